@@ -6,6 +6,7 @@ import multiprocessing as mp
 import os
 from tempfile import TemporaryDirectory
 
+from licensed_pile import profiling
 from licensed_pile.write import ShardParallelProcessor
 
 parser = argparse.ArgumentParser(
@@ -38,6 +39,11 @@ parser.add_argument(
     default=mp.cpu_count(),
     help="Number of processors for multicore.",
 )
+parser.add_argument(
+    "--profile",
+    choices=profiling.PROFILERS,
+    help="Profile each worker, the merged report is written to ${output}/profile.*, next to the documents directory.",
+)
 
 
 class ArxivParallel(ShardParallelProcessor):
@@ -54,7 +60,11 @@ def main(args):
             metadata_prefix=tempdir,
             num_processes=args.processes,
         )
-        processors(debug=args.debug)
+        processors(
+            debug=args.debug,
+            profile=args.profile,
+            profile_path=os.path.join(args.output, "profile"),
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,293 @@
+"""Measure the throughput of the licensed_pile core on synthetic corpora.
+
+Results are written as json so runs on different commits can be compared with
+`--compare`, which exits with an error if any benchmark got slower than the
+tolerance allows.
+"""
+
+import argparse
+import datetime
+import json
+import multiprocessing as mp
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from tempfile import TemporaryDirectory
+from typing import Callable, Dict, List
+
+import smart_open
+import synthetic
+
+from licensed_pile import logs
+from licensed_pile.stats import SizeStatsParallel
+from licensed_pile.write import ShardParallelProcessor, to_dolma
+from licensed_pile.xml import iterate_xml
+
+parser = argparse.ArgumentParser(description="Benchmark the licensed_pile core.")
+parser.add_argument(
+    "--data_dir",
+    default=None,
+    help="Where synthetic corpora from synthetic.py live, missing corpora are generated (and kept) there. When it isn't given, they are generated in a temporary directory.",
+)
+parser.add_argument(
+    "--output",
+    default="data/benchmarks/results.json",
+    help="Where to write the benchmark results.",
+)
+parser.add_argument(
+    "--profiles",
+    nargs="+",
+    default=list(synthetic.PROFILES),
+    choices=list(synthetic.PROFILES),
+    help="Which synthetic corpora to benchmark.",
+)
+parser.add_argument(
+    "--benchmarks",
+    nargs="+",
+    default=None,
+    help="Which benchmarks to run, defaults to all of them.",
+)
+parser.add_argument(
+    "--megabytes",
+    type=float,
+    default=20,
+    help="About how many MB of text to generate for each profile.",
+)
+parser.add_argument(
+    "--processes",
+    type=int,
+    default=mp.cpu_count(),
+    help="Number of processors for the parallel benchmarks.",
+)
+parser.add_argument(
+    "--repeats", type=int, default=3, help="How many times to run each benchmark."
+)
+parser.add_argument(
+    "--compare", help="Results from a previous run to check for regressions against."
+)
+parser.add_argument(
+    "--tolerance",
+    type=float,
+    default=0.1,
+    help="How much slower (as a fraction) a benchmark can be before it is a regression.",
+)
+
+
+class IdentityParallel(ShardParallelProcessor):
+    """Do nothing to each example so we only measure the framework overhead."""
+
+    @classmethod
+    def process_example(cls, example, **kwargs):
+        return example
+
+
+def corpus_size(corpus_dir: str) -> Dict[str, int]:
+    documents = 0
+    text_bytes = 0
+    for shard in sorted(os.listdir(os.path.join(corpus_dir, "documents"))):
+        with smart_open.open(os.path.join(corpus_dir, "documents", shard)) as f:
+            for line in f:
+                documents += 1
+                text_bytes += len(json.loads(line)["text"].encode("utf-8"))
+    return {"documents": documents, "bytes": text_bytes}
+
+
+def bench_to_dolma(corpus_dir: str, processes: int) -> Callable[[], None]:
+    del processes
+    # Load everything up front so we only time the writing.
+    examples = []
+    for shard in sorted(os.listdir(os.path.join(corpus_dir, "documents"))):
+        with smart_open.open(os.path.join(corpus_dir, "documents", shard)) as f:
+            examples.extend(json.loads(line) for line in f)
+
+    def run():
+        with TemporaryDirectory() as tempdir:
+            to_dolma(examples, tempdir, "benchmark.jsonl.gz", quiet=True)
+
+    return run
+
+
+def bench_shard_parallel(corpus_dir: str, processes: int) -> Callable[[], None]:
+    def run():
+        with TemporaryDirectory() as tempdir:
+            IdentityParallel(
+                source_prefix=os.path.join(corpus_dir, "documents", "*.jsonl.gz"),
+                destination_prefix=os.path.join(tempdir, "documents"),
+                metadata_prefix=os.path.join(tempdir, "metadata"),
+                num_processes=processes,
+            )()
+
+    return run
+
+
+def bench_size_stats(corpus_dir: str, processes: int) -> Callable[[], None]:
+    def run():
+        with TemporaryDirectory() as tempdir:
+            SizeStatsParallel(
+                source_prefix=os.path.join(corpus_dir, "documents", "*.jsonl.gz"),
+                destination_prefix=tempdir,
+                metadata_prefix=tempdir,
+                num_processes=processes,
+            )()
+
+    return run
+
+
+def bench_iterate_xml(xml_path: str, processes: int) -> Callable[[], None]:
+    del processes
+
+    def run():
+        for _ in iterate_xml(xml_path, "row"):
+            pass
+
+    return run
+
+
+# Benchmarks over the dolma corpora, each is run on every profile.
+CORPUS_BENCHMARKS = {
+    "to_dolma": bench_to_dolma,
+    "shard_parallel_processor": bench_shard_parallel,
+    "size_stats_parallel": bench_size_stats,
+}
+
+
+def measure(
+    name: str, profile: str, run: Callable[[], None], size: Dict[str, int], repeats: int
+) -> Dict:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    # The fastest run is the least affected by noise from other processes.
+    best = min(timings)
+    return {
+        "benchmark": name,
+        "profile": profile,
+        "seconds": best,
+        "median_seconds": statistics.median(timings),
+        "timings": timings,
+        **size,
+        "documents_per_second": size["documents"] / best,
+        "megabytes_per_second": size["bytes"] / best / 1e6,
+    }
+
+
+def environment(args) -> Dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "date": datetime.datetime.utcnow().isoformat(),
+        "commit": commit,
+        "python": sys.version,
+        "platform": platform.platform(),
+        "cpu_count": mp.cpu_count(),
+        "processes": args.processes,
+        "megabytes": args.megabytes,
+        "repeats": args.repeats,
+    }
+
+
+def compare(results: List[Dict], previous: List[Dict], tolerance: float) -> List[str]:
+    """Find benchmarks whose throughput dropped by more than `tolerance`."""
+    previous = {(r["benchmark"], r["profile"]): r for r in previous}
+    regressions = []
+    for result in results:
+        if (old := previous.get((result["benchmark"], result["profile"]))) is None:
+            continue
+        ratio = result["megabytes_per_second"] / old["megabytes_per_second"]
+        result["relative_throughput"] = ratio
+        if ratio < 1 - tolerance:
+            regressions.append(
+                f"{result['benchmark']}[{result['profile']}] throughput is {ratio:.2f}x the previous run."
+            )
+    return regressions
+
+
+def run_benchmarks(args, data_dir: str) -> List[Dict]:
+    logger = logs.get_logger("benchmarks")
+    wanted = set(args.benchmarks or [*CORPUS_BENCHMARKS, "iterate_xml"])
+    results = []
+    for profile in args.profiles:
+        corpus_dir = os.path.join(data_dir, profile)
+        if not os.path.exists(corpus_dir):
+            logger.info("Generating synthetic %s corpus at %s", profile, corpus_dir)
+            synthetic.write_corpus(
+                synthetic.PROFILES[profile], corpus_dir, args.megabytes
+            )
+        size = corpus_size(corpus_dir)
+        for name, bench in CORPUS_BENCHMARKS.items():
+            if name not in wanted:
+                continue
+            logger.info("Running %s on %s", name, profile)
+            results.append(
+                measure(
+                    name, profile, bench(corpus_dir, args.processes), size, args.repeats
+                )
+            )
+
+    if "iterate_xml" in wanted:
+        xml_path = os.path.join(data_dir, "xml", "Posts.xml")
+        if not os.path.exists(xml_path):
+            synthetic.write_xml(xml_path, args.megabytes)
+        size = {
+            "documents": sum(1 for _ in iterate_xml(xml_path, "row")),
+            "bytes": os.path.getsize(xml_path),
+        }
+        logger.info("Running iterate_xml")
+        results.append(
+            measure(
+                "iterate_xml",
+                "stackexchange",
+                bench_iterate_xml(xml_path, args.processes),
+                size,
+                args.repeats,
+            )
+        )
+    return results
+
+
+def main(args):
+    logger = logs.get_logger("benchmarks")
+    if args.data_dir is None:
+        with TemporaryDirectory() as data_dir:
+            results = run_benchmarks(args, data_dir)
+    else:
+        results = run_benchmarks(args, args.data_dir)
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+
+    report = {"environment": environment(args), "results": results}
+    if dirname := os.path.dirname(args.output):
+        os.makedirs(dirname, exist_ok=True)
+    with open(args.output, "w") as wf:
+        json.dump(report, wf, indent=2)
+    logger.info("Wrote benchmark results to %s", args.output)
+
+    for result in results:
+        print(
+            f"{result['benchmark']:>26} {result['profile']:>16}: "
+            f"{result['documents_per_second']:>12,.1f} docs/s "
+            f"{result['megabytes_per_second']:>8,.2f} MB/s"
+        )
+    for regression in regressions:
+        logger.error(regression)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    mp.set_start_method("spawn")
+    args = parser.parse_args()
+    logs.configure_logging("benchmarks")
+    main(args)
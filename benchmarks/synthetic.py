@@ -0,0 +1,190 @@
+"""Generate synthetic dolma corpora that look like our real sources.
+
+The size of each document is drawn from a log-normal distribution fit (roughly)
+to the source it is imitating so benchmarks see the same mix of huge and tiny
+documents that the real pipelines do.
+"""
+
+import argparse
+import datetime
+import math
+import os
+import random
+from dataclasses import dataclass
+from typing import Dict, Iterator, Sequence
+from xml.sax.saxutils import quoteattr
+
+from licensed_pile.licenses import PermissiveLicenses
+from licensed_pile.write import to_dolma
+
+parser = argparse.ArgumentParser(description="Generate synthetic dolma shards.")
+parser.add_argument(
+    "--output_dir",
+    default="data/benchmarks/synthetic",
+    help="Where the synthetic corpora go, one subdirectory per profile.",
+)
+parser.add_argument(
+    "--profiles",
+    nargs="+",
+    default=None,
+    help="Which profiles to generate, defaults to all of them.",
+)
+parser.add_argument(
+    "--megabytes",
+    type=float,
+    default=20,
+    help="About how many MB of text to generate for each profile.",
+)
+parser.add_argument("--seed", type=int, default=1234, help="The random seed.")
+
+
+# Letters used to build "words" for different writing systems.
+ALPHABETS = {
+    "en": "etaoinshrdlucmfwypvbgkjqxz",
+    "ru": "оеаинтсрвлкмдпуяыьгзбчйхжшюцщэфъё",
+    "zh": "的一是不了人我在有他这中大来上国个到说们为子和你地出道也时年",
+    "ar": "اليمونةربتدسعهفقكحجشطصىخضزثذغظ",
+    "hi": "कखगघचछजझटठडढणतथदधनपफबभमयरलवशषसह",
+}
+
+
+@dataclass
+class Profile:
+    """How big documents from a source are, and what they look like."""
+
+    name: str
+    # Parameters of the log-normal distribution over document length (in characters).
+    median_chars: int
+    sigma: float
+    max_chars: int
+    languages: Sequence[str] = ("en",)
+    license: PermissiveLicenses = PermissiveLicenses.CC_BY_SA
+
+
+PROFILES = {
+    # Book length texts, a few hundred KB each with a long tail.
+    "gutenberg": Profile(
+        "gutenberg",
+        median_chars=350_000,
+        sigma=0.6,
+        max_chars=5_000_000,
+        license=PermissiveLicenses.PD,
+    ),
+    # Lots of tiny questions, answers, and comments.
+    "stackexchange": Profile(
+        "stackexchange", median_chars=1_200, sigma=1.0, max_chars=200_000
+    ),
+    # Short instruction/response pairs across many languages.
+    "data_provenance": Profile(
+        "data_provenance",
+        median_chars=600,
+        sigma=1.2,
+        max_chars=100_000,
+        languages=tuple(ALPHABETS),
+        license=PermissiveLicenses.CC_BY,
+    ),
+}
+
+
+def random_text(rng: random.Random, n_chars: int, language: str = "en") -> str:
+    alphabet = ALPHABETS[language]
+    # Chinese doesn't use spaces between words.
+    sep = "" if language == "zh" else " "
+    words = []
+    size = 0
+    while size < n_chars:
+        word = "".join(rng.choices(alphabet, k=rng.randint(1, 10)))
+        # Add some structure so the text isn't just one long line.
+        if rng.random() < 0.01:
+            word += "\n\n"
+        elif rng.random() < 0.05:
+            word += "."
+        words.append(word)
+        size += len(word) + len(sep)
+    return sep.join(words)[:n_chars]
+
+
+def document_lengths(
+    rng: random.Random, profile: Profile, total_chars: int
+) -> Iterator[int]:
+    generated = 0
+    while generated < total_chars:
+        n = int(rng.lognormvariate(math.log(profile.median_chars), profile.sigma))
+        n = max(1, min(n, profile.max_chars))
+        generated += n
+        yield n
+
+
+def generate_documents(
+    profile: Profile, megabytes: float, seed: int = 1234
+) -> Iterator[Dict]:
+    rng = random.Random(seed)
+    added = datetime.datetime(2024, 1, 1).isoformat()
+    for i, n_chars in enumerate(
+        document_lengths(rng, profile, int(megabytes * 1000 * 1000))
+    ):
+        language = rng.choice(profile.languages)
+        yield {
+            "id": f"{profile.name}-{i}",
+            "text": random_text(rng, n_chars, language),
+            "source": f"synthetic-{profile.name}",
+            "added": added,
+            "created": added,
+            "metadata": {"license": str(profile.license), "language": language},
+        }
+
+
+def write_corpus(
+    profile: Profile,
+    output_dir: str,
+    megabytes: float,
+    seed: int = 1234,
+    shard_size: float = 0.01,
+):
+    """Write a synthetic corpus as dolma shards in `output_dir`/documents."""
+    to_dolma(
+        generate_documents(profile, megabytes, seed),
+        os.path.join(output_dir, "documents"),
+        f"{profile.name}.jsonl.gz",
+        shard_size=shard_size,
+        quiet=True,
+    )
+
+
+def write_xml(path: str, megabytes: float, seed: int = 1234, tag: str = "row"):
+    """Write a Stack Exchange style xml dump (one `row` element per line)."""
+    rng = random.Random(seed)
+    if dirname := os.path.dirname(path):
+        os.makedirs(dirname, exist_ok=True)
+    profile = PROFILES["stackexchange"]
+    with open(path, "w") as wf:
+        wf.write('<?xml version="1.0" encoding="utf-8"?>\n<posts>\n')
+        for i, n_chars in enumerate(
+            document_lengths(rng, profile, int(megabytes * 1000 * 1000))
+        ):
+            body = quoteattr(f"<p>{random_text(rng, n_chars)}</p>")
+            wf.write(
+                f'  <{tag} Id="{i}" PostTypeId="{1 + i % 2}" Score="{rng.randint(-5, 100)}" '
+                f'CreationDate="2013-05-07T20:55:35.123" Body={body} />\n'
+            )
+        wf.write("</posts>\n")
+
+
+def main(args):
+    for name in args.profiles or PROFILES:
+        write_corpus(
+            PROFILES[name],
+            os.path.join(args.output_dir, name),
+            args.megabytes,
+            seed=args.seed,
+        )
+    write_xml(
+        os.path.join(args.output_dir, "xml", "Posts.xml"),
+        args.megabytes,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -45,10 +45,9 @@ def write_jsonl_gz(
     if dirname:
         os.makedirs(dirname, exist_ok=True)
     with gzip.open(outpath, "wb") as fp:  # Open file in binary write mode
-        data_bytes = (
-            b"\n".join(json.dumps(d).encode() for d in data) + b"\n"
-        )  # Encode strings to bytes
-        fp.write(data_bytes)
+        # Write one example at a time so we never hold the whole encoded file.
+        for d in data:
+            fp.write(json.dumps(d).encode() + b"\n")
 
 
 def main(args):
@@ -67,8 +66,14 @@ def main(args):
             num_proc=os.cpu_count(),
             revision="main",
             data_files=f"data/{folder_name}/*.jsonl",
-        ).to_list()
-        exs = [ex for ex in subset if ex["dataset"] in include_dset_ids]
+        )
+        # Filter the arrow backed dataset instead of converting it to a list of
+        # python dicts, iterating over it later only loads a batch at a time.
+        exs = subset.filter(
+            lambda dsets: [d in include_dset_ids for d in dsets],
+            input_columns="dataset",
+            batched=True,
+        )
         savepath = os.path.join(args.outdir, f"{folder_name}.jsonl.gz")
         write_jsonl_gz(exs, savepath)
         logger.info(f"Saving {len(exs)} examples to {savepath}")
@@ -18,6 +18,7 @@ from constants import HF_MAPPING
 
 from licensed_pile.licenses import PermissiveLicenses
 from licensed_pile.logs import configure_logging, get_logger
+from licensed_pile.memory import parse_size
 from licensed_pile.write import to_dolma
 
 LICENSE_MAPPER = {
@@ -62,6 +63,11 @@ parser.add_argument(
 parser.add_argument(
     "--shard_size", type=int, default=1, help="Size, in GB, for each shard."
 )
+parser.add_argument(
+    "--memory_limit",
+    type=parse_size,
+    help="Pause reading when memory usage is over this limit, e.g. 8G.",
+)
 
 SOURCE_NAME = "Data Provenance Initiative"
 
@@ -77,7 +83,8 @@ def listdir_nohidden(path):
 
 def read_jsonl_gz(inpath: str):
     with gzip.open(inpath, "rb") as fp:
-        return [json.loads(l) for l in fp]
+        for l in fp:
+            yield json.loads(l)
 
 
 def extract_licenses(license_list, gh_license):
@@ -111,7 +118,6 @@ def file_to_dolma(path: str, include_df: str, source_name: str = SOURCE_NAME):
 
     dset_collection = read_jsonl_gz(path)
 
-    results = []
     for i, ex in enumerate(dset_collection):
         license_names = dset_to_licenses[ex["dataset"]]
         langs = dset_to_langs[ex["dataset"]]
@@ -121,23 +127,20 @@ def file_to_dolma(path: str, include_df: str, source_name: str = SOURCE_NAME):
         target_text = ex.get("labels", ex.get("targets", ""))
         # If target_text isn't found, the strip will remove the extra newline
         text = f"{input_text}\n{target_text}".strip()
-        results.append(
-            {
-                "id": f"{ex['dataset']}-{i}",
-                "text": text,
-                "source": source_name,
-                "added": datetime.utcnow().isoformat(),
-                "metadata": {
-                    "license": sorted(license_names),
-                    "license_url": license_urls,
-                    "language": langs,
-                    "url": url,
-                    "dataset_id": ex["dataset"],
-                    "response": target_text,
-                },
-            }
-        )
-    return results
+        yield {
+            "id": f"{ex['dataset']}-{i}",
+            "text": text,
+            "source": source_name,
+            "added": datetime.utcnow().isoformat(),
+            "metadata": {
+                "license": sorted(license_names),
+                "license_url": license_urls,
+                "language": langs,
+                "url": url,
+                "dataset_id": ex["dataset"],
+                "response": target_text,
+            },
+        }
 
 
 def main(args):
@@ -146,10 +149,17 @@ def main(args):
     include_df = pd.read_csv(args.include).fillna("")
 
     paths = listdir_nohidden(args.indir)
-    examples = itertools.chain(
-        *(file_to_dolma(path, include_df=include_df) for path in paths)
+    # Use chain.from_iterable so each file is only read once we get to it.
+    examples = itertools.chain.from_iterable(
+        file_to_dolma(path, include_df=include_df) for path in paths
+    )
+    to_dolma(
+        examples,
+        args.outdir,
+        args.filename,
+        args.shard_size,
+        memory_limit=args.memory_limit,
     )
-    to_dolma(examples, args.outdir, args.filename, args.shard_size)
 
 
 if __name__ == "__main__":
@@ -14,7 +14,7 @@ from tempfile import TemporaryDirectory
 import bs4
 import tqdm
 
-from licensed_pile import logs
+from licensed_pile import logs, profiling
 from licensed_pile.write import ShardParallelProcessor
 
 parser = argparse.ArgumentParser(
@@ -47,6 +47,11 @@ parser.add_argument(
     default=mp.cpu_count(),
     help="Number of processors for multicore.",
 )
+parser.add_argument(
+    "--profile",
+    choices=profiling.PROFILERS,
+    help="Profile each worker, the merged report is written to ${output}/profile.*, next to the documents directory.",
+)
 
 # Dolma later sets the log level to error, need to override cls.get_logger() if
 # we want to see info methods.
@@ -243,7 +248,11 @@ def main(args):
             metadata_prefix=tempdir,
             num_processes=args.processes,
         )
-        processor(debug=args.debug)
+        processor(
+            debug=args.debug,
+            profile=args.profile,
+            profile_path=os.path.join(args.output, "profile"),
+        )
 
 
 if __name__ == "__main__":
@@ -15,6 +15,7 @@ from tempfile import TemporaryDirectory
 
 import tqdm
 
+from licensed_pile import profiling
 from licensed_pile.write import ShardParallelProcessor
 
 parser = argparse.ArgumentParser(description="Preprocess raw books in dolma format.")
@@ -45,6 +46,11 @@ parser.add_argument(
     default=mp.cpu_count(),
     help="Number of processors for multicore.",
 )
+parser.add_argument(
+    "--profile",
+    choices=profiling.PROFILERS,
+    help="Profile each worker, the merged report is written to ${output}/profile.*, next to the documents directory.",
+)
 
 
 HEADER = re.compile(
@@ -84,7 +90,11 @@ def main(args):
             metadata_prefix=tempdir,
             num_processes=args.processes,
         )
-        processor(debug=args.debug)
+        processor(
+            debug=args.debug,
+            profile=args.profile,
+            profile_path=os.path.join(args.output, "profile"),
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,173 @@
+"""An on disk cache of expensive conversions, like running pandoc.
+
+Rerunning a pipeline after a change converts the same documents again even
+though most of them haven't changed. `ConversionCache` saves each result in an
+sqlite database keyed by a hash of the input and a `version` string, which
+should change whenever the conversion would (the converter, its version, and
+its options). Results from an old version are never returned, they just age
+out of the cache.
+
+Many processes can share a cache, each pool worker opens its own
+`ConversionCache` on the same path. The database uses write ahead logging so
+reads aren't blocked by other processes writing. Writes are buffered and
+committed `buffer_size` at a time. Once the stored results are larger than
+`max_size` bytes, the least recently used ones are removed.
+
+Example usage:
+```python
+with ConversionCache("cache.sqlite", pandoc.version, max_size=10**10) as cache:
+    for html in documents:
+        text = cache.convert(html, pandoc.convert)
+```
+"""
+
+import hashlib
+import sqlite3
+import time
+import zlib
+from typing import Callable, Dict, List, Optional, Tuple
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+  key BLOB PRIMARY KEY,
+  value BLOB NOT NULL,
+  size INTEGER NOT NULL,
+  used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cache_used ON cache (used);
+-- The total size is kept up to date by triggers so checking it is cheap.
+CREATE TABLE IF NOT EXISTS total (size INTEGER NOT NULL);
+INSERT INTO total SELECT 0 WHERE NOT EXISTS (SELECT * FROM total);
+CREATE TRIGGER IF NOT EXISTS cache_insert AFTER INSERT ON cache
+  BEGIN UPDATE total SET size = size + NEW.size; END;
+CREATE TRIGGER IF NOT EXISTS cache_delete AFTER DELETE ON cache
+  BEGIN UPDATE total SET size = size - OLD.size; END;
+"""
+
+
+class ConversionCache:
+    """Results of converting text with a `version` of a converter, saved in sqlite.
+
+    Args:
+      path: Where the database is saved, it is created if it doesn't exist.
+      version: Identifies the conversion, it is part of the key.
+      max_size: The most bytes of (compressed) results to keep, `None` for no
+        limit. When it is exceeded the least recently used results are removed
+        until the cache is under 90% of `max_size`.
+      buffer_size: How many new results (and reads) to hold in memory before
+        writing them. Results that are still buffered when a process is killed
+        are lost, which only means they are converted again.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        version: str,
+        max_size: Optional[int] = None,
+        buffer_size: int = 100,
+    ):
+        self.path = path
+        self.version = version
+        self._version_hash = hashlib.blake2b(
+            version.encode("utf-8") + b"\0", digest_size=16
+        )
+        self.max_size = max_size
+        self.buffer_size = buffer_size
+        # Other processes can hold the write lock while they commit.
+        self._db = sqlite3.connect(path, timeout=600)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        # Workers opening a new cache at the same time create it one at a time.
+        self._db.executescript(f"BEGIN IMMEDIATE; {_SCHEMA} COMMIT;")
+        self._buffer: List[Tuple[bytes, bytes, int, float]] = []
+        self._used: Dict[bytes, float] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text: str) -> bytes:
+        digest = self._version_hash.copy()
+        digest.update(text.encode("utf-8"))
+        return digest.digest()
+
+    def get(self, text: str) -> Optional[str]:
+        return self._get(self.key(text))
+
+    def put(self, text: str, result: str):
+        self._put(self.key(text), result)
+
+    def convert(self, text: str, converter: Callable[[str], str]) -> str:
+        """The cached result for `text`, calling `converter` if there isn't one."""
+        key = self.key(text)
+        if (result := self._get(key)) is None:
+            result = converter(text)
+            self._put(key, result)
+        return result
+
+    def _get(self, key: bytes) -> Optional[str]:
+        row = self._db.execute(
+            "SELECT value FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._used[key] = time.time()
+        if len(self._used) >= self.buffer_size:
+            self.flush()
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def _put(self, key: bytes, result: str):
+        value = zlib.compress(result.encode("utf-8"))
+        self._buffer.append((key, value, len(value), time.time()))
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer and not self._used:
+            return
+        with self._db:
+            # The same document can be converted by two processes at once,
+            # their results are the same so the second is ignored.
+            self._db.executemany(
+                "INSERT OR IGNORE INTO cache (key, value, size, used) VALUES (?, ?, ?, ?)",
+                self._buffer,
+            )
+            self._db.executemany(
+                "UPDATE cache SET used = ? WHERE key = ?",
+                ((used, key) for key, used in self._used.items()),
+            )
+        self._buffer = []
+        self._used = {}
+        self.evict()
+
+    def size(self) -> int:
+        """The number of bytes of results in the cache."""
+        return self._db.execute("SELECT size FROM total").fetchone()[0]
+
+    def evict(self):
+        """Remove the least recently used results when the cache is too large."""
+        if self.max_size is None or (total := self.size()) <= self.max_size:
+            return
+        to_free = total - int(0.9 * self.max_size)
+        freed = 0
+        cutoff = None
+        rows = self._db.execute("SELECT used, size FROM cache ORDER BY used")
+        for used, size in rows:
+            freed += size
+            cutoff = used
+            if freed >= to_free:
+                break
+        rows.close()
+        with self._db:
+            self._db.execute("DELETE FROM cache WHERE used <= ?", (cutoff,))
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
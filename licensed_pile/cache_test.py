@@ -0,0 +1,74 @@
+"""Tests for the on disk conversion cache."""
+
+import functools
+import multiprocessing as mp
+
+from licensed_pile.cache import ConversionCache
+
+
+def upper(calls, text):
+    calls.append(text)
+    return text.upper()
+
+
+def test_convert_only_runs_once(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    calls = []
+    with ConversionCache(path, "v1", buffer_size=2) as cache:
+        assert cache.convert("a", functools.partial(upper, calls)) == "A"
+        assert cache.convert("é 温度", functools.partial(upper, calls)) == "É 温度"
+    # A new process (or rerun) sees the saved results.
+    with ConversionCache(path, "v1") as cache:
+        assert cache.convert("a", functools.partial(upper, calls)) == "A"
+        assert cache.get("é 温度") == "É 温度"
+        assert cache.get("b") is None
+        assert (cache.hits, cache.misses) == (2, 1)
+    assert calls == ["a", "é 温度"]
+
+
+def test_version_is_part_of_the_key(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    with ConversionCache(path, "v1") as cache:
+        cache.put("a", "old")
+    with ConversionCache(path, "v2") as cache:
+        assert cache.get("a") is None
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    text = "".join(chr(0x4E00 + i) for i in range(2000))
+    with ConversionCache(str(tmp_path / "cache.sqlite"), "v1", buffer_size=1) as cache:
+        for i in range(10):
+            cache.put(str(i), text)
+            # Keep the first result in use.
+            assert cache.get("0") == text
+        size = cache.size()
+    with ConversionCache(
+        str(tmp_path / "cache.sqlite"), "v1", max_size=size // 2, buffer_size=1
+    ) as cache:
+        cache.put("new", text)
+        assert cache.size() <= size // 2
+        assert cache.get("0") == text
+        assert cache.get("new") == text
+        assert cache.get("1") is None
+
+
+def fill(path):
+    with ConversionCache(path, "v1", buffer_size=3) as cache:
+        for i in range(20):
+            cache.convert(str(i), lambda text: f"{text}-")
+
+
+def test_shared_between_processes(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    ctx = mp.get_context("spawn")
+    processes = [ctx.Process(target=fill, args=(path,)) for _ in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    with ConversionCache(path, "v1") as cache:
+        assert [cache.get(str(i)) for i in range(20)] == [f"{i}-" for i in range(20)]
+        assert cache.size() == sum(
+            row[0] for row in cache._db.execute("SELECT size FROM cache")
+        )
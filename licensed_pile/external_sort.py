@@ -0,0 +1,98 @@
+"""Sort iterables that don't fit in memory.
+
+Items are sorted in chunks of at most `max_items`, each sorted chunk (a "run")
+is pickled to a temporary file, and then the runs are lazily merged with
+`heapq.merge`. Only one chunk, plus one small batch per run while merging, is
+in memory at a time.
+"""
+
+import heapq
+import itertools
+import os
+import pickle
+import tempfile
+from typing import Callable, Iterable, Iterator, List, Optional, TypeVar
+
+from licensed_pile import metrics
+from licensed_pile.logs import get_logger
+
+T = TypeVar("T")
+
+# Items are pickled in batches as pickling each item on its own is slow.
+_BATCH_SIZE = 1_000
+
+
+def _write_run(items: List[T], directory: str) -> str:
+    with tempfile.NamedTemporaryFile(dir=directory, suffix=".run", delete=False) as wf:
+        for i in range(0, len(items), _BATCH_SIZE):
+            pickle.dump(
+                items[i : i + _BATCH_SIZE], wf, protocol=pickle.HIGHEST_PROTOCOL
+            )
+        return wf.name
+
+
+def _read_run(path: str) -> Iterator[T]:
+    with open(path, "rb") as f:
+        while True:
+            try:
+                yield from pickle.load(f)
+            except EOFError:
+                return
+
+
+def _merge_runs(
+    runs: List[str], key: Optional[Callable], directory: str, max_open_runs: int
+) -> Iterator[T]:
+    # Merge groups of runs into larger runs until there are few enough that we
+    # can have a file open for each one.
+    while len(runs) > max_open_runs:
+        merged = []
+        for i in range(0, len(runs), max_open_runs):
+            group = runs[i : i + max_open_runs]
+            with tempfile.NamedTemporaryFile(
+                dir=directory, suffix=".run", delete=False
+            ) as wf:
+                items = heapq.merge(*map(_read_run, group), key=key)
+                while batch := list(itertools.islice(items, _BATCH_SIZE)):
+                    pickle.dump(batch, wf, protocol=pickle.HIGHEST_PROTOCOL)
+                merged.append(wf.name)
+            for run in group:
+                os.remove(run)
+        runs = merged
+    yield from heapq.merge(*map(_read_run, runs), key=key)
+
+
+def external_sort(
+    iterable: Iterable[T],
+    key: Optional[Callable[[T], object]] = None,
+    max_items: int = 1_000_000,
+    tmp_dir: Optional[str] = None,
+    max_open_runs: int = 256,
+) -> Iterator[T]:
+    """Sort `iterable` holding at most `max_items` in memory.
+
+    The sort is stable, items with equal keys come out in the order they went
+    in. Nothing is written to disk when everything fits in a single chunk.
+
+    Args:
+      iterable: The items to sort, they must be picklable.
+      key: Sort on `key(item)` instead of the item itself.
+      max_items: How many items are sorted in memory at once.
+      tmp_dir: Where to spill sorted runs, defaults to the system temp dir.
+      max_open_runs: The most runs to merge at once, more are merged in passes.
+    """
+    iterator = iter(iterable)
+    chunk = sorted(itertools.islice(iterator, max_items), key=key)
+    if len(chunk) < max_items:
+        yield from chunk
+        return
+    with tempfile.TemporaryDirectory(dir=tmp_dir, prefix="external-sort-") as directory:
+        runs = []
+        while chunk:
+            runs.append(_write_run(chunk, directory))
+            # Release the old chunk before building the next one.
+            chunk = None
+            chunk = sorted(itertools.islice(iterator, max_items), key=key)
+        metrics.increment("external_sort/runs", len(runs))
+        get_logger().debug("Merging %d sorted runs from %s", len(runs), directory)
+        yield from _merge_runs(runs, key, directory, max_open_runs)
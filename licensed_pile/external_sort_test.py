@@ -0,0 +1,43 @@
+"""Tests for sorting in bounded memory."""
+
+import os
+import random
+
+import pytest
+
+from licensed_pile.external_sort import external_sort
+
+
+@pytest.mark.parametrize("max_items", [1, 7, 100, 10_000])
+def test_external_sort_matches_sorted(max_items, tmp_path):
+    rng = random.Random(max_items)
+    items = [rng.randint(0, 50) for _ in range(1000)]
+    assert list(external_sort(items, max_items=max_items, tmp_dir=tmp_path)) == sorted(
+        items
+    )
+
+
+def test_external_sort_is_stable(tmp_path):
+    items = [(i % 5, i) for i in range(500)]
+    result = list(
+        external_sort(items, key=lambda x: x[0], max_items=13, tmp_dir=tmp_path)
+    )
+    assert result == sorted(items, key=lambda x: x[0])
+
+
+def test_external_sort_merges_in_passes(tmp_path):
+    items = list(range(1000, 0, -1))
+    result = list(external_sort(items, max_items=10, max_open_runs=3, tmp_dir=tmp_path))
+    assert result == sorted(items)
+
+
+def test_external_sort_cleans_up(tmp_path):
+    result = external_sort(range(100, 0, -1), max_items=10, tmp_dir=tmp_path)
+    assert next(result) == 1
+    assert os.listdir(tmp_path)
+    assert list(result) == list(range(2, 101))
+    assert not os.listdir(tmp_path)
+
+
+def test_external_sort_empty(tmp_path):
+    assert list(external_sort([], tmp_dir=tmp_path)) == []
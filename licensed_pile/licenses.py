@@ -1,7 +1,9 @@
 """Enumeration of licenses."""
 
+import functools
 import re
 from enum import Enum
+from typing import Iterable, Optional
 
 
 class StringEnum(Enum):
@@ -46,21 +48,87 @@ class PermissiveLicenses(StringEnum):
     # we should just have a bit of a mess and lots of unittests.
     @classmethod
     def from_string(cls, s: str) -> "PermissiveLicenses":
-        s = s.lower().strip()
-        if re.match(r".*/publicdomain/zero/1.0/?$", s):
-            return cls.CC0
-        if m := re.match(r".*/licenses/by(?P<share>-sa)?/(?P<version>\d).0/?$", s):
-            if m.group("version") == "4":
-                if m.group("share") is None:
-                    return cls.CC_BY_SA
-                return cls.CC_BY
-            elif m.group(1) == "3":
-                if m.group("share") is None:
-                    return cls.CC_BY_SA_3
-                return cls.CC_BY_3
-            else:
+        if (license := _classify_license(s)) is None:
+            raise ValueError(f"Unable to understand license {s}")
+        return license
+
+    @classmethod
+    def from_strings(cls, values: Iterable[str], errors: str = "raise"):
+        """Convert a whole column of license strings at once.
+
+        Each unique string is only classified once, so this is cheap even for
+        millions of rows that share a handful of licenses.
+
+        Args:
+          values: A pandas Series, a pyarrow (Chunked)Array, or any iterable
+            of strings.
+          errors: "raise" to raise a ValueError for strings we don't understand,
+            "ignore" to return None (or null) for them.
+
+        Returns:
+          A pandas Series of PermissiveLicenses for pandas input, a pyarrow
+          string array of `str(license)` for pyarrow input (as arrow can't hold
+          enums), otherwise a list of PermissiveLicenses.
+        """
+        if errors not in ("raise", "ignore"):
+            raise ValueError(f"errors must be 'raise' or 'ignore', got {errors}")
+
+        def _lookup(s):
+            if s is None:
+                return None
+            if (license := _classify_license(s)) is None and errors == "raise":
                 raise ValueError(f"Unable to understand license {s}")
-        raise ValueError(f"Unable to understand license {s}")
+            return license
+
+        module = type(values).__module__
+        if module.startswith("pyarrow"):
+            import pyarrow as pa
+            import pyarrow.compute as pc
+
+            uniques = pc.unique(values)
+            licenses = [_lookup(u) for u in uniques.to_pylist()]
+            licenses = pa.array(
+                [None if l is None else str(l) for l in licenses], type=pa.string()
+            )
+            return pc.take(licenses, pc.index_in(values, value_set=uniques))
+        if module.startswith("pandas"):
+            return values.map({u: _lookup(u) for u in values.dropna().unique()})
+        cache = {}
+        results = []
+        for v in values:
+            if v not in cache:
+                cache[v] = _lookup(v)
+            results.append(cache[v])
+        return results
+
+
+# Creative Commons licenses are generally given as urls, these are the parts of
+# those urls that tell us which license it is.
+_LICENSE_URL = re.compile(
+    r".*/(?:"
+    r"(?P<zero>publicdomain/zero/1\.0)"
+    r"|licenses/by(?P<share>-sa)?/(?P<version>\d\.\d)"
+    r")/?$"
+)
+
+_CC_LICENSES = {
+    (None, "4.0"): PermissiveLicenses.CC_BY,
+    (None, "3.0"): PermissiveLicenses.CC_BY_3,
+    ("-sa", "4.0"): PermissiveLicenses.CC_BY_SA,
+    ("-sa", "3.0"): PermissiveLicenses.CC_BY_SA_3,
+    ("-sa", "2.5"): PermissiveLicenses.CC_BY_SA_2_5,
+}
+
+
+# The cache is keyed on the raw string so cache hits skip normalization too.
+@functools.lru_cache(maxsize=4096)
+def _classify_license(s: str) -> Optional[PermissiveLicenses]:
+    s = s.lower().strip()
+    if (m := _LICENSE_URL.match(s)) is None:
+        return None
+    if m.group("zero"):
+        return PermissiveLicenses.CC0
+    return _CC_LICENSES.get((m.group("share"), m.group("version")))
 
 
 class RestrictiveLicenses(StringEnum):
@@ -0,0 +1,103 @@
+"""Tests for license parsing."""
+
+import pytest
+
+from licensed_pile.licenses import PermissiveLicenses
+
+
+@pytest.mark.parametrize(
+    "url,license",
+    [
+        (
+            "https://creativecommons.org/publicdomain/zero/1.0/",
+            PermissiveLicenses.CC0,
+        ),
+        ("https://creativecommons.org/licenses/by/4.0/", PermissiveLicenses.CC_BY),
+        ("http://creativecommons.org/licenses/by/4.0", PermissiveLicenses.CC_BY),
+        ("https://creativecommons.org/licenses/by/3.0/", PermissiveLicenses.CC_BY_3),
+        (
+            "https://creativecommons.org/licenses/by-sa/4.0/",
+            PermissiveLicenses.CC_BY_SA,
+        ),
+        (
+            "https://creativecommons.org/licenses/by-sa/3.0/",
+            PermissiveLicenses.CC_BY_SA_3,
+        ),
+        (
+            "https://creativecommons.org/licenses/by-sa/2.5/",
+            PermissiveLicenses.CC_BY_SA_2_5,
+        ),
+        (
+            "  HTTPS://CreativeCommons.org/Licenses/BY-SA/4.0/ \n",
+            PermissiveLicenses.CC_BY_SA,
+        ),
+    ],
+)
+def test_from_string(url, license):
+    assert PermissiveLicenses.from_string(url) == license
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "https://creativecommons.org/licenses/by-nc/4.0/",
+        "https://creativecommons.org/licenses/by/2.0/",
+        "MIT",
+        "",
+    ],
+)
+def test_from_string_unknown(url):
+    with pytest.raises(ValueError):
+        PermissiveLicenses.from_string(url)
+
+
+def test_from_strings_list():
+    values = [
+        "https://creativecommons.org/licenses/by/4.0/",
+        "https://creativecommons.org/licenses/by-nc/4.0/",
+        "https://creativecommons.org/licenses/by/4.0/",
+    ]
+    assert PermissiveLicenses.from_strings(values, errors="ignore") == [
+        PermissiveLicenses.CC_BY,
+        None,
+        PermissiveLicenses.CC_BY,
+    ]
+    with pytest.raises(ValueError):
+        PermissiveLicenses.from_strings(values)
+
+
+def test_from_strings_pandas():
+    pd = pytest.importorskip("pandas")
+    values = pd.Series(
+        [
+            "https://creativecommons.org/licenses/by-sa/3.0/",
+            "https://creativecommons.org/publicdomain/zero/1.0/",
+        ]
+        * 3
+    )
+    result = PermissiveLicenses.from_strings(values)
+    assert (
+        list(result)
+        == [
+            PermissiveLicenses.CC_BY_SA_3,
+            PermissiveLicenses.CC0,
+        ]
+        * 3
+    )
+
+
+def test_from_strings_arrow():
+    pa = pytest.importorskip("pyarrow")
+    values = pa.chunked_array(
+        [
+            ["https://creativecommons.org/licenses/by/4.0/", None],
+            ["unknown", "https://creativecommons.org/licenses/by/4.0/"],
+        ]
+    )
+    result = PermissiveLicenses.from_strings(values, errors="ignore")
+    assert result.to_pylist() == [
+        str(PermissiveLicenses.CC_BY),
+        None,
+        None,
+        str(PermissiveLicenses.CC_BY),
+    ]
@@ -0,0 +1,261 @@
+"""Tools to keep pipelines within a memory budget.
+
+  * `RSSWatchdog`: A background thread that tracks the resident memory of the
+    process (and its children, like pool workers) and logs the peak for each
+    stage of the pipeline.
+  * `bounded_prefetch`: Read ahead of the consumer in a background thread, but
+    only up to a fixed number of items and not while over the memory budget.
+  * `bounded_imap`: `Pool.imap` without the unbounded task and result queues.
+"""
+
+import collections
+import contextlib
+import itertools
+import os
+import queue
+import re
+import resource
+import sys
+import threading
+from typing import Callable, Iterable, Iterator, Optional, TypeVar, Union
+
+from licensed_pile import metrics
+from licensed_pile.logs import get_logger
+
+T = TypeVar("T")
+U = TypeVar("U")
+
+_UNITS = {"": 1, "K": 1000, "M": 1000**2, "G": 1000**3, "T": 1000**4}
+
+
+def parse_size(size: Union[str, int, None]) -> Optional[int]:
+    """Convert a size like 512M or 8G into bytes, uses powers of 10 like our shards."""
+    if size is None or isinstance(size, int):
+        return size
+    if (
+        m := re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*", size.upper())
+    ) is None:
+        raise ValueError(f"Unable to parse size {size}, expected something like 8G")
+    return int(float(m.group(1)) * _UNITS[m.group(2)])
+
+
+def _children(pid: int) -> Iterator[int]:
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(c) for c in f.read().split()]
+    except (OSError, ValueError):
+        return
+    for child in children:
+        yield child
+        yield from _children(child)
+
+
+def _proc_rss(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def get_rss(include_children: bool = True) -> int:
+    """The current resident memory, in bytes, of this process and its children."""
+    try:
+        import psutil
+
+        process = psutil.Process()
+        processes = [process]
+        if include_children:
+            processes.extend(process.children(recursive=True))
+        rss = 0
+        for p in processes:
+            try:
+                rss += p.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss
+    except ImportError:
+        pass
+    if os.path.exists("/proc/self/statm"):
+        pid = os.getpid()
+        rss = _proc_rss(pid)
+        if include_children:
+            rss += sum(_proc_rss(c) for c in _children(pid))
+        return rss
+    # Fall back to the peak memory of this process, ru_maxrss is in bytes on
+    # macOS but KB on Linux.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RSSWatchdog:
+    """Poll memory usage in a background thread, tracking the peak for each stage.
+
+    Example:
+
+        with RSSWatchdog(limit=parse_size("8G")) as watchdog:
+            with watchdog.stage("parse"):
+                ...
+    """
+
+    def __init__(
+        self,
+        limit: Optional[int] = None,
+        interval: float = 1.0,
+        include_children: bool = True,
+    ):
+        self.limit = limit
+        self.interval = interval
+        self.include_children = include_children
+        self.rss = 0
+        self.peak = 0
+        self._stages = {}
+        self._warned = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _poll(self):
+        self.rss = get_rss(self.include_children)
+        self.peak = max(self.peak, self.rss)
+        for stage in self._stages:
+            self._stages[stage] = max(self._stages[stage], self.rss)
+        if self.over_budget and not self._warned:
+            get_logger().warning(
+                "Memory usage %.2fGB is over the budget of %.2fGB, applying backpressure.",
+                self.rss / 1e9,
+                self.limit / 1e9,
+            )
+            self._warned = True
+        elif not self.over_budget:
+            self._warned = False
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._poll()
+
+    @property
+    def over_budget(self) -> bool:
+        return self.limit is not None and self.rss > self.limit
+
+    def start(self) -> "RSSWatchdog":
+        self._poll()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        get_logger().info("Peak memory usage was %.2fGB", self.peak / 1e9)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Track (and log) the peak memory while the code in this context runs."""
+        self._poll()
+        self._stages[name] = self.rss
+        try:
+            yield self
+        finally:
+            self._poll()
+            peak = self._stages.pop(name)
+            metrics.observe(f"memory/{name}", peak)
+            get_logger().info(
+                "Peak memory usage during %s was %.2fGB", name, peak / 1e9
+            )
+
+
+_DONE = object()
+
+
+def bounded_prefetch(
+    iterable: Iterable[T],
+    max_items: int = 1000,
+    watchdog: Optional[RSSWatchdog] = None,
+    backoff: float = 0.1,
+) -> Iterator[T]:
+    """Produce items from `iterable` in a background thread, at most `max_items` ahead.
+
+    When a watchdog is given and we are over the memory budget, the producer
+    stops reading until the consumer has drained everything already buffered.
+    """
+    buffer = queue.Queue(maxsize=max(1, max_items))
+    stop = threading.Event()
+    # Set by the consumer whenever it empties the buffer.
+    drained = threading.Event()
+
+    def _put(entry) -> bool:
+        """Add to the buffer unless the consumer stops first, returns whether it was added."""
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=backoff)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce():
+        try:
+            for item in iterable:
+                while watchdog is not None and watchdog.over_budget:
+                    drained.clear()
+                    if buffer.empty() or stop.is_set():
+                        break
+                    drained.wait(backoff)
+                if not _put((item, None)):
+                    return
+        except BaseException as e:
+            _put((_DONE, e))
+            return
+        _put((_DONE, None))
+
+    thread = threading.Thread(target=_produce, name="bounded_prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if buffer.empty():
+                drained.set()
+            if item is _DONE:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        # The consumer may stop early, unblock the producer so it can exit.
+        stop.set()
+
+
+def _apply_chunk(func: Callable[[T], U], chunk):
+    return [func(x) for x in chunk]
+
+
+def bounded_imap(
+    pool,
+    func: Callable[[T], U],
+    iterable: Iterable[T],
+    max_in_flight: int = 1000,
+    chunksize: int = 1,
+) -> Iterator[U]:
+    """Like `pool.imap`, but only `max_in_flight` items are submitted or waiting to be consumed.
+
+    `Pool.imap` reads the whole input iterable into its task queue and buffers
+    results as fast as the workers make them, this keeps both bounded so a slow
+    consumer applies backpressure to the workers. Results are in input order.
+    """
+    max_chunks = max(1, max_in_flight // max(1, chunksize))
+    iterator = iter(iterable)
+    in_flight = collections.deque()
+    while chunk := list(itertools.islice(iterator, chunksize)):
+        in_flight.append(pool.apply_async(_apply_chunk, (func, chunk)))
+        if len(in_flight) >= max_chunks:
+            yield from in_flight.popleft().get()
+    while in_flight:
+        yield from in_flight.popleft().get()
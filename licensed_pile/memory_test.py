@@ -0,0 +1,86 @@
+"""Tests for the memory budget tools."""
+
+import multiprocessing as mp
+import threading
+import time
+
+import pytest
+
+from licensed_pile import memory
+
+
+def square(x):
+    return x * x
+
+
+@pytest.mark.parametrize(
+    "size,expected",
+    [("8G", 8_000_000_000), ("512m", 512_000_000), ("1.5GB", 1_500_000_000), (10, 10)],
+)
+def test_parse_size(size, expected):
+    assert memory.parse_size(size) == expected
+
+
+def test_parse_size_invalid():
+    with pytest.raises(ValueError):
+        memory.parse_size("lots")
+
+
+def test_bounded_prefetch_keeps_order():
+    assert list(memory.bounded_prefetch(range(1000), max_items=3)) == list(range(1000))
+
+
+def test_bounded_prefetch_reraises():
+    def gen():
+        yield 1
+        raise RuntimeError("Failed")
+
+    with pytest.raises(RuntimeError):
+        list(memory.bounded_prefetch(gen()))
+
+
+def test_bounded_prefetch_producer_exits_when_the_consumer_stops():
+    before = set(threading.enumerate())
+    prefetch = memory.bounded_prefetch(range(2), max_items=1, backoff=0.01)
+    assert next(prefetch) == 0
+    (producer,) = [
+        t
+        for t in threading.enumerate()
+        if t not in before and t.name == "bounded_prefetch"
+    ]
+    # Let the producer fill the buffer and block on the end of the items.
+    time.sleep(0.1)
+    prefetch.close()
+    producer.join(timeout=5)
+    assert not producer.is_alive()
+
+
+def test_bounded_prefetch_over_budget_still_makes_progress():
+    watchdog = memory.RSSWatchdog(limit=1)
+    watchdog._poll()
+    assert watchdog.over_budget
+    assert list(memory.bounded_prefetch(range(10), watchdog=watchdog)) == list(
+        range(10)
+    )
+
+
+def test_bounded_imap_is_lazy_and_ordered():
+    consumed = []
+
+    def inputs():
+        for i in range(100):
+            consumed.append(i)
+            yield i
+
+    with mp.get_context("spawn").Pool(2) as pool:
+        results = memory.bounded_imap(
+            pool, square, inputs(), max_in_flight=10, chunksize=2
+        )
+        assert next(results) == 0
+        # Only a window of the inputs have been read.
+        assert len(consumed) <= 12
+        assert list(results) == [i * i for i in range(1, 100)]
+
+
+def test_get_rss():
+    assert memory.get_rss() > 0
@@ -0,0 +1,256 @@
+"""Lightweight counters, histograms, and timers for pipeline instrumentation.
+
+Each process has its own registry of metrics, so recording a value never needs
+to talk to another process. Worker processes hand their registry back to the
+parent as a plain dict (`snapshot`), generally by writing it to a json file
+(`dump`), and the parent folds them into its own registry (`merge`) before
+writing a summary.
+
+Naming convention: A stage, like `to_dolma/serialize`, is timed with a timer of
+that name. If a counter with the *same* name exists, the summary reports it as
+the number of items that stage processed along with the throughput.
+
+Example:
+
+    from licensed_pile import metrics
+
+    with metrics.timer("parse"):
+        parse(...)
+
+    @metrics.timer("download")
+    def download(...):
+        ...
+
+    metrics.increment("parse", len(documents))
+    metrics.write_summary("metrics.json")
+"""
+
+import contextlib
+import glob
+import json
+import os
+import time
+from typing import Any, Dict, Iterable, Optional
+
+import smart_open
+
+from licensed_pile.logs import get_logger
+
+
+class Histogram:
+    """Summary statistics of observed values, mergeable across processes."""
+
+    __slots__ = ("count", "total", "min", "max")
+
+    def __init__(
+        self,
+        count: int = 0,
+        total: float = 0.0,
+        min: Optional[float] = None,
+        max: Optional[float] = None,
+    ):
+        self.count = count
+        self.total = total
+        self.min = min
+        self.max = max
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other: "Histogram"):
+        if not other.count:
+            return
+        self.count += other.count
+        self.total += other.total
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self.total / self.count if self.count else None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "total": self.total,
+            "min": self.min,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Histogram":
+        return cls(**data)
+
+
+class Metrics:
+    """A per-process registry of counters, histograms, and timers."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counters: Dict[str, float] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        # Timers are histograms of durations (in seconds), they are kept separate
+        # so the summary knows what can be turned into a throughput.
+        self.timers: Dict[str, Histogram] = {}
+        self.start = time.time()
+
+    def increment(self, name: str, value: float = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float):
+        if (hist := self.histograms.get(name)) is None:
+            hist = self.histograms[name] = Histogram()
+        hist.observe(value)
+
+    def record_time(self, name: str, seconds: float):
+        if (hist := self.timers.get(name)) is None:
+            hist = self.timers[name] = Histogram()
+        hist.observe(seconds)
+
+    def timer(self, name: str) -> "Timer":
+        return Timer(name, metrics=self)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Convert this registry into a json serializable dict."""
+        return {
+            "start": self.start,
+            "counters": dict(self.counters),
+            "histograms": {k: h.to_dict() for k, h in self.histograms.items()},
+            "timers": {k: h.to_dict() for k, h in self.timers.items()},
+        }
+
+    def merge(self, snapshot: Dict[str, Any]):
+        """Fold the snapshot of another registry (often from a worker) into this one."""
+        for name, value in snapshot.get("counters", {}).items():
+            self.increment(name, value)
+        for collection, merged in (
+            ("histograms", self.histograms),
+            ("timers", self.timers),
+        ):
+            for name, data in snapshot.get(collection, {}).items():
+                merged.setdefault(name, Histogram()).merge(Histogram.from_dict(data))
+
+    def summary(self) -> Dict[str, Any]:
+        """A report of time and throughput for each stage."""
+        wall_time = time.time() - self.start
+        stages = {}
+        for name, hist in sorted(self.timers.items()):
+            stage = {
+                "calls": hist.count,
+                "seconds": hist.total,
+                "mean_seconds": hist.mean,
+                "min_seconds": hist.min,
+                "max_seconds": hist.max,
+            }
+            if name in self.counters:
+                stage["items"] = self.counters[name]
+                stage["items_per_second"] = (
+                    self.counters[name] / hist.total if hist.total else None
+                )
+            stages[name] = stage
+        return {
+            "wall_seconds": wall_time,
+            "stages": stages,
+            "counters": dict(sorted(self.counters.items())),
+            "histograms": {
+                name: {**hist.to_dict(), "mean": hist.mean}
+                for name, hist in sorted(self.histograms.items())
+            },
+        }
+
+
+class Timer(contextlib.ContextDecorator):
+    """Time a block of code, usable as a context manager or decorator.
+
+    When `metrics` is None, the timing is recorded in whichever registry is the
+    process's default registry when the block finishes. This means decorators
+    applied at import time still record into a worker's registry after a reset.
+    """
+
+    def __init__(self, name: str, metrics: Optional[Metrics] = None):
+        self.name = name
+        self.metrics = metrics
+        # A stack so the same decorated function can be called recursively.
+        self._starts = []
+
+    def __enter__(self):
+        self._starts.append(time.perf_counter())
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self._starts.pop()
+        metrics = self.metrics if self.metrics is not None else get_metrics()
+        metrics.record_time(self.name, elapsed)
+        return False
+
+
+_METRICS = Metrics()
+
+
+def get_metrics() -> Metrics:
+    """Get this process's default registry."""
+    return _METRICS
+
+
+def increment(name: str, value: float = 1):
+    _METRICS.increment(name, value)
+
+
+def observe(name: str, value: float):
+    _METRICS.observe(name, value)
+
+
+def record_time(name: str, seconds: float):
+    _METRICS.record_time(name, seconds)
+
+
+def timer(name: str) -> Timer:
+    return Timer(name)
+
+
+def reset():
+    _METRICS.reset()
+
+
+def dump(path: str, metrics: Optional[Metrics] = None):
+    """Write the snapshot of a registry to `path` so another process can merge it."""
+    metrics = metrics if metrics is not None else _METRICS
+    with smart_open.open(path, "w") as wf:
+        json.dump(metrics.snapshot(), wf)
+
+
+def merge_files(paths: Iterable[str], metrics: Optional[Metrics] = None) -> Metrics:
+    """Merge dumped snapshots (from workers) into a registry."""
+    metrics = metrics if metrics is not None else _METRICS
+    for path in paths:
+        with smart_open.open(path) as f:
+            metrics.merge(json.load(f))
+    return metrics
+
+
+def merge_dir(directory: str, metrics: Optional[Metrics] = None) -> Metrics:
+    return merge_files(
+        sorted(glob.glob(os.path.join(directory, "*.json"))), metrics=metrics
+    )
+
+
+def write_summary(path: Optional[str] = None, metrics: Optional[Metrics] = None):
+    """Log the stage report and, if `path` is given, write it there as json."""
+    metrics = metrics if metrics is not None else _METRICS
+    summary = metrics.summary()
+    logger = get_logger()
+    logger.info("Pipeline metrics: %s", json.dumps(summary["stages"]))
+    if path is not None:
+        if dirname := os.path.dirname(path):
+            os.makedirs(dirname, exist_ok=True)
+        with smart_open.open(path, "w") as wf:
+            json.dump(summary, wf, indent=2)
+        logger.info("Wrote metrics summary to %s", path)
+    return summary
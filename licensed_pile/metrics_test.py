@@ -0,0 +1,78 @@
+"""Tests for the metrics registry."""
+
+import json
+import os
+
+import pytest
+
+from licensed_pile import metrics
+
+
+def test_timer_context_manager_and_decorator():
+    registry = metrics.Metrics()
+
+    with registry.timer("stage"):
+        pass
+
+    @registry.timer("stage")
+    def f():
+        return 1
+
+    assert f() == 1
+    assert registry.timers["stage"].count == 2
+    assert registry.timers["stage"].total >= 0
+
+
+def test_default_timer_records_into_current_registry():
+    @metrics.timer("test/decorated")
+    def f():
+        pass
+
+    metrics.reset()
+    f()
+    assert metrics.get_metrics().timers["test/decorated"].count == 1
+    metrics.reset()
+
+
+def test_merge_snapshots():
+    parent = metrics.Metrics()
+    parent.increment("docs", 2)
+    parent.observe("size", 10)
+    parent.record_time("stage", 1.0)
+
+    worker = metrics.Metrics()
+    worker.increment("docs", 3)
+    worker.observe("size", 2)
+    worker.observe("size", 30)
+    worker.record_time("stage", 3.0)
+
+    # Round trip through json like a worker writing to disk would.
+    parent.merge(json.loads(json.dumps(worker.snapshot())))
+    assert parent.counters["docs"] == 5
+    assert parent.histograms["size"].count == 3
+    assert parent.histograms["size"].min == 2
+    assert parent.histograms["size"].max == 30
+    assert parent.timers["stage"].total == pytest.approx(4.0)
+
+
+def test_summary_throughput(tmp_path):
+    registry = metrics.Metrics()
+    registry.record_time("stage", 2.0)
+    registry.increment("stage", 10)
+    registry.record_time("other", 1.0)
+
+    path = os.path.join(tmp_path, "metrics.json")
+    metrics.write_summary(path, metrics=registry)
+    with open(path) as f:
+        summary = json.load(f)
+    assert summary["stages"]["stage"]["items_per_second"] == pytest.approx(5.0)
+    assert "items" not in summary["stages"]["other"]
+
+
+def test_merge_dir(tmp_path):
+    for i in range(3):
+        worker = metrics.Metrics()
+        worker.increment("docs", i)
+        metrics.dump(os.path.join(tmp_path, f"{i}.json"), metrics=worker)
+    registry = metrics.merge_dir(tmp_path, metrics=metrics.Metrics())
+    assert registry.counters["docs"] == 3
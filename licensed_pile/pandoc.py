@@ -0,0 +1,200 @@
+"""Convert many documents with a single long running pandoc process.
+
+Running `pandoc` once per document pays for starting the process (and
+loading its readers and writers) every time, which is often slower than the
+conversion itself. `Pandoc` starts `pandoc lua` once with a small script that
+reads documents from stdin, converts each one with `pandoc.read` and
+`pandoc.write` (the same readers and writers the command line uses), and
+writes the results back to stdout.
+
+Documents are sent one at a time, each one prefixed with its length, so they
+are converted on their own exactly like separate `pandoc` calls. A document
+that fails to convert raises `PandocError` but leaves the process running
+for the next ones.
+
+Older versions of pandoc (before 3.0) don't have `pandoc lua`, for those we
+fall back to running pandoc once per document.
+"""
+
+import functools
+import os
+import shutil
+import subprocess
+from typing import Optional
+
+from licensed_pile.logs import get_logger
+
+# Reads "<size>\n<document>" and writes "ok <size>\n<text>" or
+# "error <size>\n<message>".
+_SCRIPT = """
+local from = os.getenv("LICENSED_PILE_PANDOC_FROM")
+local to = os.getenv("LICENSED_PILE_PANDOC_TO")
+local options = {
+  wrap_text = os.getenv("LICENSED_PILE_PANDOC_WRAP"),
+  columns = tonumber(os.getenv("LICENSED_PILE_PANDOC_COLUMNS")),
+}
+while true do
+  local size = io.read("l")
+  if size == nil then
+    break
+  end
+  size = tonumber(size)
+  -- io.read(0) waits for more input to check for the end of the file.
+  local text = size > 0 and io.read(size) or ""
+  local ok, result = pcall(function()
+    return pandoc.write(pandoc.read(text, from), to, options)
+  end)
+  if not ok then
+    result = tostring(result)
+  elseif result:sub(-1) ~= "\\n" then
+    -- The command line ends documents that aren't standalone with a newline.
+    result = result .. "\\n"
+  end
+  io.write(ok and "ok " or "error ", #result, "\\n", result)
+  io.stdout:flush()
+end
+"""
+
+
+class PandocError(Exception):
+    """Pandoc failed to convert a document."""
+
+
+def pandoc_path() -> str:
+    """Find pandoc, either installed or the copy bundled with pypandoc."""
+    if path := shutil.which("pandoc"):
+        return path
+    try:
+        import pypandoc
+
+        return pypandoc.get_pandoc_path()
+    except (ImportError, OSError):
+        raise FileNotFoundError("pandoc is not installed.")
+
+
+class Pandoc:
+    """A pandoc process that converts documents from `from_format` to `to_format`.
+
+    The options match the command line flags, `wrap` is `--wrap` and `columns`
+    is `--columns`.
+
+    Example usage:
+    ```python
+    with Pandoc("html", "plain") as pandoc:
+        for html in documents:
+            print(pandoc.convert(html))
+    ```
+    """
+
+    def __init__(
+        self,
+        from_format: str,
+        to_format: str,
+        wrap: str = "auto",
+        columns: int = 72,
+        path: Optional[str] = None,
+    ):
+        self.from_format = from_format
+        self.to_format = to_format
+        self.wrap = wrap
+        self.columns = columns
+        self.path = path or pandoc_path()
+        self.process = None
+        self.persistent = self._has_lua()
+        if not self.persistent:
+            get_logger().warning(
+                f"{self.path} doesn't support `pandoc lua`, running pandoc once per document."
+            )
+
+    @functools.cached_property
+    def version(self) -> str:
+        """The pandoc version and options, conversions only change when this does."""
+        result = subprocess.run([self.path, "--version"], capture_output=True)
+        version = result.stdout.decode("utf-8").split("\n")[0]
+        return f"{version} {self.from_format}->{self.to_format} wrap={self.wrap} columns={self.columns}"
+
+    def _has_lua(self) -> bool:
+        try:
+            result = subprocess.run(
+                [self.path, "lua", "-e", "io.write('ok')"],
+                capture_output=True,
+                timeout=60,
+            )
+        except (OSError, subprocess.TimeoutExpired):
+            return False
+        return result.stdout == b"ok"
+
+    def _start(self):
+        env = {
+            **os.environ,
+            "LICENSED_PILE_PANDOC_FROM": self.from_format,
+            "LICENSED_PILE_PANDOC_TO": self.to_format,
+            "LICENSED_PILE_PANDOC_WRAP": self.wrap,
+            "LICENSED_PILE_PANDOC_COLUMNS": str(self.columns),
+        }
+        self.process = subprocess.Popen(
+            [self.path, "lua", "-e", _SCRIPT],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env=env,
+        )
+
+    def _convert_once(self, text: str) -> str:
+        result = subprocess.run(
+            [
+                self.path,
+                "--quiet",
+                "--from",
+                self.from_format,
+                "--to",
+                self.to_format,
+                f"--wrap={self.wrap}",
+                f"--columns={self.columns}",
+            ],
+            input=text.encode("utf-8"),
+            capture_output=True,
+        )
+        if result.returncode != 0:
+            raise PandocError(result.stderr.decode("utf-8", errors="replace"))
+        return result.stdout.decode("utf-8")
+
+    def convert(self, text: str) -> str:
+        if not self.persistent:
+            return self._convert_once(text)
+        if self.process is None or self.process.poll() is not None:
+            self._start()
+        data = text.encode("utf-8")
+        try:
+            self.process.stdin.write(b"%d\n" % len(data))
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+            header = self.process.stdout.readline()
+        except BrokenPipeError:
+            header = b""
+        if not header:
+            # Restart on the next document.
+            self.close()
+            raise PandocError("pandoc exited while converting a document.")
+        status, size = header.split()
+        result = self.process.stdout.read(int(size)).decode("utf-8")
+        if status != b"ok":
+            raise PandocError(result)
+        return result
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except (BrokenPipeError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,59 @@
+"""Tests for converting documents with a long running pandoc process."""
+
+import subprocess
+
+import pytest
+
+from licensed_pile.pandoc import Pandoc, PandocError, pandoc_path
+
+
+@pytest.fixture(scope="module")
+def path():
+    try:
+        return pandoc_path()
+    except FileNotFoundError:
+        pytest.skip("pandoc isn't installed")
+
+
+DOCUMENTS = [
+    "<p>a <i>b</i></p>",
+    "",
+    "<!-- nothing -->",
+    "<h1>Title</h1><p>µm 温度 " + "long " * 30 + "</p>",
+    "<table><tr><td>a</td><td>b</td></tr></table>",
+]
+
+
+@pytest.mark.parametrize("wrap", ["auto", "none"])
+def test_matches_command_line(path, wrap):
+    with Pandoc("html", "markdown", wrap=wrap, path=path) as pandoc:
+        for html in DOCUMENTS:
+            expected = subprocess.run(
+                [
+                    path,
+                    "--quiet",
+                    "--from",
+                    "html",
+                    "--to",
+                    "markdown",
+                    f"--wrap={wrap}",
+                ],
+                input=html.encode("utf-8"),
+                capture_output=True,
+                check=True,
+            ).stdout.decode("utf-8")
+            assert pandoc.convert(html) == expected
+
+
+def test_errors_dont_stop_the_process(path):
+    with Pandoc("not-a-format", "plain", path=path) as pandoc:
+        with pytest.raises(PandocError):
+            pandoc.convert("a")
+        with pytest.raises(PandocError):
+            pandoc.convert("b")
+    with Pandoc("html", "plain", path=path) as pandoc:
+        assert pandoc.convert("<p>a</p>") == "a\n"
+        # A process that died is restarted for the next document.
+        pandoc.process.kill()
+        pandoc.process.wait()
+        assert pandoc.convert("<p>b</p>") == "b\n"
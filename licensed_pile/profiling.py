@@ -0,0 +1,212 @@
+"""Profile pipeline runs across all of their worker processes.
+
+Each process profiles itself and dumps its results into a shared directory, the
+parent then merges them into a single report. There are two profilers:
+
+  * `sample`: A sampling profiler that looks at the stack of every thread
+    every few milliseconds of cpu time. Its report is a `.folded` file of
+    collapsed stacks that can be rendered by flamegraph.pl, speedscope, or
+    inferno.
+  * `cprofile`: The deterministic profiler from the standard library. Its
+    report is a merged `.prof` file (for snakeviz, flameprof, etc.) and a `.txt`
+    file of the hottest functions. It only sees the thread it was started in.
+
+The sampling profiler has much lower overhead so it is the default.
+"""
+
+import collections
+import contextlib
+import cProfile
+import glob
+import os
+import pstats
+import signal
+import sys
+import threading
+import uuid
+from multiprocessing import util as mp_util
+from tempfile import TemporaryDirectory
+from typing import Any, Dict, Optional
+
+from licensed_pile.logs import get_logger
+
+PROFILERS = ("sample", "cprofile")
+
+
+class SamplingProfiler:
+    """Count the stacks seen each time the process has used `interval` seconds of cpu."""
+
+    extension = ".folded"
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._previous_handler = None
+
+    def _sample(self, signum, frame):
+        # The signal is handled by the main thread, the stacks of any other
+        # threads (like a thread pool's workers) are sampled too.
+        main = threading.main_thread().ident
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        frames = sys._current_frames()
+        # Start the main thread's stack below this handler.
+        frames[main] = frame
+        for ident, frame in frames.items():
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                )
+                frame = frame.f_back
+            if ident != main:
+                stack.append(names.get(ident, "thread"))
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+
+    def dump(self, path: str):
+        with open(path, "w") as wf:
+            for stack, count in self.stacks.items():
+                wf.write(f"{stack} {count}\n")
+
+
+class CProfiler:
+    extension = ".prof"
+
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+
+    def start(self):
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+
+    def dump(self, path: str):
+        self.profiler.dump_stats(path)
+
+
+def get_profiler(mode: str):
+    if mode == "sample":
+        return SamplingProfiler()
+    if mode == "cprofile":
+        return CProfiler()
+    raise ValueError(f"Unknown profiler {mode}, expected one of {PROFILERS}")
+
+
+def _dump(profiler, profile_dir: str):
+    profiler.dump(
+        os.path.join(
+            profile_dir, f"{os.getpid()}-{uuid.uuid4().hex}{profiler.extension}"
+        )
+    )
+
+
+@contextlib.contextmanager
+def profile(mode: Optional[str], profile_dir: str):
+    """Profile the code in the context, results are dumped into `profile_dir`.
+
+    When `mode` is None this is a no-op so callers don't need to branch.
+    """
+    if mode is None:
+        yield
+        return
+    profiler = get_profiler(mode)
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        _dump(profiler, profile_dir)
+
+
+def worker_initializer(mode: str, profile_dir: str):
+    """Use as the `initializer` of a `multiprocessing.Pool` to profile each worker.
+
+    Pools terminate their workers with SIGTERM when used as a context manager,
+    so results are dumped from a SIGTERM handler as well as when the worker
+    exits normally.
+    """
+    profiler = get_profiler(mode)
+    dumped = False
+
+    def _finalize():
+        nonlocal dumped
+        if not dumped:
+            dumped = True
+            profiler.stop()
+            _dump(profiler, profile_dir)
+
+    def _on_sigterm(signum, frame):
+        _finalize()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, _on_sigterm)
+    mp_util.Finalize(None, _finalize, exitpriority=100)
+    profiler.start()
+
+
+def pool_kwargs(mode: Optional[str], profile_dir: str) -> Dict[str, Any]:
+    """Keyword arguments for `multiprocessing.Pool` that profile each of its workers."""
+    if mode is None:
+        return {}
+    return {"initializer": worker_initializer, "initargs": (mode, profile_dir)}
+
+
+@contextlib.contextmanager
+def profile_run(mode: Optional[str], output_prefix: str):
+    """Profile the current process, yielding the directory workers should dump to.
+
+    Pools that profile their workers (see `pool_kwargs`) need to be closed
+    inside this context so their profiles are included in the merged report
+    written to `output_prefix` when it exits.
+    """
+    with TemporaryDirectory() as profile_dir:
+        with profile(mode, profile_dir):
+            yield profile_dir
+        if mode is not None:
+            merge(profile_dir, output_prefix)
+
+
+def merge(profile_dir: str, output_prefix: str) -> Optional[str]:
+    """Merge the profiles from each process into one report at `output_prefix`.*"""
+    logger = get_logger()
+    if dirname := os.path.dirname(output_prefix):
+        os.makedirs(dirname, exist_ok=True)
+
+    if folded := sorted(glob.glob(os.path.join(profile_dir, "*.folded"))):
+        stacks = collections.Counter()
+        for path in folded:
+            with open(path) as f:
+                for line in f:
+                    stack, _, count = line.rstrip("\n").rpartition(" ")
+                    stacks[stack] += int(count)
+        output = f"{output_prefix}.folded"
+        with open(output, "w") as wf:
+            for stack, count in stacks.most_common():
+                wf.write(f"{stack} {count}\n")
+        logger.info(
+            "Merged %d sampled profiles into %s, render it with flamegraph.pl or speedscope.",
+            len(folded),
+            output,
+        )
+        return output
+
+    if profiles := sorted(glob.glob(os.path.join(profile_dir, "*.prof"))):
+        stats = pstats.Stats(*profiles)
+        output = f"{output_prefix}.prof"
+        stats.dump_stats(output)
+        with open(f"{output_prefix}.txt", "w") as wf:
+            pstats.Stats(output, stream=wf).sort_stats("cumulative").print_stats(100)
+        logger.info("Merged %d cProfile profiles into %s", len(profiles), output)
+        return output
+
+    logger.warning("No profiles found in %s", profile_dir)
+    return None
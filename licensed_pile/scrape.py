@@ -6,6 +6,8 @@ from typing import Dict, Optional
 import requests
 from tenacity import retry, stop_after_attempt, wait_random_exponential
 
+from licensed_pile import metrics
+
 # A user agent that says we are compatible with most websites (most browsers
 # start with Mozilla/5.0) and also tells that we are a bot and includes a link
 # for context on why we are scraping. We hope this fosters good will with site
@@ -26,11 +28,16 @@ def get_page(
     headers = headers if headers is not None else {}
     # Unpack the defaults first so the user provided ones can override them.
     headers = {**DEFAULT_HEADERS, **headers}
-    resp = requests.get(url, params=params, headers=headers)
+    # Timed per attempt, retries show up as extra calls.
+    with metrics.timer("scrape/get_page"):
+        resp = requests.get(url, params=params, headers=headers)
     logging.debug(f"Sending GET to {resp.url}")
     if resp.status_code != 200:
+        metrics.increment("scrape/failures")
         logging.warning(
             f"Failed request to {resp.url}: {resp.status_code}, {resp.reason}"
         )
         raise RuntimeError(f"Failed request to {resp.url}")
+    metrics.increment("scrape/get_page")
+    metrics.increment("scrape/bytes", len(resp.content))
     return resp
@@ -0,0 +1,229 @@
+"""Lookup tables that map a key to a list of values.
+
+Building documents from dumps like Stack Exchange means collecting things like
+the authors or comments for each post from several files before we can join
+them. These stores support appending to a key without reading and rewriting
+the values already stored under it.
+
+  * `MemoryStore`: A dict of lists, fast but everything lives in memory.
+  * `SQLiteStore`: Values are pickled into an sqlite table on disk. Writes are
+    buffered and committed in batches, reads see everything written so far.
+"""
+
+import abc
+import collections
+import itertools
+import operator as op
+import os
+import pickle
+import sqlite3
+from typing import Any, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+
+STORES = ("memory", "sqlite")
+
+
+class Store(metaclass=abc.ABCMeta):
+    """A key -> list of values lookup that values can be appended to."""
+
+    @abc.abstractmethod
+    def extend(self, key: Hashable, values: Iterable[Any]):
+        """Add `values` to the end of the list stored under `key`.
+
+        Note: The key is added to the store even if `values` is empty.
+        """
+
+    def append(self, key: Hashable, value: Any):
+        """Add `value` to the end of the list stored under `key`."""
+        self.extend(key, (value,))
+
+    @abc.abstractmethod
+    def get(self, key: Hashable, default: Optional[List] = None) -> Optional[List]:
+        """All values appended to `key`, in the order they were added."""
+
+    @abc.abstractmethod
+    def items(self) -> Iterator[Tuple[Hashable, List]]:
+        """Iterate over each key and all of its values."""
+
+    @abc.abstractmethod
+    def __contains__(self, key: Hashable) -> bool:
+        """Have any values been added for `key`?"""
+
+    @abc.abstractmethod
+    def __len__(self) -> int:
+        """The number of keys in the store."""
+
+    def __getitem__(self, key: Hashable) -> List:
+        if (values := self.get(key)) is None:
+            raise KeyError(key)
+        return values
+
+    def keys(self) -> Iterator[Hashable]:
+        return map(op.itemgetter(0), self.items())
+
+    def flush(self):
+        """Make sure all writes have been saved."""
+
+    def prepare_read(self):
+        """Save all writes and get ready for reads, including from other processes.
+
+        Reads do this automatically, but stores opened read-only in other
+        processes (like pool workers) rely on the writer having done it.
+        """
+        self.flush()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class MemoryStore(Store):
+    """A store that keeps everything in a dict of lists."""
+
+    def __init__(self):
+        self._data: Dict[Hashable, List] = collections.defaultdict(list)
+
+    def extend(self, key, values):
+        self._data[key].extend(values)
+
+    def get(self, key, default=None):
+        # Don't use the defaultdict lookup so reads don't add keys.
+        return self._data.get(key, default)
+
+    def items(self):
+        return iter(self._data.items())
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteStore(Store):
+    """A store backed by an sqlite database on disk.
+
+    Each value is its own row, so appending is just an insert. A row with a
+    NULL value marks a key that was extended with no values. Inserts are
+    buffered in memory until there are `buffer_size` of them and then written
+    in a single transaction. The index on the key is only created on the
+    first read, as building it once after a bulk load is much faster than
+    updating it on every insert.
+
+    Note: The database is a scratch space that can be rebuilt from the dump,
+      so we turn off journaling and syncing. A crash while writing can leave
+      it corrupted.
+
+    Args:
+      path: Where the database is saved.
+      flag: "n" to always start with an empty store, "c" to add to an existing
+        one, or "r" to open an existing store read-only (for example, in
+        worker processes).
+      buffer_size: How many values to hold in memory before writing them.
+    """
+
+    def __init__(self, path: str, flag: str = "n", buffer_size: int = 10_000):
+        if flag not in ("n", "c", "r"):
+            raise ValueError(f"flag must be one of 'n', 'c', or 'r', got {flag}")
+        self.path = path
+        self.buffer_size = buffer_size
+        self.readonly = flag == "r"
+        if flag == "n" and os.path.exists(path):
+            os.remove(path)
+        if self.readonly:
+            self._db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        else:
+            self._db = sqlite3.connect(path)
+            self._db.execute("PRAGMA journal_mode=OFF")
+            self._db.execute("PRAGMA synchronous=OFF")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS store (key NOT NULL, value BLOB)"
+            )
+            self._db.commit()
+        self._buffer: List[Tuple[Hashable, Optional[bytes]]] = []
+        self._indexed = False
+
+    def extend(self, key, values):
+        if self.readonly:
+            raise ValueError(f"Store at {self.path} was opened read-only.")
+        start = len(self._buffer)
+        self._buffer.extend(
+            (key, pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL)) for v in values
+        )
+        if len(self._buffer) == start:
+            self._buffer.append((key, None))
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        with self._db:
+            self._db.executemany(
+                "INSERT INTO store (key, value) VALUES (?, ?)", self._buffer
+            )
+        self._buffer = []
+
+    def prepare_read(self):
+        self.flush()
+        if not self._indexed and not self.readonly:
+            with self._db:
+                self._db.execute("CREATE INDEX IF NOT EXISTS store_key ON store (key)")
+        self._indexed = True
+
+    def get(self, key, default=None):
+        self.prepare_read()
+        rows = self._db.execute(
+            "SELECT value FROM store WHERE key = ? ORDER BY rowid", (key,)
+        ).fetchall()
+        if not rows:
+            return default
+        return [pickle.loads(value) for value, in rows if value is not None]
+
+    def items(self):
+        self.prepare_read()
+        # Use a separate cursor so reads can be interleaved with other lookups.
+        rows = self._db.cursor().execute(
+            "SELECT key, value FROM store ORDER BY key, rowid"
+        )
+        for key, group in itertools.groupby(rows, key=op.itemgetter(0)):
+            yield key, [pickle.loads(v) for _, v in group if v is not None]
+
+    def keys(self):
+        self.prepare_read()
+        rows = self._db.cursor().execute("SELECT DISTINCT key FROM store ORDER BY key")
+        return map(op.itemgetter(0), rows)
+
+    def __contains__(self, key):
+        self.prepare_read()
+        return (
+            self._db.execute(
+                "SELECT 1 FROM store WHERE key = ? LIMIT 1", (key,)
+            ).fetchone()
+            is not None
+        )
+
+    def __len__(self):
+        self.prepare_read()
+        return self._db.execute("SELECT COUNT(DISTINCT key) FROM store").fetchone()[0]
+
+    def close(self):
+        if not self.readonly:
+            self.flush()
+        self._db.close()
+
+
+def open_store(kind: str, path: Optional[str] = None, **kwargs) -> Store:
+    """Create a store of type `kind` (one of `STORES`), saved at `path` when on disk."""
+    if kind == "memory":
+        return MemoryStore()
+    if kind == "sqlite":
+        if path is None:
+            raise ValueError("An sqlite store needs a path.")
+        return SQLiteStore(path, **kwargs)
+    raise ValueError(f"Unknown store {kind}, expected one of {STORES}")
@@ -0,0 +1,89 @@
+"""Tests for the multi-value lookup stores."""
+
+import os
+
+import pytest
+
+from licensed_pile import store
+
+
+@pytest.fixture(params=store.STORES)
+def kv(request, tmp_path):
+    with store.open_store(
+        request.param, os.path.join(tmp_path, "store.sqlite"), buffer_size=3
+    ) as s:
+        yield s
+
+
+def test_append_keeps_order(kv):
+    for i in range(10):
+        kv.append("a", i)
+        kv.append("b", -i)
+    assert kv.get("a") == list(range(10))
+    assert kv["b"] == [-i for i in range(10)]
+
+
+def test_missing_key(kv):
+    kv.append("a", 1)
+    assert "b" not in kv
+    assert kv.get("b") is None
+    assert kv.get("b", []) == []
+    with pytest.raises(KeyError):
+        kv["b"]
+    assert len(kv) == 1
+
+
+def test_items_groups_values(kv):
+    kv.extend("x", [{"name": "x"}, {"name": "y"}])
+    kv.append("y", ("tuple", 1))
+    kv.append("x", {"name": "z"})
+    assert dict(kv.items()) == {
+        "x": [{"name": "x"}, {"name": "y"}, {"name": "z"}],
+        "y": [("tuple", 1)],
+    }
+    assert sorted(kv.keys()) == ["x", "y"]
+
+
+def test_extend_empty_adds_key(kv):
+    kv.extend("a", [])
+    assert "a" in kv
+    assert kv.get("a") == []
+    kv.append("a", 1)
+    assert dict(kv.items()) == {"a": [1]}
+
+
+def test_writes_after_reads(kv):
+    kv.append("a", 1)
+    assert kv.get("a") == [1]
+    kv.append("a", 2)
+    assert kv.get("a") == [1, 2]
+
+
+def test_sqlite_reopen(tmp_path):
+    path = os.path.join(tmp_path, "store.sqlite")
+    with store.SQLiteStore(path) as s:
+        s.extend("a", [1, 2, 3])
+    with store.SQLiteStore(path, flag="r") as s:
+        assert s.get("a") == [1, 2, 3]
+        with pytest.raises(ValueError):
+            s.append("a", 4)
+    with store.SQLiteStore(path, flag="c") as s:
+        s.append("a", 4)
+        assert s.get("a") == [1, 2, 3, 4]
+    with store.SQLiteStore(path, flag="n") as s:
+        assert "a" not in s
+
+
+def test_sqlite_readers_in_other_connections(tmp_path):
+    path = os.path.join(tmp_path, "store.sqlite")
+    writer = store.SQLiteStore(path)
+    writer.extend("a", [1, 2])
+    writer.prepare_read()
+    # The writer is still open, readers see what was written and use its index.
+    with store.SQLiteStore(path, flag="r") as reader:
+        assert reader.get("a") == [1, 2]
+        plan = reader._db.execute(
+            "EXPLAIN QUERY PLAN SELECT value FROM store WHERE key = ?", ("a",)
+        ).fetchall()
+        assert "store_key" in str(plan)
+    writer.close()
@@ -2,17 +2,24 @@
 
 import abc
 import copy
+import gzip
 import json
 import multiprocessing as mp
 import os
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack
 from queue import Queue
-from typing import Dict, Iterator
+from tempfile import TemporaryDirectory
+from typing import Dict, Iterator, Optional
 
 import smart_open
 import tqdm
 from dolma.core.parallel import BaseParallelProcessor
 
+from licensed_pile import memory, metrics, profiling
 from licensed_pile.logs import configure_logging, get_logger
 
 
@@ -28,11 +35,41 @@ def to_dolma(
     filename: str,
     shard_size: int = 1,
     quiet: bool = False,
+    metrics_path: Optional[str] = None,
+    prefetch: int = 0,
+    memory_limit: Optional[int] = None,
 ):
-    """Write `examples` to `path` in the dolma format with `shard_size`GB shards."""
+    """Write `examples` to `path` in the dolma format with `shard_size`GB shards.
+
+    Time spent waiting on `examples` (i.e. the upstream processing), serializing
+    to json, and writing/compressing are recorded in the metrics registry and
+    the summary is logged (and written to `metrics_path`) once all examples are
+    written.
+
+    When `prefetch` or `memory_limit` (in bytes) is set, `examples` are produced
+    in a background thread at most `prefetch` examples ahead of the writer, and
+    production pauses while the memory usage of this process (and its children)
+    is over `memory_limit`. The peak memory usage is logged at the end.
+    """
     logger = get_logger()
     logger.info("Writing Dolma Shards to %s", path)
     os.makedirs(path, exist_ok=True)
+    with ExitStack() as stack:
+        if prefetch or memory_limit:
+            watchdog = stack.enter_context(memory.RSSWatchdog(limit=memory_limit))
+            stack.enter_context(watchdog.stage("to_dolma"))
+            examples = memory.bounded_prefetch(
+                examples, prefetch or 1000, watchdog=watchdog
+            )
+        _write_shards(examples, path, filename, shard_size, quiet)
+    metrics.write_summary(metrics_path)
+
+
+def _write_shards(
+    examples: Iterator[Dict], path: str, filename: str, shard_size: int, quiet: bool
+):
+    logger = get_logger()
+    registry = metrics.get_metrics()
     shard_idx = 0
     size = 0
     # Gigabytes, not Gibibytes
@@ -41,8 +78,13 @@ def to_dolma(
         wf = stack.enter_context(
             smart_open.open(os.path.join(path, shard_name(filename, shard_idx)), "w")
         )
+        start = time.perf_counter()
         for example in tqdm.tqdm(examples, disable=quiet):
+            produced = time.perf_counter()
+            registry.record_time("to_dolma/upstream", produced - start)
             data = json.dumps(example)
+            serialized = time.perf_counter()
+            registry.record_time("to_dolma/serialize", serialized - produced)
             # Assume one character is about 1 bytes, good enough as we use utf-8
             size += len(data)
             if size >= max_bytes:
@@ -53,6 +95,84 @@ def to_dolma(
                 logger.info("Shard size exceeded, creating new shard at %s", shard_file)
                 size = 0
             wf.write(data + "\n")
+            start = time.perf_counter()
+            # Writing includes the compression done by smart_open.
+            registry.record_time("to_dolma/write", start - serialized)
+            registry.increment("to_dolma/write")
+            registry.increment("to_dolma/bytes", len(data) + 1)
+    registry.increment("to_dolma/shards", shard_idx + 1)
+
+
+def to_dolma_chunks(
+    chunks: Iterator[bytes],
+    path: str,
+    filename: str,
+    shard_size: int = 1,
+    threads: int = 4,
+    metrics_path: Optional[str] = None,
+):
+    """Write chunks of already serialized dolma examples to `shard_size`GB shards.
+
+    Each chunk is the utf-8 encoded json lines for some examples, for example
+    from a columnar library that can serialize a whole batch at once, so no
+    python objects are created per example. Shards are only split between
+    chunks, so a shard can be larger than `shard_size` by up to a chunk.
+
+    Compression, not serialization, is the slowest part of writing. When
+    `filename` ends with `.gz`, each chunk is compressed as its own gzip member
+    (a file of concatenated members is a valid gzip file) in one of `threads`
+    threads, zlib releases the GIL so they run in parallel.
+    """
+    logger = get_logger()
+    logger.info("Writing Dolma Shards to %s", path)
+    os.makedirs(path, exist_ok=True)
+    registry = metrics.get_metrics()
+    compress = gzip.compress if filename.endswith(".gz") else lambda data: data
+    shard_idx = 0
+    size = 0
+    max_bytes = shard_size * 1000 * 1000 * 1000
+    pending = deque()
+
+    def open_shard():
+        shard_file = os.path.join(path, shard_name(filename, shard_idx))
+        # We compress the chunks ourselves.
+        return smart_open.open(shard_file, "wb", compression="disable")
+
+    def write(wf, chunk):
+        examples, size, compressed = chunk
+        wf.write(compressed.result())
+        registry.increment("to_dolma/write", examples)
+        registry.increment("to_dolma/bytes", size)
+
+    with ExitStack() as stack:
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=threads))
+        wf = stack.enter_context(open_shard())
+        start = time.perf_counter()
+        for data in chunks:
+            produced = time.perf_counter()
+            registry.record_time("to_dolma/upstream", produced - start)
+            if size and size + len(data) > max_bytes:
+                while pending:
+                    write(wf, pending.popleft())
+                wf.close()
+                shard_idx += 1
+                wf = stack.enter_context(open_shard())
+                logger.info("Shard size exceeded, creating new shard.")
+                size = 0
+            size += len(data)
+            pending.append(
+                (data.count(b"\n"), len(data), executor.submit(compress, data))
+            )
+            # Bound the number of chunks in memory, the oldest is written first
+            # to keep the examples in order.
+            while len(pending) > 2 * threads:
+                write(wf, pending.popleft())
+            start = time.perf_counter()
+            registry.record_time("to_dolma/write", start - produced)
+        while pending:
+            write(wf, pending.popleft())
+    registry.increment("to_dolma/shards", shard_idx + 1)
+    metrics.write_summary(metrics_path)
 
 
 class ShardParallelProcessor(BaseParallelProcessor):
@@ -83,6 +203,34 @@ class ShardParallelProcessor(BaseParallelProcessor):
     ):
         logger = cls.get_logger()
         logger.debug("Processing %s into %s", source_path, destination_path)
+        # Where we save the metrics from this worker so the parent can aggregate them.
+        metrics_dir = kwargs.pop("metrics_dir", None)
+        profile = kwargs.pop("profile", None)
+        profile_dir = kwargs.pop("profile_dir", None)
+        registry = metrics.get_metrics()
+        try:
+            with profiling.profile(profile, profile_dir):
+                cls._process_shard(
+                    source_path, destination_path, queue, registry, **kwargs
+                )
+        finally:
+            registry.increment("shard/files")
+            if metrics_dir is not None:
+                metrics.dump(os.path.join(metrics_dir, f"{uuid.uuid4().hex}.json"))
+                # Reset so metrics from this shard aren't reported again when
+                # this worker dumps metrics for the next one.
+                registry.reset()
+
+    @classmethod
+    def _process_shard(
+        cls,
+        source_path: str,
+        destination_path: str,
+        queue: Queue,
+        registry: metrics.Metrics,
+        **kwargs,
+    ):
+        logger = cls.get_logger()
         with smart_open.open(source_path) as f, smart_open.open(
             destination_path, "w"
         ) as wf:
@@ -91,6 +239,7 @@ class ShardParallelProcessor(BaseParallelProcessor):
             debug = kwargs.pop("debug", False)
 
             try:
+                start = time.perf_counter()
                 for i, line in enumerate(f):
                     try:
                         data = json.loads(line)
@@ -102,12 +251,21 @@ class ShardParallelProcessor(BaseParallelProcessor):
                             line[:80],
                             e,
                         )
+                        registry.increment("shard/parse_failures")
+                        start = time.perf_counter()
                         continue
+                    # Reading includes decompression and json parsing.
+                    read = time.perf_counter()
+                    registry.record_time("shard/read", read - start)
+                    registry.increment("shard/read")
 
                     if debug:
                         og = copy.deepcopy(data["text"])
 
                     processed = cls.process_example(data, **kwargs)
+                    start = time.perf_counter()
+                    registry.record_time("shard/process", start - read)
+                    registry.increment("shard/process")
 
                     if processed is None:
                         logger.warning(
@@ -115,6 +273,7 @@ class ShardParallelProcessor(BaseParallelProcessor):
                             source_path,
                             i,
                         )
+                        registry.increment("shard/skipped")
                         continue
 
                     if debug and og == processed["text"]:
@@ -124,13 +283,50 @@ class ShardParallelProcessor(BaseParallelProcessor):
 
                     wf.write(json.dumps(processed) + "\n")
                     document_count += 1
+                    written = time.perf_counter()
+                    registry.record_time("shard/write", written - start)
+                    registry.increment("shard/write")
 
                     if document_count % update_interval == 0:
                         cls.increment_progressbar(queue, documents=document_count)
                         if queue.qsize() >= mp.cpu_count():
                             update_interval *= 2
                         document_count = 0
+                    start = time.perf_counter()
             except Exception as e:
                 logger.warning("Failed to process %s: %s", source_path, e)
+                registry.increment("shard/failures")
                 return
             cls.increment_progressbar(queue, shards=1, documents=document_count)
+
+    def __call__(
+        self,
+        metrics_path: Optional[str] = None,
+        profile: Optional[str] = None,
+        profile_path: Optional[str] = None,
+        **process_single_kwargs,
+    ):
+        """Run the processor, then aggregate and report the metrics from each worker.
+
+        Args:
+          metrics_path: Where to save the json metrics summary, it is always logged.
+          profile: Which profiler (from `profiling.PROFILERS`) to run in each
+            worker, None means no profiling.
+          profile_path: The prefix for the merged profile report, defaults to
+            `profile` next to the (first) destination directory.
+        """
+        with TemporaryDirectory() as metrics_dir, TemporaryDirectory() as profile_dir:
+            super().__call__(
+                metrics_dir=metrics_dir,
+                profile=profile,
+                profile_dir=profile_dir,
+                **process_single_kwargs,
+            )
+            metrics.merge_dir(metrics_dir)
+            if profile is not None:
+                if profile_path is None:
+                    profile_path = os.path.join(
+                        os.path.dirname(self.dst_prefixes[0].rstrip("/")), "profile"
+                    )
+                profiling.merge(profile_dir, profile_path)
+        metrics.write_summary(metrics_path)
@@ -0,0 +1,36 @@
+"""Tests for writing dolma shards."""
+
+import gzip
+import json
+import os
+
+import pytest
+
+from licensed_pile import metrics
+from licensed_pile.write import to_dolma_chunks
+
+
+def chunks(n, per_chunk):
+    for start in range(0, n, per_chunk):
+        yield "".join(
+            json.dumps({"id": str(i), "text": "é" * i}) + "\n"
+            for i in range(start, min(n, start + per_chunk))
+        ).encode("utf-8")
+
+
+@pytest.mark.parametrize("filename", ["test.jsonl.gz", "test.jsonl"])
+def test_to_dolma_chunks_keeps_order_across_shards(tmp_path, filename):
+    metrics.reset()
+    # A tiny shard size, so each shard holds about two chunks.
+    to_dolma_chunks(chunks(100, 7), str(tmp_path), filename, shard_size=2e-6, threads=3)
+    shards = sorted(os.listdir(tmp_path))
+    assert len(shards) > 1
+    examples = []
+    for shard in shards:
+        open_ = gzip.open if filename.endswith(".gz") else open
+        with open_(tmp_path / shard, "rt", encoding="utf-8") as f:
+            examples.extend(json.loads(line) for line in f)
+    assert [e["id"] for e in examples] == [str(i) for i in range(100)]
+    assert examples[10]["text"] == "é" * 10
+    assert metrics.get_metrics().counters["to_dolma/write"] == 100
+    assert metrics.get_metrics().counters["to_dolma/shards"] == len(shards)
@@ -1,7 +1,13 @@
 """Tools to help with xml parsing."""
 
+import functools
+import os
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
 from xml.etree import ElementTree as ET
 
+from licensed_pile import metrics
+
 
 def iterate_xml(path: str, tag: str):
     """Iterable version of xml parsing, lets us not load the whole thing at once.
@@ -12,11 +18,122 @@ def iterate_xml(path: str, tag: str):
 
     See https://web.archive.org/web/20201111201837/http://effbot.org/zone/element-iterparse.htm
     for more details on what it is doing.
+
+    The time spent parsing (not including the time the consumer spends on each
+    element) and the number of elements are recorded as the `iterate_xml` stage.
+    """
+    parse_time = 0
+    elements = 0
+    start = time.perf_counter()
+    try:
+        context = ET.iterparse(path, events=("start", "end"))
+        context = iter(context)
+        event, root = next(context)
+        for event, elem in context:
+            if event == "end" and elem.tag == tag:
+                parse_time += time.perf_counter() - start
+                elements += 1
+                yield elem
+                root.clear()
+                start = time.perf_counter()
+    finally:
+        metrics.record_time("iterate_xml", parse_time)
+        metrics.increment("iterate_xml", elements)
+
+
+def iterate_attributes(path: str, tag: str, keys: Sequence[str]) -> Iterator[Dict]:
+    """Iterate over just the `keys` attributes of each `tag` element.
+
+    Elements carry all of their attributes (and children) with them, when they
+    are sent to other processes only sending the values that are actually used
+    is much cheaper. Missing attributes are left out of the dict.
+    """
+    for elem in iterate_xml(path, tag):
+        attrib = elem.attrib
+        yield {k: attrib[k] for k in keys if k in attrib}
+
+
+def line_ranges(
+    path: str, chunk_bytes: int = 64 * 1024 * 1024
+) -> List[Tuple[int, int]]:
+    """Split a file into [start, end) byte ranges of about `chunk_bytes` that end on a newline."""
+    size = os.path.getsize(path)
+    ranges = []
+    start = 0
+    with open(path, "rb") as f:
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            # Move the end to the start of the next line.
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def iterate_xml_lines(
+    path: str,
+    tag: str,
+    start: int = 0,
+    end: Optional[int] = None,
+    block_bytes: int = 1024 * 1024,
+):
+    """Parse the `tag` elements in a byte range of a file with one element per line.
+
+    Dumps like Stack Exchange's write each row on its own line (newlines in
+    attribute values are escaped) so each line can be parsed on its own and
+    different processes can parse different parts of the file. Lines that
+    don't start with `tag`, like the xml declaration or the root element, are
+    skipped. The kept lines are fed to the parser in blocks of about
+    `block_bytes` as that is much faster than parsing each line separately.
     """
-    context = ET.iterparse(path, events=("start", "end"))
-    context = iter(context)
-    event, root = next(context)
-    for event, elem in context:
-        if event == "end" and elem.tag == tag:
-            yield elem
+    prefix = f"<{tag}".encode("utf-8")
+    parser = ET.XMLPullParser(events=("start", "end"))
+    # Wrap the lines in a root element so they can be parsed as a single document.
+    parser.feed(b"<root>")
+    ((_, root),) = parser.read_events()
+    with open(path, "rb") as f:
+        f.seek(start)
+        position = start
+        while end is None or position < end:
+            size = block_bytes if end is None else min(block_bytes, end - position)
+            if not (block := f.read(size)):
+                break
+            # Finish the last line of the block, ranges always end on a newline.
+            if not block.endswith(b"\n"):
+                block += f.readline()
+            position += len(block)
+            parser.feed(
+                b"".join(
+                    line
+                    for line in block.splitlines(keepends=True)
+                    if line.lstrip().startswith(prefix)
+                )
+            )
+            for event, elem in parser.read_events():
+                if event == "end" and elem.tag == tag:
+                    yield elem
             root.clear()
+
+
+def _map_range(func: Callable, path: str, tag: str, byte_range: Tuple[int, int]):
+    return [func(elem) for elem in iterate_xml_lines(path, tag, *byte_range)]
+
+
+def map_xml_lines(
+    pool,
+    func: Callable,
+    path: str,
+    tag: str,
+    chunk_bytes: int = 64 * 1024 * 1024,
+) -> Iterator:
+    """Apply `func` to each `tag` element of a one element per line file with `pool`.
+
+    Each worker reads and parses its own byte range of the file so only the
+    outputs of `func` are sent between processes. Outputs are unordered.
+    """
+    for results in pool.imap_unordered(
+        functools.partial(_map_range, func, path, tag),
+        line_ranges(path, chunk_bytes),
+    ):
+        yield from results
@@ -0,0 +1,44 @@
+"""Tests for xml parsing."""
+
+import os
+
+import pytest
+
+from licensed_pile import xml
+
+
+@pytest.fixture
+def rows(tmp_path):
+    path = os.path.join(tmp_path, "Posts.xml")
+    with open(path, "w") as wf:
+        wf.write('<?xml version="1.0" encoding="utf-8"?>\n<posts>\n')
+        for i in range(100):
+            wf.write(f'  <row Id="{i}" Body="line&#xA;{"x" * i} &amp; é" />\n')
+        wf.write("</posts>\n")
+    return path
+
+
+def test_iterate_attributes(rows):
+    attributes = list(xml.iterate_attributes(rows, "row", ("Id", "Missing")))
+    assert attributes == [{"Id": str(i)} for i in range(100)]
+
+
+@pytest.mark.parametrize("chunk_bytes", [1, 100, 1000, 10**9])
+def test_line_ranges_cover_the_file(rows, chunk_bytes):
+    ranges = xml.line_ranges(rows, chunk_bytes)
+    assert ranges[0][0] == 0
+    assert ranges[-1][1] == os.path.getsize(rows)
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start
+
+
+@pytest.mark.parametrize("chunk_bytes", [1, 100, 1000, 10**9])
+@pytest.mark.parametrize("block_bytes", [1, 64, 1024 * 1024])
+def test_iterate_xml_lines_matches_iterate_xml(rows, chunk_bytes, block_bytes):
+    expected = [dict(e.attrib) for e in xml.iterate_xml(rows, "row")]
+    parsed = [
+        dict(e.attrib)
+        for start, end in xml.line_ranges(rows, chunk_bytes)
+        for e in xml.iterate_xml_lines(rows, "row", start, end, block_bytes)
+    ]
+    assert parsed == expected
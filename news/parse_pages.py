@@ -2,6 +2,7 @@
 
 import argparse
 import functools
+import itertools
 import json
 import multiprocessing as mp
 import os
@@ -10,7 +11,7 @@ from datetime import datetime
 import utils
 from charset_normalizer import from_bytes
 
-from licensed_pile import licenses, logs
+from licensed_pile import licenses, logs, memory, profiling
 from licensed_pile.write import to_dolma
 
 parser = argparse.ArgumentParser(description="Parse pages downloaded from a News Sites")
@@ -43,6 +44,22 @@ parser.add_argument(
     default=mp.cpu_count(),
     help="Number of workers",
 )
+parser.add_argument(
+    "--prefetch",
+    type=int,
+    default=1000,
+    help="The max number of pages being parsed or waiting to be written at once.",
+)
+parser.add_argument(
+    "--memory_limit",
+    type=memory.parse_size,
+    help="Pause parsing when memory usage is over this limit, e.g. 8G.",
+)
+parser.add_argument(
+    "--profile",
+    choices=profiling.PROFILERS,
+    help="Profile the main process and each worker, the merged report is written to ${output_dir}/profile.*",
+)
 
 
 LICENSE_MAP = {
@@ -94,6 +111,13 @@ def parse_page(
         logger.warning(f"Article {url} exists in the index but is not downloaded.")
 
 
+def read_index(path: str):
+    with open(path) as f:
+        for l in f:
+            if line := l.strip():
+                yield json.loads(line)
+
+
 def main(args):
     logger = logs.get_logger("news")
     args.input_dir = (
@@ -101,12 +125,15 @@ def main(args):
         if args.input_dir is not None
         else os.path.dirname(args.index_path)
     )
-    with open(args.index_path) as f:
-        page_index = [json.loads(line) for l in f if (line := l.strip())]
-
-    if not page_index:
+    page_index = read_index(args.index_path)
+    # Peek at the first entry so we can error on empty indices without reading
+    # the whole thing into memory.
+    try:
+        first = next(page_index)
+    except StopIteration:
         logger.error(f"{args.index_path} is empty.")
         raise ValueError(f"{args.index_path} is empty.")
+    page_index = itertools.chain((first,), page_index)
 
     os.makedirs(args.output_dir, exist_ok=True)
     today = datetime.utcnow()
@@ -115,8 +142,15 @@ def main(args):
         args.filename if args.filename is not None else f"{args.source_name}.jsonl.gz"
     )
 
-    with mp.Pool(args.num_workers) as p:
-        page_data = p.imap(
+    with profiling.profile_run(
+        args.profile, os.path.join(args.output_dir, "profile")
+    ) as profile_dir, mp.Pool(
+        args.num_workers, **profiling.pool_kwargs(args.profile, profile_dir)
+    ) as p:
+        # Bounded so a slow writer stops the workers instead of the results
+        # piling up in memory.
+        page_data = memory.bounded_imap(
+            p,
             functools.partial(
                 parse_page,
                 input_dir=args.input_dir,
@@ -127,10 +161,19 @@ def main(args):
                 attrs=args.attrs,
             ),
             page_index,
+            max_in_flight=args.prefetch,
+            chunksize=16,
         )
         page_data = filter(lambda p: p is not None, page_data)
 
-        to_dolma(page_data, args.output_dir, args.filename, args.shard_size)
+        to_dolma(
+            page_data,
+            args.output_dir,
+            args.filename,
+            args.shard_size,
+            prefetch=args.prefetch,
+            memory_limit=args.memory_limit,
+        )
 
 
 if __name__ == "__main__":
@@ -5,7 +5,6 @@ import multiprocessing as mp
 import os
 import re
 import shutil
-import subprocess
 import tarfile
 import traceback
 import xml.etree.ElementTree as ET
@@ -13,6 +12,9 @@ import xml.etree.ElementTree as ET
 from tqdm import tqdm
 
 from licensed_pile import logs
+from licensed_pile.cache import ConversionCache
+from licensed_pile.memory import parse_size
+from licensed_pile.pandoc import Pandoc
 from licensed_pile.scrape import get_page
 
 parser = argparse.ArgumentParser(description="Convert xml documents to markdown.")
@@ -35,6 +37,16 @@ parser.add_argument(
     type=int,
     help="Number of processes to use for conversion.",
 )
+parser.add_argument(
+    "--cache",
+    help="Path to an sqlite cache of conversions, articles that were already converted aren't converted again.",
+)
+parser.add_argument(
+    "--cache_size",
+    type=parse_size,
+    default="20G",
+    help="The most (compressed) markdown to keep in the --cache, the least recently used articles are removed.",
+)
 
 
 def get_date_from_tree(tree):
@@ -158,6 +170,33 @@ def download(f_url: str, output_dir: str):
         logger.error(traceback.print_exc())
 
 
+# Each worker starts one pandoc process and reuses it for all of its documents,
+# instead of running pandoc once per article.
+_PANDOC = None
+
+
+def get_pandoc() -> Pandoc:
+    global _PANDOC
+    if _PANDOC is None:
+        _PANDOC = Pandoc("jats", "markdown", wrap="none")
+    return _PANDOC
+
+
+_CACHE = None
+
+
+def get_cache() -> ConversionCache:
+    global _CACHE
+    if _CACHE is None:
+        # The pool is terminated when it exits, so each conversion is written
+        # right away instead of buffered. Articles take much longer to convert
+        # than to write.
+        _CACHE = ConversionCache(
+            args.cache, get_pandoc().version, args.cache_size, buffer_size=1
+        )
+    return _CACHE
+
+
 def extract_and_convert_tarball(t: str, output_dir: str):
     if not os.path.exists(t):
         return
@@ -191,24 +230,18 @@ def extract_and_convert_tarball(t: str, output_dir: str):
 
         # convert nxml to markdown
         # pandoc options:
-        #   --quiet is to suppress messages
-        #   --from jats specifies the input format as Journal Article Tag Suite (https://jats.nlm.nih.gov/)
-        #   -o is the output file
-        #   --wrap=none is to prevent pandoc from wrapping lines
-        options = [
-            "pandoc",
-            "--quiet",
-            "--from",
-            "jats",
-            nxml,
-            "-o",
-            f"{pmcid}.md",
-            "--wrap=none",
-        ]
-        subprocess.run(options)
+        #   jats is the input format, Journal Article Tag Suite (https://jats.nlm.nih.gov/)
+        #   wrap="none" is to prevent pandoc from wrapping lines
+        with open(nxml, encoding="utf-8") as f:
+            text = f.read()
+        if args.cache:
+            markdown = get_cache().convert(text, get_pandoc().convert)
+        else:
+            markdown = get_pandoc().convert(text)
+        with open(f"{output_dir}/{pmcid}.md", "w", encoding="utf-8") as f:
+            f.write(markdown)
 
         # remove extracted files
-        os.rename(f"{pmcid}.md", f"{output_dir}/{pmcid}.md")
         shutil.rmtree(nxml.split("/")[0], ignore_errors=True)
 
     except:
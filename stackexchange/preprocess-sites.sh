@@ -3,13 +3,6 @@
 data_dir=${1:-"data"}
 data_dir=${data_dir%/}
 
-for site_dump in ${data_dir}/dump/*/; do
-  site=$(basename ${site_dump})
-  if [[ "${site}" != "stackoverflow.com" ]]; then
-    output="${data_dir}/stackexchange/v0/${site}"
-    if [[ ! -d ${output} ]]; then
-      echo "python preprocess.py --input ${site_dump} --output ${output}"
-      time python preprocess.py --input ${site_dump} --output ${output}
-    fi
-  fi
-done
+# Process all the sites (except stackoverflow) in parallel, sites that have
+# already finished are skipped. Extra arguments are passed to preprocess.py
+python preprocess_sites.py --dumps ${data_dir}/dump --output ${data_dir}/stackexchange/v0 --exclude stackoverflow.com "${@:2}"
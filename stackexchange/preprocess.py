@@ -5,24 +5,47 @@ import collections
 import dataclasses
 import datetime
 import functools
+import glob
+import gzip
+import hashlib
 import itertools
+import json
 import multiprocessing as mp
+import multiprocessing.dummy
 import operator as op
 import os
 import re
-import shelve
+import sys
 import urllib.parse
 from dataclasses import dataclass
-from typing import Dict, List, Sequence
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
 
-import bs4
+import smart_open
 import tqdm
-from markdown_it import MarkdownIt
+from text import html_to_text, markdown_to_text
 
 import licensed_pile.xml as xml
-from licensed_pile import logs
+from licensed_pile import logs, memory, profiling, store
+from licensed_pile.external_sort import external_sort
 from licensed_pile.licenses import PermissiveLicenses
-from licensed_pile.write import to_dolma
+from licensed_pile.write import shard_name, to_dolma
+
+ENRICHMENTS = ("tags", "links", "votes")
+# PostLinks.xml LinkTypeIds
+LINK_TYPES = {"1": "linked", "3": "duplicate_of"}
+# Votes.xml VoteTypeIds, other kinds of votes are ignored.
+VOTE_TYPES = {
+    "1": "accepted",
+    "2": "up",
+    "3": "down",
+    "4": "offensive",
+    "5": "favorite",
+    "6": "close",
+    "7": "reopen",
+    "8": "bounty_start",
+    "9": "bounty_close",
+    "12": "spam",
+}
 
 parser = argparse.ArgumentParser(description="Parse a stack exchange dump.")
 parser.add_argument("--input", help="Path to the dump, data/dump/${site}")
@@ -31,13 +54,38 @@ parser.add_argument(
 )
 parser.add_argument(
     "--processes",
+    type=int,
     default=mp.cpu_count(),
-    help="The number of multicore processors to use.",
+    help="The number of multicore processors to use, 0 parses in this process without starting a pool.",
+)
+parser.add_argument(
+    "--store",
+    choices=store.STORES,
+    default="memory",
+    help="Where to keep the lookup tables, sqlite saves them to disk in ${output} so we don't need to keep them all in memory.",
 )
 parser.add_argument(
     "--shelve",
+    action="store_const",
+    const="sqlite",
+    dest="store",
+    help="Deprecated alias for --store sqlite.",
+)
+parser.add_argument(
+    "--join",
+    action="store_true",
+    help="Join posts, comments, and authors with external sorts instead of building lookup tables, memory use doesn't grow with the size of the site.",
+)
+parser.add_argument(
+    "--sort_buffer",
+    type=int,
+    default=1_000_000,
+    help="With --join, the most records to sort in memory before spilling them to ${output}. Also how many posts votes are counted for at once with --enrich votes.",
+)
+parser.add_argument(
+    "--split_xml",
     action="store_true",
-    help="Save lookup tables as shelves so we don't need to keep them all in memory.",
+    help="Have each worker parse its own part of the xml files instead of parsing them in the main process. Requires one row per line, like the official dumps.",
 )
 parser.add_argument(
     "--skip_comments",
@@ -51,56 +99,112 @@ parser.add_argument(
     default="votes",
     help="How should answers be sorted?",
 )
-
-# Use over commonmark library as that is deprecated and has errors parsing stack overflow.
-MD = MarkdownIt("commonmark", {"breaks": True, "html": True})
-
+parser.add_argument(
+    "--enrich",
+    nargs="+",
+    choices=ENRICHMENTS,
+    default=[],
+    help="Extra metadata to add to each question: its tags, the posts it links to or is a duplicate of (PostLinks.xml), and counts of each kind of vote (Votes.xml).",
+)
+parser.add_argument(
+    "--parallel_output",
+    action="store_true",
+    help="With --store sqlite, sort answers and format documents in the workers, which read the questions from the store and write their own shards.",
+)
+parser.add_argument(
+    "--shard_questions",
+    type=int,
+    default=20_000,
+    help="With --parallel_output, the number of questions each worker writes to a shard.",
+)
+parser.add_argument(
+    "--fingerprints",
+    action="store_true",
+    help="Save a fingerprint of each question to ${output}/fingerprints.tsv.gz so the next dump can be processed with --previous.",
+)
+parser.add_argument(
+    "--previous",
+    help="The output of a run on an older dump (with --fingerprints). Only questions that changed since then are processed, the rest of the documents are copied over.",
+)
+parser.add_argument(
+    "--profile",
+    choices=profiling.PROFILERS,
+    help="Profile the main process and each worker, the merged report is written to ${output}/profile.*",
+)
 
 LICENSES = {
     "CC BY-SA 2.5": PermissiveLicenses.CC_BY_SA_2_5,
     "CC BY-SA 3.0": PermissiveLicenses.CC_BY_SA_3,
     "CC BY-SA 4.0": PermissiveLicenses.CC_BY_SA,
 }
+# Posts store the index of their license in LICENSE_VALUES instead of the enum.
+# Small ints are shared by every post and are much cheaper to pickle.
+LICENSE_IDS = {license: i for i, license in enumerate(LICENSES)}
+LICENSE_VALUES = tuple(LICENSES.values())
+
 
+# The kinds of records we parse and join. Records with the same key are sorted by
+# kind, so users come before the revisions and comments that reference them
+# and questions come before their answers.
+USER, REVISION, AUTHORS, COMMENT, QUESTION, ANSWER, LINK, VOTES = range(8)
 
-@dataclass
+
+# Millions of posts can be in memory (or pickled to a store) at once, so they use
+# slots instead of a __dict__ when the python version supports it.
+SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+
+@dataclass(**SLOTS)
 class Post:
     text: str
-    date: datetime.datetime
-    license: PermissiveLicenses
+    # Seconds since the epoch, see `get_date`.
+    date: int
+    # An index into LICENSE_VALUES, see `stackexchange_license`.
+    license: int
+
+    def __reduce__(self):
+        # Pickle just the values, by default the name of each field is pickled
+        # with every post.
+        return type(self), tuple(
+            getattr(self, field.name) for field in dataclasses.fields(self)
+        )
 
 
-@dataclass
+@dataclass(**SLOTS)
 class Comment(Post):
-    author: str
+    author: Tuple[str, ...]
 
 
-@dataclass
+@dataclass(**SLOTS)
 class Answer(Post):
-    authors: List[str]
+    authors: Tuple[str, ...]
     comments: List[Comment]
     score: int
     accepted: bool
 
 
-@dataclass
+@dataclass(**SLOTS)
 class Question(Post):
     id: str
-    authors: List[str]
+    authors: Tuple[str, ...]
     comments: List[Comment]
     accepted_answer: int
     answers: List[Answer] = dataclasses.field(default_factory=list)
+    # Metadata from --enrich, None when it wasn't collected.
+    tags: Optional[Tuple[str, ...]] = None
+    # (link type, post id) pairs
+    links: Optional[Tuple[Tuple[str, str], ...]] = None
+    votes: Optional[Dict[str, int]] = None
 
 
 def get_attr(xml_obj, key):
-    if key in xml_obj.attrib:
-        return xml_obj.attrib[key]
-    return None
+    """Get an attribute from an xml element or a dict of its attributes."""
+    return xml_obj.get(key)
 
 
 def get_html_text(html):
-    soup = bs4.BeautifulSoup(html, "html.parser")
-    return soup.get_text()
+    # The same as BeautifulSoup(html, "html.parser").get_text(), but much faster.
+    return html_to_text(html)
 
 
 def get_body_text(xml_obj):
@@ -108,7 +212,9 @@ def get_body_text(xml_obj):
 
 
 def get_markdown_text(xml_obj):
-    return get_html_text(MD.render(get_attr(xml_obj, "Text")))
+    # Converts the markdown-it tokens to text directly instead of rendering
+    # them to html and then parsing it with BeautifulSoup.
+    return markdown_to_text(get_attr(xml_obj, "Text"))
     # The original commonmark library used is not maintained anymore and has
     # issues with some of the data.
     # return get_html_text(commonmark.commonmark(get_attr(xml_obj, "Text")))
@@ -160,9 +266,17 @@ def process_comment(comment):
     )
 
 
-def get_date(ts: str) -> datetime.datetime:
+def get_date(ts: str) -> int:
+    """Convert a timestamp into seconds since the epoch, ints are smaller than datetimes."""
     # TODO: Add better error handling?
-    return datetime.datetime.fromisoformat(ts.split(".")[0])
+    date = datetime.datetime.fromisoformat(ts.split(".")[0])
+    return int(date.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+def date_to_iso(date: int) -> str:
+    """Convert the output of `get_date` back into an iso formatted timestamp."""
+    date = datetime.datetime.fromtimestamp(date, datetime.timezone.utc)
+    return date.replace(tzinfo=None).isoformat()
 
 
 def process_question(question):
@@ -174,15 +288,82 @@ def process_question(question):
       The date the question was posted
       The license that applies to the question
       The id of the accepted answer
+      The tags on the question
     """
     if get_attr(question, "PostTypeId") != "1":
-        return None, None, None, None, None
+        return None, None, None, None, None, None
     post_id = get_attr(question, "Id")
     text = f"{get_attr(question, 'Title')}\n{get_body_text(question)}"
     date = get_date(get_attr(question, "CreationDate"))
     license = stackexchange_license(get_attr(question, "ContentLicense"))
     accepted = get_attr(question, "AcceptedAnswerId")
-    return post_id, text, date, license, accepted
+    tags = parse_tags(get_attr(question, "Tags"))
+    return post_id, text, date, license, accepted, tags
+
+
+def parse_tags(tags: Optional[str]) -> Tuple[str, ...]:
+    """Tags are formatted like <python><regex>, or |python|regex| in newer dumps."""
+    if not tags:
+        return ()
+    if tags.startswith("|"):
+        return tuple(tag for tag in tags.split("|") if tag)
+    return tuple(re.findall(r"<([^>]+)>", tags))
+
+
+def process_link(link):
+    """Extract a link between posts from xml.
+
+    Returns:
+      The id of the post with the link
+      The kind of link (a value of LINK_TYPES)
+      The id of the post it links to
+    """
+    link_type = LINK_TYPES.get(get_attr(link, "LinkTypeId"))
+    if link_type is None:
+        return None, None, None
+    return get_attr(link, "PostId"), link_type, get_attr(link, "RelatedPostId")
+
+
+def process_vote(vote):
+    """Extract a vote from xml.
+
+    Returns:
+      The id of the post voted on
+      The kind of vote (a value of VOTE_TYPES)
+    """
+    vote_type = VOTE_TYPES.get(get_attr(vote, "VoteTypeId"))
+    if vote_type is None:
+        return None, None
+    return get_attr(vote, "PostId"), vote_type
+
+
+def count_votes(
+    votes: Iterator[Tuple[str, str]], max_posts: int
+) -> Iterator[Tuple[str, Dict[str, int]]]:
+    """Count each kind of vote per post, a post's counts can be split over several outputs.
+
+    There are many more votes than posts, so instead of passing each vote on
+    we count them for up to `max_posts` posts at a time and then output the
+    partial counts. Dumps are roughly ordered by post id, so most posts end
+    up with a single count.
+    """
+    counts = collections.defaultdict(collections.Counter)
+    for post_id, vote_type in votes:
+        if post_id is None:
+            continue
+        counts[post_id][vote_type] += 1
+        if len(counts) >= max_posts:
+            yield from ((post_id, dict(c)) for post_id, c in counts.items())
+            counts = collections.defaultdict(collections.Counter)
+    yield from ((post_id, dict(c)) for post_id, c in counts.items())
+
+
+def merge_votes(counts: Iterable[Dict[str, int]]) -> Dict[str, int]:
+    """Add up the partial counts from `count_votes`."""
+    total = collections.Counter()
+    for count in counts:
+        total.update(count)
+    return dict(sorted(total.items()))
 
 
 def process_answer(answer):
@@ -208,6 +389,206 @@ def process_answer(answer):
     return question_id, answer_id, text, date, score, license
 
 
+def process_post(post):
+    """Extract question or answer information from xml.
+
+    Returns:
+      The kind of post (QUESTION or ANSWER) and the output of `process_question`
+      or `process_answer`. Other kinds of posts (like tag wikis) are None.
+    """
+    post_type = get_attr(post, "PostTypeId")
+    if post_type == "1":
+        return QUESTION, process_question(post)
+    if post_type == "2":
+        return ANSWER, process_answer(post)
+    return None, None
+
+
+# The attributes that each process_* function reads. Only these are sent to
+# the workers instead of the whole xml element.
+ATTRIBUTES = {
+    "Users.xml": ("Id", "DisplayName"),
+    "PostHistory.xml": ("Id", "PostId"),
+    "Comments.xml": ("PostId", "UserId", "Text", "CreationDate", "ContentLicense"),
+    "PostLinks.xml": ("PostId", "LinkTypeId", "RelatedPostId"),
+    "Votes.xml": ("PostId", "VoteTypeId"),
+    "Posts.xml": (
+        "Id",
+        "PostTypeId",
+        "ParentId",
+        "AcceptedAnswerId",
+        "Title",
+        "Body",
+        "Tags",
+        "CreationDate",
+        "Score",
+        "ContentLicense",
+    ),
+}
+
+
+# The attributes that change when a question, or anything attached to it, is
+# updated. These are used to decide which questions need to be reprocessed.
+FINGERPRINT_ATTRIBUTES = {
+    "PostHistory.xml": ("Id", "PostId"),
+    "Comments.xml": ("Id", "PostId"),
+    "PostLinks.xml": ("Id", "PostId"),
+    "Votes.xml": ("Id", "PostId"),
+    "Posts.xml": (
+        "Id",
+        "PostTypeId",
+        "ParentId",
+        "AcceptedAnswerId",
+        "LastActivityDate",
+        "LastEditDate",
+        "Score",
+    ),
+}
+# The attribute that links a row to a post, used to skip rows of unchanged
+# questions.
+POST_ID_ATTRIBUTES = {
+    "PostHistory.xml": "PostId",
+    "Comments.xml": "PostId",
+    "PostLinks.xml": "PostId",
+    "Votes.xml": "PostId",
+    "Posts.xml": "Id",
+}
+FINGERPRINTS_FILE = "fingerprints.tsv.gz"
+
+
+def hash_values(*values) -> int:
+    """A 64 bit hash that, unlike `hash`, is the same in every process and run."""
+    digest = hashlib.blake2b(repr(values).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def fingerprint_post(post):
+    """Hash the parts of a post that change when it is edited, answered, or voted on.
+
+    Returns:
+      The id of the post
+      The id of the question the post belongs to (itself for questions)
+      The hash of the post
+    """
+    post_id = get_attr(post, "Id")
+    post_type = get_attr(post, "PostTypeId")
+    if post_type == "1":
+        question_id = post_id
+        # Accepting an answer doesn't always update the last activity date.
+        extra = get_attr(post, "AcceptedAnswerId")
+    elif post_type == "2":
+        question_id = get_attr(post, "ParentId")
+        # Votes change the order of the answers but not the last activity date.
+        extra = get_attr(post, "Score")
+    else:
+        return None, None, None
+    return (
+        post_id,
+        question_id,
+        hash_values(
+            post_id,
+            get_attr(post, "LastActivityDate"),
+            get_attr(post, "LastEditDate"),
+            extra,
+        ),
+    )
+
+
+def fingerprint_row(row, kind: str):
+    """Hash a comment or revision by id, these are only ever added or deleted.
+
+    Returns:
+      The id of the post the row is attached to
+      The hash of the row
+    """
+    return get_attr(row, "PostId"), hash_values(kind, get_attr(row, "Id"))
+
+
+def fingerprint_dump(pool, args) -> Tuple[Dict[str, int], Dict[str, str]]:
+    """Fingerprint each question in the dump.
+
+    A fingerprint combines the hash of the question, its answers, and the ids
+    of their comments and revisions. Hashes are summed so the order the rows
+    are processed in doesn't matter.
+
+    Returns:
+      A mapping from question id to fingerprint and from each post id to the
+      id of its question.
+    """
+    logger = logs.get_logger("stackexchange")
+    logger.info("Fingerprinting Questions")
+    hashes = collections.defaultdict(int)
+    questions = {}
+    for post_id, question_id, post_hash in parse_dump_file(
+        pool, args, "Posts.xml", fingerprint_post, FINGERPRINT_ATTRIBUTES
+    ):
+        if post_id is None:
+            continue
+        questions[post_id] = question_id
+        hashes[question_id] += post_hash
+    files = [("PostHistory.xml", "revision")]
+    if args.include_comments:
+        files.append(("Comments.xml", "comment"))
+    if "links" in args.enrich:
+        files.append(("PostLinks.xml", "link"))
+    if "votes" in args.enrich:
+        files.append(("Votes.xml", "vote"))
+    for file_name, kind in files:
+        for post_id, row_hash in parse_dump_file(
+            pool,
+            args,
+            file_name,
+            functools.partial(fingerprint_row, kind=kind),
+            FINGERPRINT_ATTRIBUTES,
+        ):
+            if (question_id := questions.get(post_id)) is not None:
+                hashes[question_id] += row_hash
+    # Answers to questions that aren't in the dump are dropped.
+    fingerprints = {
+        post_id: hashes[post_id] & 0xFFFFFFFFFFFFFFFF
+        for post_id, question_id in questions.items()
+        if post_id == question_id
+    }
+    return fingerprints, questions
+
+
+def write_fingerprints(path: str, fingerprints: Dict[str, int], options: Dict):
+    """Save fingerprints, the first line records the options the documents were made with."""
+    with gzip.open(path, "wt") as wf:
+        wf.write(f"# {json.dumps(options, sort_keys=True)}\n")
+        for question_id, fingerprint in fingerprints.items():
+            wf.write(f"{question_id}\t{fingerprint}\n")
+
+
+def read_fingerprints(path: str, options: Dict) -> Dict[str, int]:
+    """Load fingerprints, empty when they are missing or were made with different options."""
+    logger = logs.get_logger("stackexchange")
+    if not os.path.exists(path):
+        logger.warning(f"No fingerprints at {path}, all questions will be processed.")
+        return {}
+    with gzip.open(path, "rt") as f:
+        previous_options = json.loads(f.readline()[2:])
+        if previous_options != options:
+            logger.warning(
+                f"Previous documents were made with {previous_options} instead of {options}, all questions will be processed."
+            )
+            return {}
+        return {
+            question_id: int(fingerprint)
+            for question_id, fingerprint in (line.split("\t") for line in f)
+        }
+
+
+def previous_documents(path: str, question_ids: Set[str]) -> Iterator[Dict]:
+    """Documents from a previous run for `question_ids`."""
+    for shard in sorted(glob.glob(os.path.join(path, "documents", "*.jsonl.gz"))):
+        with gzip.open(shard, "rt") as f:
+            for line in f:
+                document = json.loads(line)
+                if document["id"] in question_ids:
+                    yield document
+
+
 def stackexchange_license(license):
     """For a rough idea of date based licenses see
        https://stackoverflow.com/help/licensing.
@@ -219,8 +600,16 @@ def stackexchange_license(license):
 
     TODO: Add filtering based on license type (do any answer/comment/question
       have licenses that aren't permissive?)
+
+    Returns:
+      The id of the license, unknown licenses are returned as is.
     """
-    return LICENSES.get(license, license)
+    return LICENSE_IDS.get(license, license)
+
+
+def license_from_id(license):
+    """Convert the output of `stackexchange_license` into the license."""
+    return LICENSE_VALUES[license] if isinstance(license, int) else license
 
 
 def stackexchange_url(site, id, collection: str = "questions"):
@@ -268,18 +657,80 @@ def format_dolma(question, site, extra_metadata: Dict[str, str]):
         # id as the id which needs to be unique *per* source*.
         "source": "Stack Exchange",
         "added": datetime.datetime.utcnow().isoformat(),
-        "created": question.date.isoformat(),
+        "created": date_to_iso(question.date),
         "metadata": {
-            "license": str(question.license),
+            "license": str(license_from_id(question.license)),
             "site": site,
             "url": stackexchange_url(site, question.id),
             "authors": sorted(all_authors),
-            "all_licenses": sorted(map(str, set(all_licenses))),
+            "all_licenses": sorted(str(license_from_id(l)) for l in set(all_licenses)),
+            **enrichment_metadata(question),
             **extra_metadata,
         },
     }
 
 
+def attach_answers(question: Question, answers: store.Store, sort_answers) -> Question:
+    """Add the answers stored under the id of `question` to it."""
+    question_answers = []
+    for answer_id, answer in answers.get(question.id, []):
+        answer.accepted = question.accepted_answer == answer_id
+        question_answers.append(answer)
+    # Sort answers to questions (based on the --sort order), when they are
+    # added to the question text we know they will be in the correct order,
+    # even if they are out of order in the dump/from multiprocessing.
+    question.answers = sort_answers(question_answers)
+    return question
+
+
+# The question and answer stores that a worker has opened, they are kept open
+# for each of the shards it writes.
+_WORKER_STORES = {}
+
+
+def format_shard(
+    task: Tuple[int, List[str]], output: str, sort_answers, format_example
+):
+    """Write the documents for a chunk of questions to their own shard.
+
+    This runs in a worker. It reads the questions and answers from the sqlite
+    stores in `output` itself, so only the question ids are sent to it.
+
+    Returns:
+      The number of documents written.
+    """
+    shard, question_ids = task
+    if output not in _WORKER_STORES:
+        _WORKER_STORES[output] = tuple(
+            store.SQLiteStore(os.path.join(output, name), flag="r")
+            for name in ("questions.sqlite", "answers.sqlite")
+        )
+    questions, answers = _WORKER_STORES[output]
+    path = os.path.join(output, "documents", shard_name("se.jsonl.gz", shard))
+    with smart_open.open(path, "w") as wf:
+        for question_id in question_ids:
+            question, *_ = questions[question_id]
+            question = attach_answers(question, answers, sort_answers)
+            wf.write(json.dumps(format_example(question)) + "\n")
+    return len(question_ids)
+
+
+def enrichment_metadata(question: Question) -> Dict:
+    """Metadata from --enrich, only what was collected is included."""
+    metadata = {}
+    if question.tags is not None:
+        metadata["tags"] = list(question.tags)
+    if question.links is not None:
+        for link_type in LINK_TYPES.values():
+            metadata[link_type] = sorted(
+                {post_id for kind, post_id in question.links if kind == link_type},
+                key=int,
+            )
+    if question.votes is not None:
+        metadata["votes"] = question.votes
+    return metadata
+
+
 def vote_sort(answers: Sequence[Answer]) -> List[Answer]:
     """Sort based on votes.
 
@@ -307,8 +758,274 @@ def find_file(directory: str, file_name: str) -> str:
     raise ValueError(f"Failed to find {file_name} in {directory}")
 
 
+def join_users(records: Iterator[Tuple]) -> Iterator[Tuple]:
+    """Attach user names to revisions and comments.
+
+    Args:
+      records: (user id, kind, value) tuples sorted by user id and kind.
+
+    Returns:
+      (post id, kind, value) records with the authors of each revision and
+      each comment.
+    """
+    for _, group in itertools.groupby(records, key=op.itemgetter(0)):
+        names = set()
+        authors = None
+        for _, kind, value in group:
+            if kind == USER:
+                names.update(value)
+                continue
+            # Users come first, so all their names have been seen. The same
+            # tuple is shared by each of their revisions and comments.
+            if authors is None:
+                authors = tuple(names)
+            if kind == REVISION:
+                yield value, AUTHORS, authors
+            elif kind == COMMENT:
+                post_id, text, date, license = value
+                yield post_id, COMMENT, Comment(
+                    text=text, author=authors, date=date, license=license
+                )
+
+
+def join_posts(
+    records: Iterator[Tuple], sort_comments, enrich: Sequence[str] = ()
+) -> Iterator[Tuple]:
+    """Attach authors and comments (and links and votes) to questions and answers.
+
+    Args:
+      records: (post id, kind, value) tuples sorted by post id and kind.
+      enrich: Which of ENRICHMENTS to add to the questions.
+
+    Returns:
+      (question id, kind, value) records for each question and answer.
+    """
+    logger = logs.get_logger("stackexchange")
+    for post_id, group in itertools.groupby(records, key=op.itemgetter(0)):
+        authors = None
+        comments = []
+        links = []
+        votes = []
+        posts = []
+        for _, kind, value in group:
+            if kind == AUTHORS:
+                authors = (authors or set()).union(value)
+            elif kind == COMMENT:
+                comments.append(value)
+            elif kind == LINK:
+                links.append(value)
+            elif kind == VOTES:
+                votes.append(value)
+            else:
+                posts.append((kind, value))
+        if not posts:
+            continue
+        if authors is None:
+            logger.warning(f"Failed to find authors associated with post: {post_id}")
+            authors = {"Unknown"}
+        authors = tuple(authors)
+        # Comments are sorted in chronological order.
+        comments = sort_comments(comments)
+        for kind, value in posts:
+            if kind == QUESTION:
+                text, date, license, accepted_id, tags = value
+                yield post_id, QUESTION, Question(
+                    text=text,
+                    id=post_id,
+                    authors=authors,
+                    comments=comments,
+                    date=date,
+                    license=license,
+                    accepted_answer=accepted_id,
+                    **enrichments(enrich, tags, links, votes),
+                )
+            else:
+                question_id, text, date, score, license = value
+                yield question_id, ANSWER, (
+                    post_id,
+                    Answer(
+                        text=text,
+                        authors=authors,
+                        comments=comments,
+                        date=date,
+                        license=license,
+                        score=score,
+                        accepted=False,
+                    ),
+                )
+
+
+def enrichments(
+    enrich: Sequence[str],
+    tags: Tuple[str, ...],
+    links: Iterable[Tuple[str, str]],
+    votes: Iterable[Dict[str, int]],
+) -> Dict:
+    """The Question fields for the metadata in `enrich`, the rest are left as None."""
+    fields = {}
+    if "tags" in enrich:
+        fields["tags"] = tags
+    if "links" in enrich:
+        fields["links"] = tuple(links)
+    if "votes" in enrich:
+        fields["votes"] = merge_votes(votes)
+    return fields
+
+
+def join_answers(records: Iterator[Tuple], sort_answers) -> Iterator[Question]:
+    """Attach answers to their questions.
+
+    Args:
+      records: (question id, kind, value) tuples sorted by question id and kind.
+
+    Returns:
+      Each question with its answers.
+    """
+    for _, group in itertools.groupby(records, key=op.itemgetter(0)):
+        _, kind, question = next(group)
+        # Answers to questions that aren't in the dump are dropped.
+        if kind != QUESTION:
+            continue
+        answers = []
+        for _, _, (answer_id, answer) in group:
+            answer.accepted = question.accepted_answer == answer_id
+            answers.append(answer)
+        question.answers = sort_answers(answers)
+        yield question
+
+
+def join_dump(
+    args, pool, site, sort_comments, sort_answers, keep: Optional[Set[str]] = None
+) -> Iterator[Question]:
+    """Build questions with a sort-merge join over each file in the dump.
+
+    Instead of lookup tables keyed by id, each file is turned into records
+    keyed by the id it is joined on. The records are sorted (spilling to disk
+    when there are too many) and then each group of records with the same key
+    is joined in a single pass. This takes three rounds, joining on the user
+    id, the post id, and finally the question id. Only the posts in `keep` (all
+    of them when it is None) are included.
+    """
+    logger = logs.get_logger("stackexchange")
+    sort = functools.partial(
+        external_sort,
+        key=op.itemgetter(0, 1),
+        max_items=args.sort_buffer,
+        tmp_dir=args.output,
+    )
+
+    users = (
+        (user_id, USER, user_names)
+        for user_id, user_names in parse_dump_file(
+            pool, args, "Users.xml", functools.partial(process_user, site=site)
+        )
+        if user_id is not None
+    )
+    revisions = (
+        (user_id, REVISION, post_id)
+        for post_id, user_id in parse_dump_file(
+            pool, args, "PostHistory.xml", process_revision, keep=keep
+        )
+        if post_id is not None
+    )
+    if args.include_comments:
+        comments = (
+            # Comments without a user are sorted with the empty string.
+            (user_id or "", COMMENT, (post_id, text, date, license))
+            for post_id, user_id, text, date, license in parse_dump_file(
+                pool, args, "Comments.xml", process_comment, keep=keep
+            )
+            if post_id is not None
+        )
+    else:
+        logger.info("Comments will not be included in the text output.")
+        comments = ()
+    logger.info("Joining users with revisions and comments.")
+    by_user = sort(itertools.chain(users, revisions, comments))
+
+    def posts():
+        for kind, post in parse_dump_file(
+            pool, args, "Posts.xml", process_post, keep=keep
+        ):
+            if kind == QUESTION:
+                post_id, *question = post
+                yield post_id, QUESTION, tuple(question)
+            elif kind == ANSWER:
+                question_id, answer_id, *answer = post
+                yield answer_id, ANSWER, (question_id, *answer)
+
+    # Links and votes are keyed by the post they are on, so they join with the
+    # posts without any extra rounds.
+    extras = []
+    if "links" in args.enrich:
+        extras.append(
+            (post_id, LINK, (link_type, related_id))
+            for post_id, link_type, related_id in parse_dump_file(
+                pool, args, "PostLinks.xml", process_link, keep=keep
+            )
+            if post_id is not None
+        )
+    if "votes" in args.enrich:
+        votes = parse_dump_file(pool, args, "Votes.xml", process_vote, keep=keep)
+        extras.append(
+            (post_id, VOTES, counts)
+            for post_id, counts in count_votes(votes, args.sort_buffer)
+        )
+
+    logger.info("Joining posts with their authors and comments.")
+    by_post = sort(itertools.chain(join_users(by_user), posts(), *extras))
+
+    logger.info("Joining answers with their questions.")
+    by_question = sort(join_posts(by_post, sort_comments, args.enrich))
+    yield from join_answers(by_question, sort_answers)
+
+
+def parse_dump_file(
+    pool,
+    args,
+    file_name: str,
+    func,
+    attributes: Dict[str, Sequence[str]] = ATTRIBUTES,
+    keep: Optional[Set[str]] = None,
+) -> Iterator:
+    """Run `func` on each row of `file_name` in the dump using `pool`.
+
+    Either the rows are parsed here and only the `attributes` `func` needs are
+    sent to the workers, or with `--split_xml` each worker parses its own byte
+    range of the file. Nothing is read until the output is iterated over.
+
+    When `keep` is given, only rows for those post ids are processed. The rows
+    are filtered here, so `--split_xml` isn't used.
+    """
+    path = find_file(args.input, file_name)
+    if args.split_xml and keep is None:
+        yield from xml.map_xml_lines(pool, func, path, "row")
+    else:
+        rows = xml.iterate_attributes(path, "row", attributes[file_name])
+        if keep is not None and (key := POST_ID_ATTRIBUTES.get(file_name)):
+            rows = (row for row in rows if row.get(key) in keep)
+        yield from pool.imap_unordered(func, rows, chunksize=100)
+
+
+def make_pool(
+    processes: int, profile: Optional[str] = None, profile_dir: Optional[str] = None
+):
+    """A pool of `processes` workers, with 0 the work is done by a thread in this process.
+
+    Starting a pool costs more than parsing very small sites, which are
+    processed in bulk by preprocess_sites.py.
+
+    Worker processes are profiled with their own profiler when `profile` is
+    set. Signal handlers can only be installed by the main thread, so the
+    thread pool isn't, it is covered by the profile of this process instead.
+    """
+    if processes == 0:
+        return mp.dummy.Pool(processes=1)
+    return mp.Pool(processes=processes, **profiling.pool_kwargs(profile, profile_dir))
+
+
 def main(args):
-    logger = logs.configure_logging("stackexchange")
+    logger = logs.get_logger("stackexchange")
     # Note: The Stack Exchage data doesn't lend itself to being shared into the
     # dolma format before the preprocessing is done, therefore we manually use
     # multiprocessing as we go to generate examples in parallel which are
@@ -316,7 +1033,18 @@ def main(args):
     # Make sure the ending the input dir with a `/` doesn't results in an empty
     # string as the site value.
     site = os.path.basename(re.sub(r"/$", "", args.input))
+    if args.previous and os.path.realpath(args.previous) == os.path.realpath(
+        args.output
+    ):
+        raise ValueError("--previous must be a different directory than --output.")
     os.makedirs(args.output, exist_ok=True)
+    parallel_output = args.parallel_output and not args.join
+    if parallel_output and args.store != "sqlite":
+        raise ValueError("--parallel_output needs the questions in --store sqlite.")
+    if parallel_output and args.processes == 0:
+        # There are no worker processes to share the work with.
+        logger.info("Formatting documents in this process as --processes is 0.")
+        parallel_output = False
 
     date_sort = functools.partial(sorted, key=op.attrgetter("date"))
     # Comments are always sorted by date
@@ -327,6 +1055,15 @@ def main(args):
     else:
         logger.info("Answers will be sorted based on votes (accepted answer first).")
         sort_answers = vote_sort
+    options = {
+        "sort": args.sort,
+        "include_comments": args.include_comments,
+    }
+    format_example = functools.partial(format_dolma, site=site, extra_metadata=options)
+    # Documents can only be reused when they have the same metadata.
+    fingerprint_options = (
+        {**options, "enrich": sorted(args.enrich)} if args.enrich else options
+    )
 
     # TODO: Does setting the start method to `spawn` help reduce memory usage?
     # Note: We use iterables through out this to reduce memory usage, however,
@@ -334,38 +1071,88 @@ def main(args):
     # multiprocessing pool *within* the pool context manager, otherwise the
     # pool will be "finalized" (deleted) before all the data is processed and
     # the program will hang.
-    with mp.Pool(processes=args.processes) as pool:
+    with profiling.profile_run(
+        args.profile, os.path.join(args.output, "profile")
+    ) as profile_dir, make_pool(args.processes, args.profile, profile_dir) as pool:
+        # In incremental mode only the posts of new or changed questions (and
+        # their answers, comments, and revisions) are processed, the documents
+        # for the rest are copied from the previous output.
+        keep = None
+        reused = set()
+        fingerprints = None
+        if args.fingerprints or args.previous:
+            fingerprints, post_questions = fingerprint_dump(pool, args)
+        if args.previous:
+            previous = read_fingerprints(
+                os.path.join(args.previous, FINGERPRINTS_FILE), fingerprint_options
+            )
+            changed = {
+                question_id
+                for question_id, fingerprint in fingerprints.items()
+                if previous.get(question_id) != fingerprint
+            }
+            reused = fingerprints.keys() - changed
+            keep = {
+                post_id
+                for post_id, question_id in post_questions.items()
+                if question_id in changed
+            }
+            del previous, post_questions
+            logger.info(
+                f"{len(changed)} questions are new or changed, reusing {len(reused)} documents from {args.previous}"
+            )
+
+        def write_documents(questions):
+            examples = map(format_example, questions)
+            if reused:
+                examples = itertools.chain(
+                    previous_documents(args.previous, reused), examples
+                )
+            to_dolma(examples, os.path.join(args.output, "documents"), "se.jsonl.gz")
+            if fingerprints is not None:
+                write_fingerprints(
+                    os.path.join(args.output, FINGERPRINTS_FILE),
+                    fingerprints,
+                    fingerprint_options,
+                )
+
+        if args.join:
+            questions = join_dump(
+                args, pool, site, sort_comments, sort_answers, keep=keep
+            )
+            logger.info("Formatting Questions as Dolma Documents")
+            write_documents(questions)
+            return
+
         logger.info("Building Lookup from user id -> user names")
-        user_xml = xml.iterate_xml(find_file(args.input, "Users.xml"), "row")
         # This table is fairly small so we don't need to create a shelve for it.
+        # The ids and names are interned and the names of each user are shared
+        # by all of their posts and comments.
         author_display = collections.defaultdict(set)
-        for user_id, user_names in pool.imap_unordered(
-            functools.partial(process_user, site=site), user_xml, chunksize=100
+        for user_id, user_names in parse_dump_file(
+            pool, args, "Users.xml", functools.partial(process_user, site=site)
         ):
             if user_id is None:
                 continue
-            author_display[user_id].update(user_names)
+            author_display[sys.intern(user_id)].update(map(sys.intern, user_names))
+        author_display = {
+            user_id: tuple(names) for user_id, names in author_display.items()
+        }
 
         logger.info("Building Lookup from post id -> authors")
-        history_xml = xml.iterate_xml(find_file(args.input, "PostHistory.xml"), "row")
-        # It would probably be better/faster to use a database to store these
-        # intermediate lookups instead of a shelve (which requires multiple
-        # pickle serialization/deserialization) but I didn't want to implement
-        # a database based key-value store that supports list values, set values
-        # and scalar values.
-        if args.shelve:
-            post_authors = shelve.open(os.path.join(args.output, "authors.shelve"))
-        else:
-            post_authors = {}
-        for post_id, user_id in pool.imap_unordered(
-            process_revision, history_xml, chunksize=100
+        # Each lookup maps a post id to a list of values. We only ever append
+        # to them (instead of reading, updating, and writing back the whole
+        # value) so they can live on disk when using `--store sqlite`. Authors
+        # are saved as user ids, which are converted to names when used.
+        post_authors = store.open_store(
+            args.store, os.path.join(args.output, "authors.sqlite")
+        )
+        for post_id, user_id in parse_dump_file(
+            pool, args, "PostHistory.xml", process_revision, keep=keep
         ):
             if post_id is None:
                 continue
-            authors = post_authors.get(post_id, set())
-            authors.update(author_display[user_id])
-            # Get and assign so that values are written back to the shelve.
-            post_authors[post_id] = authors
+            post_authors.append(post_id, sys.intern(user_id))
 
         # Even if we are going to skip including the comments in the output, we
         # still create the comment lookup date. Accesses to it later have
@@ -373,124 +1160,189 @@ def main(args):
         # in no comments being included. Even though we make the lookup table,
         # we do skip filling it with processed comments if they are going to be
         # skipped later.
-        if args.shelve:
-            comments = shelve.open(os.path.join(args.output, "comments.shelve"))
-        else:
-            comments = {}
+        comments = store.open_store(
+            args.store, os.path.join(args.output, "comments.sqlite")
+        )
         if args.include_comments:
             logger.info("Building Lookup from post/answer id -> comments")
-            comment_xml = xml.iterate_xml(find_file(args.input, "Comments.xml"), "row")
-            for post_id, user_id, text, date, license in pool.imap_unordered(
-                process_comment, comment_xml, chunksize=100
+            for post_id, user_id, text, date, license in parse_dump_file(
+                pool, args, "Comments.xml", process_comment, keep=keep
             ):
                 if post_id is None:
                     continue
-                comment = comments.get(post_id, [])
-                comment.append(
+                comments.append(
+                    post_id,
                     Comment(
                         text=text,
-                        author=author_display[user_id],
+                        author=author_display.get(user_id, ()),
                         date=date,
                         license=license,
-                    )
+                    ),
                 )
-                # Get and assign so that values are written back to the shelve.
-                comments[post_id] = comment
-            # Sort comments based on creation date, then when we add them to the text
-            # we know that they will be in the correct order, even if they are out
-            # of order in the dump/from multiprocessing.
-            # Explicit loop instead of a comprehension because it might be a shelve :(
-            for cid, cs in comments.items():
-                comments[cid] = sort_comments(cs)
         else:
             logger.info("Comments will not be included in the text output.")
 
-        if args.shelve:
-            parsed_dump = shelve.open(os.path.join(args.output, "questions.shelve"))
-        else:
-            parsed_dump = {}
-
-        # Questions are the "document" level for this dataset, therefore we do
-        # no need to sort them.
-        logger.info("Parsing Questions")
-        post_xml = xml.iterate_xml(find_file(args.input, "Posts.xml"), "row")
-        for post_id, text, date, license, accepted_id in pool.imap_unordered(
-            process_question, post_xml, chunksize=100
-        ):
-            if post_id is None:
-                continue
-            if post_id not in post_authors:
+        def get_authors(post_id):
+            if (authors := post_authors.get(post_id)) is None:
                 logger.warning(
                     f"Failed to find authors associated with post: {post_id}"
                 )
-            parsed_dump[post_id] = Question(
-                text=text,
-                id=post_id,
-                authors=post_authors.get(post_id, {"Unknown"}),
-                # Comments are sorted in chronological order.
-                comments=comments.get(post_id, []),
-                date=date,
-                license=license,
-                accepted_answer=accepted_id,
+                return ("Unknown",)
+            return tuple(
+                set(
+                    itertools.chain.from_iterable(
+                        author_display.get(user_id, ()) for user_id in authors
+                    )
+                )
             )
 
-        logger.info("Parsing Answers")
-        # Reinitialize the iterator over the Posts as it was consumed when
-        # looking for questions. We do this as a second pass so we know that
-        # there will always be a question we can attach this answer to.
-        post_xml = xml.iterate_xml(find_file(args.input, "Posts.xml"), "row")
-        for question_id, answer_id, answer, date, score, license in pool.imap_unordered(
-            process_answer, post_xml, chunksize=100
+        # Comments are sorted based on creation date when they are looked up,
+        # then when we add them to the text we know that they will be in the
+        # correct order, even if they are out of order in the dump/from
+        # multiprocessing.
+        def get_comments(post_id):
+            return sort_comments(comments.get(post_id, []))
+
+        # The links and votes are only read (and stored) when they are used.
+        links = votes = None
+        if "links" in args.enrich:
+            logger.info("Building Lookup from post id -> links")
+            links = store.open_store(
+                args.store, os.path.join(args.output, "links.sqlite")
+            )
+            for post_id, link_type, related_id in parse_dump_file(
+                pool, args, "PostLinks.xml", process_link, keep=keep
+            ):
+                if post_id is not None:
+                    links.append(post_id, (link_type, related_id))
+        # Votes are counted for batches of posts before they are stored, there
+        # are many more votes than posts.
+        if "votes" in args.enrich:
+            logger.info("Building Lookup from post id -> votes")
+            votes = store.open_store(
+                args.store, os.path.join(args.output, "votes.sqlite")
+            )
+            for post_id, counts in count_votes(
+                parse_dump_file(pool, args, "Votes.xml", process_vote, keep=keep),
+                args.sort_buffer,
+            ):
+                votes.append(post_id, counts)
+
+        questions = store.open_store(
+            args.store, os.path.join(args.output, "questions.sqlite")
+        )
+        answers = store.open_store(
+            args.store, os.path.join(args.output, "answers.sqlite")
+        )
+        # Questions are the "document" level for this dataset, therefore we do
+        # no need to sort them. Questions and answers are parsed in a single
+        # pass over the posts. Answers are stored under the id of their
+        # question (which may not have been seen yet) and whether they are
+        # accepted is decided when they are attached to the question, so the
+        # questions don't need to be updated.
+        logger.info("Parsing Questions and Answers")
+        for kind, post in parse_dump_file(
+            pool, args, "Posts.xml", process_post, keep=keep
         ):
-            if question_id is None:
-                continue
-            if answer_id not in post_authors:
-                logger.warning(
-                    f"Failed to find authors assocaited with answer: {answer_id}"
+            if kind == QUESTION:
+                post_id, text, date, license, accepted_id, tags = post
+                questions.append(
+                    post_id,
+                    Question(
+                        text=text,
+                        id=post_id,
+                        authors=get_authors(post_id),
+                        comments=get_comments(post_id),
+                        date=date,
+                        license=license,
+                        accepted_answer=accepted_id,
+                        **enrichments(
+                            args.enrich,
+                            tags,
+                            links.get(post_id, ()) if links is not None else (),
+                            votes.get(post_id, ()) if votes is not None else (),
+                        ),
+                    ),
                 )
-            question = parsed_dump[question_id]
-            question.answers.append(
-                Answer(
-                    text=answer,
-                    authors=post_authors.get(answer_id, {"Unknown"}),
-                    # Comments are sorted in chronological order.
-                    comments=comments.get(answer_id, []),
-                    date=date,
-                    license=license,
-                    score=score,
-                    accepted=question.accepted_answer == answer_id,
+            elif kind == ANSWER:
+                question_id, answer_id, answer, date, score, license = post
+                answers.append(
+                    question_id,
+                    (
+                        answer_id,
+                        Answer(
+                            text=answer,
+                            authors=get_authors(answer_id),
+                            comments=get_comments(answer_id),
+                            date=date,
+                            license=license,
+                            score=score,
+                            accepted=False,
+                        ),
+                    ),
                 )
-            )
-            # Get and assign so that values are written back to the shelve.
-            parsed_dump[question_id] = question
-
-        # Sort answers to questions based on creation date, when when they are
-        # added to the question text we know they will be in the correct order,
-        # even if they are out of order in the dump/from multiprocessing.
-        # Explicit loop instead of a compreshension because it might be a shelve :(
-        for qid, q in parsed_dump.items():
-            q.answers = sort_answers(q.answers)
-            parsed_dump[qid] = q
-
         # Use iterators so we don't need to have the full dataset loaded at once.
         logger.info("Formatting Questions as Dolma Documents")
-        # Even on rather large datasets, such as askubuntu.com, and shelves it
-        # was faster to do the comment/answer sorting and run format dolma in
-        # the main process. I assume the cost to serialize and decerialize the
-        # question is large and especially when the main process is the only
-        # writer.
-        examples = map(
-            functools.partial(
-                format_dolma,
-                site=site,
-                extra_metadata={
-                    "sort": args.sort,
-                    "include_comments": args.include_comments,
-                },
-            ),
-            parsed_dump.values(),
-        )
-        to_dolma(examples, os.path.join(args.output, "documents"), "se.jsonl.gz")
+        if parallel_output:
+            # Only the question ids are sent to the workers, each one reads
+            # the questions and answers from the sqlite stores and writes its
+            # own shards.
+            for lookup in (questions, answers):
+                lookup.prepare_read()
+            documents = os.path.join(args.output, "documents")
+            os.makedirs(documents, exist_ok=True)
+
+            def chunks():
+                question_ids = iter(questions.keys())
+                while chunk := list(
+                    itertools.islice(question_ids, args.shard_questions)
+                ):
+                    yield chunk
+
+            # Only a few shards are queued at a time so the ids aren't all
+            # read into memory at once.
+            written = sum(
+                tqdm.tqdm(
+                    memory.bounded_imap(
+                        pool,
+                        functools.partial(
+                            format_shard,
+                            output=args.output,
+                            sort_answers=sort_answers,
+                            format_example=format_example,
+                        ),
+                        enumerate(chunks()),
+                        max_in_flight=2 * args.processes,
+                    ),
+                    desc="Shards",
+                )
+            )
+            logger.info(f"Wrote {written} documents to {documents}")
+            if reused:
+                to_dolma(
+                    previous_documents(args.previous, reused),
+                    documents,
+                    "previous_se.jsonl.gz",
+                )
+            if fingerprints is not None:
+                write_fingerprints(
+                    os.path.join(args.output, FINGERPRINTS_FILE),
+                    fingerprints,
+                    fingerprint_options,
+                )
+        else:
+            # Without --parallel_output, it was faster to do the answer sorting
+            # and run format dolma in the main process, even on rather large
+            # datasets such as askubuntu.com and on disk stores. I assume the
+            # cost to serialize and deserialize the question is large and
+            # especially when the main process is the only writer.
+            write_documents(
+                attach_answers(q, answers, sort_answers)
+                for _, (q, *_) in questions.items()
+            )
+        for lookup in (post_authors, comments, links, votes, questions, answers):
+            if lookup is not None:
+                lookup.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,249 @@
+"""Preprocess all the stack exchange site dumps with a shared pool of processors.
+
+Running `preprocess.py` once per site leaves cores idle. Each tiny site pays
+the cost of starting a pool, and the last large site runs on its own. Instead,
+sites are run at the same time under a global budget of `--processes`:
+  * Large sites split the part of the budget their size is worth, so they all
+    finish at about the same time.
+  * Small sites are packed together and run one after another, without a pool,
+    in a single process. Packs are small so they fill in the processors that
+    free up as the large sites finish.
+  * The largest jobs start first, smaller ones fill in as processors free up.
+Sites that have already finished (they have a `.done` file) are skipped.
+
+Any arguments not listed here are passed along to `preprocess.py`, for example
+`--store sqlite` or `--join`.
+"""
+
+import argparse
+import math
+import multiprocessing as mp
+import multiprocessing.connection
+import os
+import shutil
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence
+
+import preprocess
+
+from licensed_pile import logs
+from licensed_pile.memory import parse_size
+
+parser = argparse.ArgumentParser(
+    description="Parse all the stack exchange dumps in parallel."
+)
+parser.add_argument(
+    "--dumps", default="data/dump", help="Path to the directory of site dumps."
+)
+parser.add_argument(
+    "--output",
+    default="data/stackexchange/v0",
+    help="Path to the output, each site is written to ${output}/${site}",
+)
+parser.add_argument(
+    "--processes",
+    type=int,
+    default=mp.cpu_count(),
+    help="The total number of processors to use across all sites.",
+)
+parser.add_argument(
+    "--small_site",
+    type=parse_size,
+    default="256M",
+    help="Sites with dumps smaller than this are packed together and run without a pool.",
+)
+parser.add_argument(
+    "--pack_size",
+    type=parse_size,
+    help="How much of the small sites to pack into one process, defaults to a quarter of an even share of all the dumps.",
+)
+parser.add_argument(
+    "--exclude",
+    nargs="*",
+    default=["stackoverflow.com"],
+    help="Sites to skip, stackoverflow is large enough that it should be run on its own.",
+)
+parser.add_argument(
+    "--previous",
+    help="The output of a run on an older dump, sites are updated incrementally from ${previous}/${site} when it exists.",
+)
+parser.add_argument(
+    "--force",
+    action="store_true",
+    help="Reprocess sites even if they have already finished.",
+)
+
+# Written to ${output}/${site} once a site has been fully processed.
+DONE_FILE = ".done"
+
+
+@dataclass
+class Job:
+    """A group of sites that are processed, in order, by one process tree."""
+
+    sites: List[str]
+    size: int
+    # How much of the processor budget the job uses, the main process plus
+    # `processes - 1` pool workers.
+    processes: int
+
+
+def dump_size(path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, f))
+        for root, _, files in os.walk(path)
+        for f in files
+    )
+
+
+def is_done(output: str, site: str) -> bool:
+    return os.path.exists(os.path.join(output, site, DONE_FILE))
+
+
+def plan_jobs(
+    sizes: Dict[str, int],
+    processes: int,
+    small_site: int,
+    pack_size: Optional[int] = None,
+) -> List[Job]:
+    """Split the sites into jobs, largest first.
+
+    Args:
+      sizes: The size of each site's dump.
+      processes: The total number of processors we can use.
+      small_site: Sites smaller than this are packed into single process jobs,
+        as are sites that would get less than one of the `processes`.
+      pack_size: The most data to pack into a single job. Defaults to a quarter
+        of the total size divided by the number of processors (the amount of
+        work each processor would do with a perfect split), so the packs are
+        small enough to fill in the processors the large sites leave free.
+    """
+    total = sum(sizes.values())
+    if pack_size is None:
+        pack_size = max(1, math.ceil(total / (4 * processes)))
+    # Sites that would get less than a whole processor are packed as well.
+    large = {
+        site: size
+        for site, size in sizes.items()
+        if size >= small_site and processes * size >= total
+    }
+    shares = share_processes(large, processes * sum(large.values()) / total)
+    jobs = [Job([site], size, shares[site]) for site, size in large.items()]
+    packs = []
+    for site, size in sorted(sizes.items(), key=lambda s: (-s[1], s[0])):
+        if site in large:
+            continue
+        # First fit decreasing, sites go into the first pack with room.
+        for pack in packs:
+            if pack.size + size <= pack_size:
+                pack.sites.append(site)
+                pack.size += size
+                break
+        else:
+            packs.append(Job([site], size, 1))
+    return sorted(jobs + packs, key=lambda j: (-j.size, j.sites[0]))
+
+
+def share_processes(sizes: Dict[str, int], processes: float) -> Dict[str, int]:
+    """Split `processes` between the sites so the slowest one finishes first.
+
+    Each site starts with one processor and the rest are handed out one at a
+    time to the site that would take longest, each site should be large enough
+    for at least one. The shares add up to at most `processes`.
+    """
+    shares = {site: 1 for site in sizes}
+    for _ in range(math.floor(processes + 1e-9) - len(shares)):
+        slowest = max(shares, key=lambda site: (sizes[site] / shares[site], site))
+        shares[slowest] += 1
+    return shares
+
+
+def run_job(job: Job, args: argparse.Namespace, preprocess_args: Sequence[str]):
+    """Process each site in the job, this runs in its own process."""
+    logger = logs.configure_logging("stackexchange")
+    # With a single processor we parse in this process, `--processes 0`.
+    workers = job.processes - 1 if job.processes > 1 else 0
+    for site in job.sites:
+        output = os.path.join(args.output, site)
+        # Remove documents from an earlier run that didn't finish, the shards it
+        # wrote could otherwise be left next to the new ones.
+        shutil.rmtree(os.path.join(output, "documents"), ignore_errors=True)
+        site_args = preprocess.parser.parse_args(
+            [
+                *preprocess_args,
+                "--input",
+                os.path.join(args.dumps, site),
+                "--output",
+                output,
+                "--processes",
+                str(workers),
+            ]
+        )
+        if args.previous and os.path.exists(
+            previous := os.path.join(args.previous, site)
+        ):
+            site_args.previous = previous
+        start = time.time()
+        preprocess.main(site_args)
+        with open(os.path.join(output, DONE_FILE), "w") as wf:
+            wf.write(f"{time.time() - start:.1f}\n")
+        logger.info(
+            f"Finished {site} in {time.time() - start:.1f}s with {job.processes} processor(s)."
+        )
+
+
+def main(args, preprocess_args):
+    logger = logs.configure_logging("stackexchange")
+    # Catch bad arguments before starting any sites.
+    preprocess.parser.parse_args(preprocess_args)
+    sizes = {}
+    for site in sorted(os.listdir(args.dumps)):
+        if not os.path.isdir(os.path.join(args.dumps, site)) or site in args.exclude:
+            continue
+        if not args.force and is_done(args.output, site):
+            logger.info(f"Skipping {site} as it has already been processed.")
+            continue
+        sizes[site] = dump_size(os.path.join(args.dumps, site))
+    if not sizes:
+        logger.info("All sites have already been processed.")
+        return
+    pending = plan_jobs(sizes, args.processes, args.small_site, args.pack_size)
+    logger.info(
+        f"Processing {len(sizes)} sites ({sum(sizes.values()) / 1e9:.2f}GB) as {len(pending)} jobs on {args.processes} processors."
+    )
+
+    # Start the largest jobs that fit in the free processors, then wait for a
+    # job to finish so another can take its place.
+    ctx = mp.get_context("spawn")
+    running = {}
+    free = args.processes
+    failed = []
+    start = time.time()
+    while pending or running:
+        for job in list(pending):
+            if job.processes <= free:
+                process = ctx.Process(
+                    target=run_job, args=(job, args, preprocess_args), name=job.sites[0]
+                )
+                process.start()
+                running[process.sentinel] = (process, job)
+                free -= job.processes
+                pending.remove(job)
+        for sentinel in mp.connection.wait(list(running)):
+            process, job = running.pop(sentinel)
+            process.join()
+            free += job.processes
+            if process.exitcode != 0:
+                logger.error(
+                    f"Processing {job.sites} failed with exit code {process.exitcode}."
+                )
+                failed.extend(s for s in job.sites if not is_done(args.output, s))
+    logger.info(f"Processed all sites in {time.time() - start:.1f}s.")
+    if failed:
+        raise RuntimeError(f"Failed to process: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    args, preprocess_args = parser.parse_known_args()
+    main(args, preprocess_args)
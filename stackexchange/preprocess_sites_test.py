@@ -0,0 +1,58 @@
+"""Tests for scheduling stack exchange sites."""
+
+import random
+
+import pytest
+from preprocess_sites import plan_jobs
+
+
+def test_plan_jobs_shares_processes_by_size():
+    sizes = {"large": 600, "medium": 300, "small": 100}
+    jobs = plan_jobs(sizes, processes=10, small_site=1)
+    assert [(j.sites, j.processes) for j in jobs] == [
+        (["large"], 6),
+        (["medium"], 3),
+        (["small"], 1),
+    ]
+
+
+def test_plan_jobs_packs_small_sites():
+    sizes = {"large": 1000, **{f"tiny{i}": 10 for i in range(10)}, "small": 40}
+    jobs = plan_jobs(sizes, processes=4, small_site=100, pack_size=50)
+    assert jobs[0].sites == ["large"]
+    # Its share is 3.5 processors, the rest of one is left for the small sites.
+    assert jobs[0].processes == 3
+    packs = jobs[1:]
+    assert all(j.processes == 1 and j.size <= 50 for j in packs)
+    assert sorted(s for j in packs for s in j.sites) == sorted(set(sizes) - {"large"})
+    assert len(packs) == 3
+
+
+def test_plan_jobs_is_largest_first():
+    sizes = {f"site{i}": i for i in range(1, 50)}
+    jobs = plan_jobs(sizes, processes=8, small_site=20)
+    assert [j.size for j in jobs] == sorted((j.size for j in jobs), reverse=True)
+    assert all(1 <= j.processes <= 8 for j in jobs)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_plan_jobs_stays_within_the_budget(seed):
+    rng = random.Random(seed)
+    processes = rng.randint(1, 64)
+    sizes = {f"site{i}": int(rng.paretovariate(0.8) * 10) for i in range(200)}
+    jobs = plan_jobs(sizes, processes=processes, small_site=100)
+    total = sum(sizes.values())
+    # The sites with a share of the processors all run at the same time.
+    large = [j for j in jobs if j.size >= 100 and processes * j.size >= total]
+    assert sum(j.processes for j in large) <= processes
+    assert all(j.processes == 1 for j in jobs if j not in large)
+    assert sorted(s for j in jobs for s in j.sites) == sorted(sizes)
+
+
+def test_plan_jobs_packs_are_small_enough_to_fill_the_tail():
+    sizes = {"a": 400, "b": 300, "c": 300, "d": 200, **{f"t{i}": 4 for i in range(300)}}
+    jobs = plan_jobs(sizes, processes=16, small_site=50)
+    ideal = sum(sizes.values()) / 16
+    assert sum(j.processes for j in jobs if j.processes > 1) <= 16
+    packs = [j for j in jobs if len(j.sites) > 1]
+    assert packs and all(j.size <= ideal / 4 for j in packs)
@@ -7,9 +7,45 @@ answers were accepted, the sort would be result in the being in the same order
 they were in originally.
 """
 
+import functools
+import glob
+import gzip
+import json
+import os
+import pickle
 import random
+import xml.etree.ElementTree as ET
 
-from preprocess import Answer, vote_sort
+import pytest
+from preprocess import (
+    ANSWER,
+    QUESTION,
+    Answer,
+    Comment,
+    Question,
+    count_votes,
+    date_to_iso,
+    enrichment_metadata,
+    fingerprint_post,
+    format_dolma,
+    format_shard,
+    get_date,
+    license_from_id,
+    main,
+    merge_votes,
+    parse_tags,
+    parser,
+    process_link,
+    process_post,
+    process_vote,
+    read_fingerprints,
+    stackexchange_license,
+    vote_sort,
+    write_fingerprints,
+)
+
+from licensed_pile import metrics, store
+from licensed_pile.licenses import PermissiveLicenses
 
 
 def test_vote_sort_low_accepted_is_first():
@@ -57,3 +93,355 @@ def test_vote_sort_no_accepted_is_ordered():
     for answer in vote_sort(answers):
         assert answer.score <= prev_score
         prev_score = answer.score
+
+
+def test_dates_and_licenses_round_trip():
+    date = get_date("2013-05-07T20:55:35.123")
+    assert isinstance(date, int)
+    assert date_to_iso(date) == "2013-05-07T20:55:35"
+    assert get_date("1969-12-31T23:59:59.000") == -1
+    license = stackexchange_license("CC BY-SA 3.0")
+    assert isinstance(license, int)
+    assert license_from_id(license) == PermissiveLicenses.CC_BY_SA_3
+    assert license_from_id(stackexchange_license("Other")) == "Other"
+
+
+def test_posts_pickle_compactly():
+    comment = Comment(
+        text="hi",
+        date=get_date("2013-05-07T20:55:35"),
+        license=stackexchange_license("CC BY-SA 4.0"),
+        author=("user1",),
+    )
+    assert pickle.loads(pickle.dumps(comment)) == comment
+    # No field names or license text are pickled.
+    assert b"author" not in pickle.dumps(comment)
+    assert b"Creative" not in pickle.dumps(comment)
+
+
+def test_process_post_classifies_rows():
+    common = 'CreationDate="2013-05-07T20:55:35.123" ContentLicense="CC BY-SA 3.0"'
+    question = ET.fromstring(
+        f'<row Id="1" PostTypeId="1" Title="T" Body="&lt;p&gt;Q&lt;/p&gt;" {common} />'
+    )
+    answer = ET.fromstring(
+        f'<row Id="2" PostTypeId="2" ParentId="1" Score="3" Body="A" {common} />'
+    )
+    wiki = ET.fromstring(f'<row Id="3" PostTypeId="5" Body="W" {common} />')
+    kind, (post_id, text, *_) = process_post(question)
+    assert (kind, post_id, text) == (QUESTION, "1", "T\nQ")
+    kind, (question_id, answer_id, text, _, score, _) = process_post(answer)
+    assert (kind, question_id, answer_id, text, score) == (ANSWER, "1", "2", "A", 3)
+    assert process_post(wiki) == (None, None)
+
+
+def test_fingerprint_post_changes_with_activity():
+    question = {"Id": "1", "PostTypeId": "1", "AcceptedAnswerId": "2"}
+    answer = {"Id": "2", "PostTypeId": "2", "ParentId": "1", "Score": "3"}
+    post_id, question_id, question_hash = fingerprint_post(question)
+    assert (post_id, question_id) == ("1", "1")
+    assert fingerprint_post(dict(question))[2] == question_hash
+    edited = {**question, "LastActivityDate": "2024-01-01T00:00:00.000"}
+    assert fingerprint_post(edited)[2] != question_hash
+    post_id, question_id, answer_hash = fingerprint_post(answer)
+    assert (post_id, question_id) == ("2", "1")
+    assert fingerprint_post({**answer, "Score": "4"})[2] != answer_hash
+    assert fingerprint_post({"Id": "3", "PostTypeId": "5"}) == (None, None, None)
+
+
+def test_fingerprints_round_trip(tmp_path):
+    path = tmp_path / "fingerprints.tsv.gz"
+    fingerprints = {"1": 2**64 - 1, "7": 0}
+    options = {"sort": "votes", "include_comments": True}
+    write_fingerprints(path, fingerprints, options)
+    assert read_fingerprints(path, options) == fingerprints
+    # Documents made with other options can't be reused.
+    assert read_fingerprints(path, {**options, "sort": "time"}) == {}
+    assert read_fingerprints(tmp_path / "missing.tsv.gz", options) == {}
+
+
+def test_format_shard_reads_from_stores(tmp_path):
+    date = get_date("2013-05-07T20:55:35")
+    license = stackexchange_license("CC BY-SA 4.0")
+    os.makedirs(tmp_path / "documents")
+    with store.SQLiteStore(tmp_path / "questions.sqlite") as questions:
+        for question_id in ("1", "2"):
+            questions.append(
+                question_id,
+                Question(
+                    text=f"Q{question_id}",
+                    id=question_id,
+                    authors=("a",),
+                    comments=[],
+                    date=date,
+                    license=license,
+                    accepted_answer="11",
+                ),
+            )
+    with store.SQLiteStore(tmp_path / "answers.sqlite") as answers:
+        for answer_id, score in (("10", 5), ("11", 1)):
+            answers.append(
+                "1",
+                (
+                    answer_id,
+                    Answer(
+                        text=f"A{answer_id}",
+                        authors=("b",),
+                        comments=[],
+                        date=date,
+                        license=license,
+                        score=score,
+                        accepted=False,
+                    ),
+                ),
+            )
+    written = format_shard(
+        (3, ["1", "2"]),
+        output=str(tmp_path),
+        sort_answers=vote_sort,
+        format_example=functools.partial(format_dolma, site="x.com", extra_metadata={}),
+    )
+    assert written == 2
+    with gzip.open(tmp_path / "documents" / "00003_se.jsonl.gz", "rt") as f:
+        documents = [json.loads(line) for line in f]
+    # The accepted answer is first.
+    assert [d["text"] for d in documents] == ["Q1\nA11\nA10", "Q2"]
+    assert documents[0]["metadata"]["authors"] == ["a", "b"]
+
+
+@pytest.mark.parametrize(
+    "tags,expected",
+    [
+        ("<python><regex>", ("python", "regex")),
+        ("|python|regex|", ("python", "regex")),
+        ("<c++>", ("c++",)),
+        ("", ()),
+        (None, ()),
+    ],
+)
+def test_parse_tags(tags, expected):
+    assert parse_tags(tags) == expected
+
+
+def test_votes_are_counted_in_batches():
+    votes = [
+        process_vote({"PostId": post_id, "VoteTypeId": vote_type})
+        for post_id, vote_type in [
+            ("1", "2"),
+            ("2", "2"),
+            ("1", "3"),
+            ("1", "2"),
+            ("2", "16"),
+            ("3", "5"),
+        ]
+    ]
+    counts = list(count_votes(votes, max_posts=2))
+    # Counts for the first post are split across batches.
+    assert [post_id for post_id, _ in counts] == ["1", "2", "1", "3"]
+    by_post = {}
+    for post_id, count in counts:
+        by_post.setdefault(post_id, []).append(count)
+    assert merge_votes(by_post["1"]) == {"down": 1, "up": 2}
+    assert merge_votes(by_post["2"]) == {"up": 1}
+    assert merge_votes(by_post["3"]) == {"favorite": 1}
+
+
+def test_enrichment_metadata():
+    links = [
+        process_link({"PostId": "1", "LinkTypeId": "1", "RelatedPostId": "10"}),
+        process_link({"PostId": "1", "LinkTypeId": "3", "RelatedPostId": "4"}),
+        process_link({"PostId": "1", "LinkTypeId": "1", "RelatedPostId": "9"}),
+    ]
+    assert process_link({"PostId": "1", "LinkTypeId": "2"}) == (None, None, None)
+    question = Question(
+        text="",
+        id="1",
+        authors=(),
+        comments=[],
+        date=0,
+        license=0,
+        accepted_answer=None,
+        tags=("python",),
+        links=tuple((kind, related) for _, kind, related in links),
+        votes={"up": 3},
+    )
+    assert enrichment_metadata(question) == {
+        "tags": ["python"],
+        "linked": ["9", "10"],
+        "duplicate_of": ["4"],
+        "votes": {"up": 3},
+    }
+    question.tags = question.links = question.votes = None
+    assert enrichment_metadata(question) == {}
+
+
+def post(id, type, body, **attributes):
+    attributes = "".join(f' {k}="{v}"' for k, v in attributes.items())
+    return (
+        f'<row Id="{id}" PostTypeId="{type}" Body="&lt;p&gt;{body}&lt;/p&gt;" '
+        'CreationDate="2013-05-07T20:55:35.000" LastActivityDate="2013-05-09T20:55:35.000" '
+        f'ContentLicense="CC BY-SA 3.0"{attributes} />'
+    )
+
+
+# Three questions, with answers, comments, links, and votes.
+DUMP = {
+    "Users.xml": (
+        '<row Id="1" DisplayName="alice" />',
+        '<row Id="2" DisplayName="bob" />',
+    ),
+    "Posts.xml": (
+        post(
+            1,
+            1,
+            "How?",
+            Title="A question",
+            AcceptedAnswerId=3,
+            Score=3,
+            Tags="&lt;python&gt;",
+        ),
+        post(2, 2, "Like this.", ParentId=1, Score=5),
+        post(3, 2, "Or this.", ParentId=1, Score=1),
+        post(
+            4, 1, "Why?", Title="Another question", Score=0, Tags="&lt;c&gt;&lt;go&gt;"
+        ),
+        post(5, 2, "Because.", ParentId=4, Score=2),
+        post(6, 1, "When?", Title="A third question", Score=1),
+    ),
+    "Comments.xml": (
+        '<row Id="1" PostId="1" UserId="2" Text="Good question" '
+        'CreationDate="2013-05-07T21:55:35.000" ContentLicense="CC BY-SA 3.0" />',
+        '<row Id="2" PostId="5" UserId="1" Text="Thanks" '
+        'CreationDate="2013-05-08T21:55:35.000" ContentLicense="CC BY-SA 3.0" />',
+    ),
+    "PostHistory.xml": (
+        '<row Id="1" PostId="1" />',
+        '<row Id="2" PostId="2" />',
+        '<row Id="2" PostId="3" />',
+        '<row Id="1" PostId="4" />',
+        '<row Id="2" PostId="5" />',
+        '<row Id="1" PostId="6" />',
+    ),
+    "PostLinks.xml": (
+        '<row Id="1" PostId="1" LinkTypeId="1" RelatedPostId="4" />',
+        '<row Id="2" PostId="6" LinkTypeId="3" RelatedPostId="1" />',
+    ),
+    "Votes.xml": (
+        '<row Id="1" PostId="1" VoteTypeId="2" />',
+        '<row Id="2" PostId="1" VoteTypeId="2" />',
+        '<row Id="3" PostId="4" VoteTypeId="3" />',
+        '<row Id="4" PostId="6" VoteTypeId="5" />',
+    ),
+}
+
+
+def write_dump(site, dump=DUMP):
+    os.makedirs(site, exist_ok=True)
+    for file_name, rows in dump.items():
+        with open(os.path.join(site, file_name), "w") as wf:
+            wf.write("\n".join(["<rows>", *rows, "</rows>"]))
+
+
+def read_documents(output, added=False):
+    """The documents in `output` by id, without the time they were added."""
+    documents = {}
+    for path in glob.glob(os.path.join(output, "documents", "*.jsonl.gz")):
+        with gzip.open(path, "rt") as f:
+            for line in f:
+                document = json.loads(line)
+                if not added:
+                    del document["added"]
+                documents[document["id"]] = document
+    return documents
+
+
+def run_preprocess(site, output, *flags):
+    main(
+        parser.parse_args(
+            [f"--input={site}", f"--output={output}", "--processes=0", *flags]
+        )
+    )
+    return read_documents(output)
+
+
+@pytest.mark.parametrize("profile", ["sample", "cprofile"])
+def test_profile_without_worker_processes(tmp_path, profile):
+    write_dump(tmp_path / "site.com")
+    output = tmp_path / "output"
+    documents = run_preprocess(tmp_path / "site.com", output, f"--profile={profile}")
+    assert (
+        documents["1"]["text"]
+        == "A question\nHow?\nGood question\n\nOr this.\nLike this."
+    )
+    assert sorted(documents) == ["1", "4", "6"]
+    assert any(f.startswith("profile.") for f in os.listdir(output))
+
+
+def test_enrichment_stores_are_only_made_when_used(tmp_path):
+    write_dump(tmp_path / "site.com")
+    plain = run_preprocess(tmp_path / "site.com", tmp_path / "plain", "--store=sqlite")
+    assert not {"links.sqlite", "votes.sqlite"} & set(os.listdir(tmp_path / "plain"))
+    assert "votes" not in plain["1"]["metadata"]
+    enriched = run_preprocess(
+        tmp_path / "site.com",
+        tmp_path / "enriched",
+        "--store=sqlite",
+        "--enrich",
+        "tags",
+        "links",
+        "votes",
+    )
+    assert {"links.sqlite", "votes.sqlite"} <= set(os.listdir(tmp_path / "enriched"))
+    assert enriched["1"]["metadata"]["votes"] == {"up": 2}
+    assert enriched["1"]["metadata"]["linked"] == ["4"]
+    assert enriched["6"]["metadata"]["duplicate_of"] == ["1"]
+    assert enriched["4"]["metadata"]["tags"] == ["c", "go"]
+
+
+@pytest.mark.parametrize("enrich", [[], ["--enrich", "tags", "links", "votes"]])
+def test_join_matches_lookups(tmp_path, enrich):
+    write_dump(tmp_path / "site.com")
+    lookup = run_preprocess(tmp_path / "site.com", tmp_path / "lookup", *enrich)
+    # A tiny sort buffer so the external sorts spill to disk and are merged.
+    metrics.reset()
+    joined = run_preprocess(
+        tmp_path / "site.com", tmp_path / "join", "--join", "--sort_buffer=2", *enrich
+    )
+    assert metrics.get_metrics().counters["external_sort/runs"] > 2
+    assert joined == lookup
+    assert sorted(joined) == ["1", "4", "6"]
+
+
+@pytest.mark.parametrize("mode", [[], ["--join"]])
+def test_previous_only_rewrites_changed_questions(tmp_path, mode):
+    write_dump(tmp_path / "old" / "site.com")
+    run_preprocess(
+        tmp_path / "old" / "site.com", tmp_path / "v0", "--fingerprints", *mode
+    )
+    # An answer to the second question is edited in the new dump.
+    posts = list(DUMP["Posts.xml"])
+    posts[4] = post(
+        5,
+        2,
+        "Because it is.",
+        ParentId=4,
+        Score=2,
+        LastEditDate="2014-01-01T00:00:00.000",
+    )
+    write_dump(tmp_path / "new" / "site.com", {**DUMP, "Posts.xml": posts})
+    run_preprocess(
+        tmp_path / "new" / "site.com",
+        tmp_path / "v1",
+        "--fingerprints",
+        "--previous",
+        str(tmp_path / "v0"),
+        *mode,
+    )
+    before = read_documents(tmp_path / "v0", added=True)
+    after = read_documents(tmp_path / "v1", added=True)
+    # Unchanged documents are copied as is, so they keep the time they were added.
+    assert [i for i in sorted(after) if after[i] != before[i]] == ["4"]
+    assert "Because it is.\nThanks" in after["4"]["text"]
+    # The output is the same as processing the new dump from scratch.
+    fresh = run_preprocess(tmp_path / "new" / "site.com", tmp_path / "fresh", *mode)
+    assert read_documents(tmp_path / "v1") == fresh
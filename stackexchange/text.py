@@ -0,0 +1,294 @@
+"""Convert Stack Exchange html bodies and markdown comments into plain text.
+
+The text is the same as what BeautifulSoup's `get_text` gives for the html (or
+for the html that markdown-it renders from the markdown) but we don't build a
+tree of the document. Html is streamed through a tokenizer and markdown is
+converted straight from the markdown-it tokens, skipping the html entirely.
+
+To match BeautifulSoup's output we copy how it builds strings:
+  * Text between two tags is a single string, if it is only whitespace it is
+    replaced with a single newline or space (unless it is inside a <pre> or
+    <textarea>).
+  * Comments, declarations, processing instructions, and the contents of
+    <script>, <style>, and <template> tags are not text.
+  * Entities are converted the same way, including its quirks like leaving
+    unknown entities as is (minus the semicolon).
+"""
+
+import re
+from html.entities import html5
+from html.parser import HTMLParser
+from typing import List, Sequence
+
+from markdown_it import MarkdownIt
+from markdown_it.token import Token
+
+# Use over commonmark library as that is deprecated and has errors parsing stack overflow.
+MD = MarkdownIt("commonmark", {"breaks": True, "html": True})
+
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+# Strings inside these tags keep their whitespace.
+PRESERVE_WHITESPACE_TAGS = frozenset(("pre", "textarea"))
+# Strings inside these tags are not included in the text.
+SKIPPED_TAGS = frozenset(("script", "style", "template"))
+# Tags that can't have children, so they are closed as soon as they are opened.
+EMPTY_ELEMENT_TAGS = frozenset(
+    (
+        "area",
+        "base",
+        "br",
+        "col",
+        "embed",
+        "hr",
+        "img",
+        "input",
+        "keygen",
+        "link",
+        "menuitem",
+        "meta",
+        "param",
+        "source",
+        "track",
+        "wbr",
+        "basefont",
+        "bgsound",
+        "command",
+        "frame",
+        "image",
+        "isindex",
+        "nextid",
+        "spacer",
+    )
+)
+ENTITIES = {
+    name[:-1]: character for name, character in html5.items() if name.endswith(";")
+}
+_DECIMAL_REFERENCE = re.compile("^([0-9]+)(.*)")
+_HEX_REFERENCE = re.compile("^([0-9a-f]+)(.*)")
+
+
+def numeric_reference(number: int) -> str:
+    """Convert a numeric character reference into a character, like the html spec."""
+    if number == 0 or number > 0x10FFFF or 0xD800 <= number <= 0xDFFF:
+        return "\ufffd"
+    # References to these are assumed to be in Windows-1252.
+    if 0x80 <= number <= 0x9F:
+        try:
+            return bytes((number,)).decode("cp1252")
+        except UnicodeDecodeError:
+            pass
+    return chr(number)
+
+
+class TextExtractor(HTMLParser):
+    """Collect the strings of text from an html document.
+
+    The handle_* methods can also be called directly to build the text of a
+    document without having to create (and then parse) the html.
+    """
+
+    def __init__(self):
+        # We convert the references ourselves to match BeautifulSoup.
+        super().__init__(convert_charrefs=False)
+
+    def reset(self):
+        super().reset()
+        self.strings: List[str] = []
+        self._data: List[str] = []
+        self._open_tags: List[str] = []
+        self._closed_empty_tags: List[str] = []
+        self._preserve = 0
+        self._skip = 0
+
+    def text(self) -> str:
+        self._end_string()
+        return "".join(self.strings)
+
+    def _end_string(self, is_text: bool = True):
+        if not self._data:
+            return
+        data = "".join(self._data)
+        self._data = []
+        # markdown-it can add empty text tokens, html never has empty strings.
+        if not data:
+            return
+        if not self._preserve and not data.strip(ASCII_SPACES):
+            data = "\n" if "\n" in data else " "
+        if is_text and not self._skip:
+            self.strings.append(data)
+
+    def _start(self, tag):
+        self._end_string()
+        if tag in EMPTY_ELEMENT_TAGS:
+            return False
+        self._open_tags.append(tag)
+        self._preserve += tag in PRESERVE_WHITESPACE_TAGS
+        self._skip += tag in SKIPPED_TAGS
+        return True
+
+    def _end(self, tag):
+        self._end_string()
+        # Closing a tag closes everything opened inside of it, end tags without
+        # a start tag are ignored.
+        if tag not in self._open_tags:
+            return
+        while (open_tag := self._open_tags.pop()) != tag:
+            self._close(open_tag)
+        self._close(open_tag)
+
+    def handle_starttag(self, tag, attrs):
+        if not self._start(tag):
+            # Tags like <br> are closed right away, so an explicit </br> that
+            # follows is skipped (it doesn't even end the current string).
+            self._closed_empty_tags.append(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self._closed_empty_tags:
+            self._closed_empty_tags.remove(tag)
+            return
+        self._end(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        # Tags like <br/>
+        self._start(tag)
+        self._end(tag)
+
+    def _close(self, tag):
+        self._preserve -= tag in PRESERVE_WHITESPACE_TAGS
+        self._skip -= tag in SKIPPED_TAGS
+
+    def handle_data(self, data):
+        self._data.append(data)
+
+    def handle_entityref(self, name):
+        self._data.append(ENTITIES.get(name, f"&{name}"))
+
+    def handle_charref(self, name):
+        pattern = _DECIMAL_REFERENCE
+        base = 10
+        if name.startswith(("x", "X")):
+            name = name[1:]
+            pattern = _HEX_REFERENCE
+            base = 16
+        try:
+            self._data.append(numeric_reference(int(name, base)))
+        except ValueError:
+            # A reference without a semicolon, followed by regular text.
+            if (m := pattern.search(name)) is not None:
+                self._data.append(numeric_reference(int(m.group(1), base)))
+                self._data.append(m.group(2))
+            else:
+                self._data.append(name)
+
+    def _not_text(self, data):
+        self._end_string()
+        self._data.append(data)
+        self._end_string(is_text=False)
+
+    handle_comment = _not_text
+    handle_decl = _not_text
+    handle_pi = _not_text
+
+    def unknown_decl(self, data):
+        if data.upper().startswith("CDATA["):
+            self._end_string()
+            self._data.append(data[len("CDATA[") :])
+            self._end_string()
+        else:
+            self._not_text(data)
+
+
+# Each process reuses a single parser, it is reset before each document.
+_EXTRACTOR = TextExtractor()
+
+
+def html_to_text(html: str) -> str:
+    """The text in an html document, the same as BeautifulSoup(html).get_text()."""
+    _EXTRACTOR.reset()
+    _EXTRACTOR.feed(html)
+    _EXTRACTOR.close()
+    return _EXTRACTOR.text()
+
+
+# Tokens that contain raw html, we fall back to rendering and parsing the html
+# when we see them.
+_HTML_TOKENS = frozenset(("html_block", "html_inline"))
+
+
+def _needs_newline(tokens: Sequence[Token], i: int) -> bool:
+    """Does markdown-it add a newline after this tag?"""
+    token = tokens[i]
+    if not token.block:
+        return False
+    if token.nesting == 1 and i + 1 < len(tokens):
+        next_token = tokens[i + 1]
+        if next_token.type == "inline" or next_token.hidden:
+            return False
+        if next_token.nesting == -1 and next_token.tag == token.tag:
+            return False
+    return True
+
+
+def _render_tokens(tokens: Sequence[Token], extractor: TextExtractor):
+    """Mirror markdown-it's html renderer, but send the tags and text to `extractor`."""
+    for i, token in enumerate(tokens):
+        kind = token.type
+        if kind == "inline":
+            _render_tokens(token.children or (), extractor)
+        elif kind == "text":
+            extractor.handle_data(token.content)
+        elif kind in ("softbreak", "hardbreak"):
+            # Softbreaks are rendered as <br /> as we set `breaks`.
+            extractor.handle_startendtag("br", [])
+            extractor.handle_data("\n")
+        elif kind == "code_inline":
+            extractor.handle_starttag("code", [])
+            extractor.handle_data(token.content)
+            extractor.handle_endtag("code")
+        elif kind in ("code_block", "fence"):
+            extractor.handle_starttag("pre", [])
+            extractor.handle_starttag("code", [])
+            extractor.handle_data(token.content)
+            extractor.handle_endtag("code")
+            extractor.handle_endtag("pre")
+            extractor.handle_data("\n")
+        elif token.hidden:
+            continue
+        else:
+            if token.block and token.nesting != -1 and i and tokens[i - 1].hidden:
+                extractor.handle_data("\n")
+            if token.nesting == 1:
+                extractor.handle_starttag(token.tag, [])
+            elif token.nesting == -1:
+                extractor.handle_endtag(token.tag)
+            else:
+                # Like <hr /> or <img />
+                extractor.handle_startendtag(token.tag, [])
+            if _needs_newline(tokens, i):
+                extractor.handle_data("\n")
+
+
+def _has_html(tokens: Sequence[Token]) -> bool:
+    return any(
+        t.type in _HTML_TOKENS or (t.children and _has_html(t.children)) for t in tokens
+    )
+
+
+# Characters that might be markdown syntax anywhere in a line, and the starts of
+# lines that might be a list item.
+_MARKDOWN_SYNTAX = re.compile(r"[\\`*_\[\]<>&!#~\n\r\x00]|^(?:[-+]|\d+[.)])")
+
+
+def markdown_to_text(markdown: str) -> str:
+    """The text in a markdown document, the same as BeautifulSoup(MD.render(markdown)).get_text()."""
+    # Most comments are a single line of plain text, which markdown renders as
+    # a paragraph.
+    if markdown == markdown.strip() and not _MARKDOWN_SYNTAX.search(markdown):
+        return f"{markdown}\n" if markdown else ""
+    env = {}
+    tokens = MD.parse(markdown, env)
+    if _has_html(tokens):
+        return html_to_text(MD.renderer.render(tokens, MD.options, env))
+    _EXTRACTOR.reset()
+    _render_tokens(tokens, _EXTRACTOR)
+    return _EXTRACTOR.text()
@@ -0,0 +1,110 @@
+"""Tests for converting html and markdown to text.
+
+The expected outputs are what BeautifulSoup(..., "html.parser").get_text() gives,
+which is what we used before. When bs4 is installed, random documents are also
+checked against it.
+"""
+
+import random
+
+import pytest
+from text import MD, html_to_text, markdown_to_text
+
+HTML_GOLDEN = [
+    ("<p>Hello <b>world</b></p>", "Hello world"),
+    ("<p>a</p>\n\n<p>b</p>\n", "a\nb\n"),
+    ("<ul>\n  <li>one</li>\n  <li>two</li>\n</ul>", "\none\ntwo\n"),
+    ("<pre><code>x = 1\n\n  y = 2\n</code></pre>", "x = 1\n\n  y = 2\n"),
+    ("<pre>\n  \n</pre><p> </p>", "\n  \n "),
+    ("a<!-- comment -->b", "ab"),
+    ("<script>var x = '<b>';</script>z<style>p {}</style>", "z"),
+    ("<template>t</template>u", "u"),
+    ("&amp;&lt;&gt;&quot;&#39;&#x27;&nbsp;", "&<>\"''\xa0"),
+    ("&foo; &ampx &#128; &#0;", "&foo &ampx € �"),
+    ("<![CDATA[cd]]>e<!DOCTYPE html><?pi x?>", "cde"),
+    ("a <br>b</br> c<br/>d<img src='x' alt='y'>", "a b cd"),
+    ('<a href="https://x.com/?a=1&b=2">link</a>', "link"),
+    ("<b><pre>x</b> \n </pre>", "x\n"),
+    ("text with < not a tag", "text with < not a tag"),
+    ("", ""),
+]
+
+MARKDOWN_GOLDEN = [
+    ("plain comment", "plain comment\n"),
+    ("", ""),
+    ("use `x = 1` and *this*", "use x = 1 and this\n"),
+    ("see [the docs](http://x.com) **now**", "see the docs now\n"),
+    ("line one\nline two", "line one\nline two\n"),
+    ("- a\n- b\n", "\na\nb\n\n"),
+    ("1. item", "\nitem\n\n"),
+    ("    code block", "code block\n\n"),
+    ("```python\nx = 1\n```", "x = 1\n\n"),
+    ("> quoted", "\nquoted\n\n"),
+    ("# Heading", "Heading\n"),
+    ("&amp; &copy; \\*", "& © *\n"),
+    ("with <b>html</b>", "with html\n"),
+    ("![alt text](http://x.com/i.png)", "\n"),
+    ("  padded  ", "padded\n"),
+]
+
+
+@pytest.mark.parametrize("html,text", HTML_GOLDEN)
+def test_html_to_text(html, text):
+    assert html_to_text(html) == text
+
+
+@pytest.mark.parametrize("markdown,text", MARKDOWN_GOLDEN)
+def test_markdown_to_text(markdown, text):
+    assert markdown_to_text(markdown) == text
+
+
+HTML_FRAGMENTS = [
+    *(html for html, _ in HTML_GOLDEN),
+    "<p>",
+    "</p>",
+    "<pre>",
+    "</pre>",
+    "<textarea>",
+    "</textarea>",
+    "<br>",
+    "</br>",
+    "<li>",
+    "</li>",
+    "\n",
+    "  ",
+    "\r\n",
+    "\t",
+    "text",
+    "&",
+    "<",
+    "</div>",
+]
+MARKDOWN_FRAGMENTS = [
+    *(markdown for markdown, _ in MARKDOWN_GOLDEN),
+    "*",
+    "`",
+    "\n",
+    "\n\n",
+    " ",
+    "- ",
+    "2) ",
+    "text",
+    "[ref]\n\n[ref]: http://x.com\n",
+    "* a\n* b\n\n  c\n",
+    "<!-- c -->",
+    "\\\n",
+]
+
+
+def test_matches_beautifulsoup():
+    bs4 = pytest.importorskip("bs4")
+
+    def get_text(html):
+        return bs4.BeautifulSoup(html, "html.parser").get_text()
+
+    rng = random.Random(1234)
+    for _ in range(500):
+        html = "".join(rng.choices(HTML_FRAGMENTS, k=rng.randint(0, 15)))
+        assert html_to_text(html) == get_text(html), html
+        markdown = "".join(rng.choices(MARKDOWN_FRAGMENTS, k=rng.randint(0, 8)))
+        assert markdown_to_text(markdown) == get_text(MD.render(markdown)), markdown
@@ -7,6 +7,7 @@ import os
 import re
 from tempfile import TemporaryDirectory
 
+from licensed_pile import profiling
 from licensed_pile.logs import configure_logging
 from licensed_pile.write import ShardParallelProcessor
 
@@ -46,6 +47,11 @@ parser.add_argument(
     default=mp.cpu_count(),
     help="Number of processors for multicore.",
 )
+parser.add_argument(
+    "--profile",
+    choices=profiling.PROFILERS,
+    help="Profile each worker, the merged report is written to ${output}/profile.*, next to the documents directory.",
+)
 # This is currently unused, if we filter out chats in the dolma format we will
 # have unbalanced shards. We should have an efficient re-shard tool before we
 # apply this filter.
@@ -128,7 +134,12 @@ def main(args):
             metadata_prefix=tempdir,
             num_processes=args.processes,
         )
-        processors(debug=args.debug, min_lines=args.min_lines)
+        processors(
+            debug=args.debug,
+            min_lines=args.min_lines,
+            profile=args.profile,
+            profile_path=os.path.join(args.output, "profile"),
+        )
 
 
 if __name__ == "__main__":
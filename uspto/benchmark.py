@@ -0,0 +1,348 @@
+"""Measure the USPTO conversion pipeline at several concurrency levels.
+
+The input is either synthetic patents, built from the converted examples in
+`examples/uspto_examples.jsonl` by turning their text back into patent style
+html, or a sample of rows from real parquet files (`--sample-from`). Each
+`--concurrency` level runs the same pipeline as `uspto-to-dolma.py` (stream
+parquet batches, convert them with a `ConversionPool`, write dolma shards) and
+reports rows/sec, the peak RSS of the process and its workers, and the time
+spent in each stage:
+
+  * `startup`: Starting the conversion pool (each worker imports polars).
+  * `scan`: Reading parquet batches.
+  * `convert`: Converting the html columns in the pool.
+  * `concat`: The rest of the polars plan, filtering, cleaning up the text,
+    and concatenating it.
+  * `serialize`: Turning the batches into json lines.
+  * `write`: Compressing and writing the shards (compression overlaps with the
+    other stages, this is only the time the pipeline waited on it).
+
+Results are written as json, `--compare` checks them against a previous run
+like `benchmarks/benchmark.py`.
+"""
+
+import argparse
+import datetime
+import importlib.util
+import io
+import json
+import multiprocessing as mp
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Dict, Iterator, List
+
+import polars as pl
+import pyarrow.parquet as pq
+from patent_examples import example_patent, read_examples
+from utils import ConversionPool
+
+from licensed_pile import logs, metrics
+from licensed_pile.memory import RSSWatchdog
+
+# The pipeline lives in a script whose name isn't a valid module name.
+_spec = importlib.util.spec_from_file_location(
+    "uspto_to_dolma", os.path.join(os.path.dirname(__file__), "uspto-to-dolma.py")
+)
+uspto_to_dolma = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(uspto_to_dolma)
+
+STAGES = ("startup", "scan", "convert", "concat", "serialize", "write")
+
+parser = argparse.ArgumentParser(description="Benchmark the uspto conversion.")
+parser.add_argument(
+    "--data-path",
+    default=None,
+    help="Where the benchmark parquet files live, they are generated there if it doesn't exist. When it isn't given, they are generated in a temporary directory.",
+)
+parser.add_argument(
+    "--sample-from",
+    default=None,
+    help="A directory of real uspto parquet files to sample rows from, instead of synthetic patents.",
+)
+parser.add_argument(
+    "--output",
+    default="data/benchmarks/uspto.json",
+    help="Where to write the benchmark results.",
+)
+parser.add_argument(
+    "--rows", type=int, default=2000, help="How many patents to benchmark on."
+)
+parser.add_argument(
+    "--files", type=int, default=2, help="How many parquet files to split them into."
+)
+parser.add_argument(
+    "--concurrency",
+    type=int,
+    nargs="+",
+    default=sorted({1, max(1, mp.cpu_count() // 2), mp.cpu_count()}),
+    help="The --max-concurrency levels to benchmark.",
+)
+parser.add_argument(
+    "--converter",
+    choices=["python", "pandoc"],
+    default="python",
+    help="Which html converter the pipeline uses.",
+)
+parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=4096,
+    help="Number of rows to read and convert at once, 0 converts whole files at once.",
+)
+parser.add_argument(
+    "--write-threads",
+    type=int,
+    default=4,
+    help="Number of threads used to compress the dolma shards.",
+)
+parser.add_argument(
+    "--repeats", type=int, default=3, help="How many times to run each level."
+)
+parser.add_argument(
+    "--compare", help="Results from a previous run to check for regressions against."
+)
+parser.add_argument(
+    "--tolerance",
+    type=float,
+    default=0.1,
+    help="How much slower (as a fraction) a level can be before it is a regression.",
+)
+
+
+def synthetic_patents(rows: int, seed: int = 0) -> pl.DataFrame:
+    """`rows` patents made by cycling through the examples."""
+    rng = random.Random(seed)
+    examples = [example_patent(e["text"], rng) for e in read_examples()]
+    return pl.DataFrame(
+        [
+            {
+                **examples[i % len(examples)],
+                "title_language": "en",
+                "publication_date": 20230101 + i % 28,
+                "application_number": f"US-{i}-A",
+                "filing_date": 20200101 + i % 28,
+            }
+            for i in range(rows)
+        ],
+        schema_overrides={
+            "publication_date": pl.Int64,
+            "filing_date": pl.Int64,
+            "claims_html": pl.String,
+        },
+    ).select(uspto_to_dolma.COLUMNS)
+
+
+def sampled_patents(data_dir: str, rows: int) -> pl.DataFrame:
+    """The first `rows` patents from the real parquet files in `data_dir`."""
+    return (
+        pl.scan_parquet(sorted(Path(data_dir).glob("*.parquet")))
+        .select(uspto_to_dolma.COLUMNS)
+        .head(rows)
+        .collect()
+    )
+
+
+def write_dataset(df: pl.DataFrame, data_dir: str, files: int):
+    os.makedirs(data_dir, exist_ok=True)
+    rows = -(-len(df) // files)
+    for i, offset in enumerate(range(0, len(df), rows)):
+        df.slice(offset, rows).write_parquet(
+            os.path.join(data_dir, f"part-{i:05d}.parquet")
+        )
+
+
+class TimedPool(ConversionPool):
+    """A `ConversionPool` that records how long the html conversions take."""
+
+    def parallel_apply(self, column: pl.Series) -> pl.Series:
+        with metrics.timer("convert"):
+            return super().parallel_apply(column)
+
+
+def timed_chunks(file_names, pool: ConversionPool, batch_size: int) -> Iterator[bytes]:
+    """`stream_datasets` and `dolma_jsonl` with a timer around each stage."""
+    registry = metrics.get_metrics()
+    for file_name in file_names:
+        if batch_size > 0:
+            batches = pq.ParquetFile(file_name).iter_batches(
+                batch_size=batch_size, columns=list(uspto_to_dolma.COLUMNS)
+            )
+        else:
+            batches = iter(
+                [pq.read_table(file_name, columns=list(uspto_to_dolma.COLUMNS))]
+            )
+        while True:
+            with metrics.timer("scan"):
+                if (batch := next(batches, None)) is None:
+                    break
+                df = pl.from_arrow(batch).lazy()
+            with metrics.timer("transform"):
+                df = uspto_to_dolma.convert_patents(df, pool).collect()
+            registry.increment("rows", len(df))
+            with metrics.timer("serialize"):
+                buffer = io.BytesIO()
+                df.write_ndjson(buffer)
+            yield buffer.getvalue()
+
+
+def run_once(args, data_dir: str, concurrency: int, watchdog: RSSWatchdog) -> Dict:
+    file_names = sorted(Path(data_dir).glob("*.parquet"))
+    with TemporaryDirectory() as output_dir:
+        with watchdog.stage(f"uspto-{concurrency}"):
+            start = time.perf_counter()
+            with TimedPool(concurrency, args.converter) as pool:
+                # Wait for every worker to start so it isn't counted as converting.
+                pool.parallel_apply(pl.Series([""] * pool.processes, dtype=pl.String))
+                startup = time.perf_counter() - start
+                metrics.reset()
+                start = time.perf_counter()
+                uspto_to_dolma.to_dolma_chunks(
+                    timed_chunks(file_names, pool, args.batch_size),
+                    output_dir,
+                    "uspto.jsonl.gz",
+                    threads=args.write_threads,
+                )
+                seconds = time.perf_counter() - start
+        output_bytes = sum(
+            os.path.getsize(os.path.join(output_dir, f)) for f in os.listdir(output_dir)
+        )
+    summary = metrics.get_metrics().summary()
+    stages = {name: stage["seconds"] for name, stage in summary["stages"].items()}
+    rows = summary["counters"].get("rows", 0)
+    return {
+        "seconds": seconds,
+        "rows": rows,
+        "rows_per_second": rows / seconds,
+        "output_bytes": output_bytes,
+        "peak_rss_bytes": summary["histograms"][f"memory/uspto-{concurrency}"]["max"],
+        "stages": {
+            "startup": startup,
+            "scan": stages.get("scan", 0.0),
+            "convert": stages.get("convert", 0.0),
+            "concat": stages.get("transform", 0.0) - stages.get("convert", 0.0),
+            "serialize": stages.get("serialize", 0.0),
+            "write": stages.get("to_dolma/write", 0.0),
+        },
+    }
+
+
+def measure(args, data_dir: str, concurrency: int) -> Dict:
+    runs = []
+    with RSSWatchdog(interval=0.1) as watchdog:
+        for _ in range(args.repeats):
+            runs.append(run_once(args, data_dir, concurrency, watchdog))
+    # The fastest run is the least affected by noise from other processes.
+    best = min(runs, key=lambda r: r["seconds"])
+    return {
+        "benchmark": "uspto",
+        "concurrency": concurrency,
+        **best,
+        "timings": [r["seconds"] for r in runs],
+        "peak_rss_bytes": max(r["peak_rss_bytes"] for r in runs),
+    }
+
+
+def environment(args) -> Dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "date": datetime.datetime.utcnow().isoformat(),
+        "commit": commit,
+        "python": sys.version,
+        "platform": platform.platform(),
+        "cpu_count": mp.cpu_count(),
+        "polars": pl.__version__,
+        "data": args.sample_from or "synthetic",
+        "rows": args.rows,
+        "files": args.files,
+        "converter": args.converter,
+        "batch_size": args.batch_size,
+        "write_threads": args.write_threads,
+        "repeats": args.repeats,
+    }
+
+
+def compare(results: List[Dict], previous: List[Dict], tolerance: float) -> List[str]:
+    """Find concurrency levels whose throughput dropped by more than `tolerance`."""
+    previous = {r["concurrency"]: r for r in previous}
+    regressions = []
+    for result in results:
+        if (old := previous.get(result["concurrency"])) is None:
+            continue
+        ratio = result["rows_per_second"] / old["rows_per_second"]
+        result["relative_throughput"] = ratio
+        if ratio < 1 - tolerance:
+            regressions.append(
+                f"uspto[concurrency={result['concurrency']}] throughput is {ratio:.2f}x the previous run."
+            )
+    return regressions
+
+
+def run_benchmarks(args, data_dir: str) -> List[Dict]:
+    logger = logs.get_logger("benchmarks")
+    if not os.path.exists(data_dir):
+        if args.sample_from:
+            logger.info("Sampling %d patents from %s", args.rows, args.sample_from)
+            df = sampled_patents(args.sample_from, args.rows)
+        else:
+            logger.info("Generating %d synthetic patents", args.rows)
+            df = synthetic_patents(args.rows)
+        write_dataset(df, data_dir, args.files)
+    results = []
+    for concurrency in args.concurrency:
+        logger.info("Running the uspto pipeline with %d workers", concurrency)
+        results.append(measure(args, data_dir, concurrency))
+    return results
+
+
+def main(args):
+    logger = logs.get_logger("benchmarks")
+    if args.data_path is None:
+        with TemporaryDirectory() as data_dir:
+            results = run_benchmarks(args, os.path.join(data_dir, "uspto"))
+    else:
+        results = run_benchmarks(args, args.data_path)
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+
+    report = {"environment": environment(args), "results": results}
+    if dirname := os.path.dirname(args.output):
+        os.makedirs(dirname, exist_ok=True)
+    with open(args.output, "w") as wf:
+        json.dump(report, wf, indent=2)
+    logger.info("Wrote benchmark results to %s", args.output)
+
+    print(
+        f"{'workers':>8} {'rows/s':>10} {'peak RSS':>10} "
+        + " ".join(f"{stage:>9}" for stage in STAGES)
+    )
+    for result in results:
+        print(
+            f"{result['concurrency']:>8} {result['rows_per_second']:>10,.1f} "
+            f"{result['peak_rss_bytes'] / 1e9:>8.2f}GB "
+            + " ".join(f"{result['stages'][stage]:>8.2f}s" for stage in STAGES)
+        )
+    for regression in regressions:
+        logger.error(regression)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    mp.set_start_method("spawn")
+    args = parser.parse_args()
+    logs.configure_logging("benchmarks")
+    main(args)
@@ -0,0 +1,75 @@
+"""Patent style html rebuilt from the converted examples in `examples/`.
+
+The examples are the text the pipeline outputs, these turn them back into
+html like the raw data so the converter can be tested and benchmarked without
+downloading the dataset.
+"""
+
+import json
+import os
+import random
+import re
+from typing import Dict, List, Optional
+
+
+def read_examples() -> List[Dict]:
+    """The examples are json objects written one after another, not one per line."""
+    path = os.path.join(os.path.dirname(__file__), "examples", "uspto_examples.jsonl")
+    with open(path) as f:
+        data = f.read()
+    decoder = json.JSONDecoder()
+    examples = []
+    position = 0
+    while (position := len(data) - len(data[position:].lstrip())) < len(data):
+        example, position = decoder.raw_decode(data, position)
+        examples.append(example)
+    return examples
+
+
+def example_html(text: str, rng: random.Random, section: str = "description") -> str:
+    """Rebuild patent style html from the text of an example."""
+    parts = [f'<div class="{section}">']
+    for i, line in enumerate(line.strip() for line in text.split("\n")):
+        if not line:
+            continue
+        line = line.replace("&", "&amp;").replace("<", "&lt;")
+        if line.isupper():
+            parts.append(f'<heading id="h-{i:04d}">{line}</heading>')
+            continue
+        words = line.split(" ")
+        nonempty = [j for j, word in enumerate(words) if word]
+        for j in rng.sample(nonempty, k=min(3, len(nonempty))):
+            tag = rng.choice(["i", "b", "sub", "sup", "figref"])
+            words[j] = f"<{tag}>{words[j]}</{tag}>"
+        # Wrap the source like the raw data.
+        line = "\n".join(" ".join(words[j : j + 12]) for j in range(0, len(words), 12))
+        if re.match(r"\d+\. ", line):
+            parts.append(
+                f'<div class="claim"><div class="claim-text">{line}</div></div>'
+            )
+        else:
+            parts.append(f'<p num="{i:04d}">{line}</p>')
+        if rng.random() < 0.02:
+            parts.append(
+                "<tables><table><tr><th>Layer</th><th>nm</th></tr>"
+                "<tr><td>oxide</td><td>10</td></tr></table></tables>"
+            )
+    parts.append("</div>")
+    return "\n".join(parts)
+
+
+def example_patent(text: str, rng: random.Random) -> Dict[str, Optional[str]]:
+    """Split the text of an example into the columns of the raw data."""
+    title, _, rest = text.partition("\n\n")
+    _, _, rest = rest.partition("ABSTRACT\n\n")
+    abstract, _, rest = rest.partition("\n")
+    # The claims are the numbered paragraphs at the end.
+    claims = list(re.finditer(r"\n\s*1\. ", rest))
+    split = claims[-1].start() if claims else len(rest)
+    description, claims = rest[:split], rest[split:]
+    return {
+        "title_text": title,
+        "abstract_text": abstract.strip(),
+        "description_html": example_html(description, rng),
+        "claims_html": example_html(claims, rng, "claims") if claims else None,
+    }
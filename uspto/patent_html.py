@@ -0,0 +1,471 @@
+"""Convert patent html to the same plain text that pandoc gives, without running pandoc.
+
+Even with a long running pandoc process, pandoc's html reader is slow compared
+to the size of the documents. Patent html only uses a handful of tags
+so we convert it directly, copying what pandoc's html reader and plain writer
+do for them:
+  * Blocks (paragraphs, divs, headings, ...) are separated by a blank line.
+    Inline text that is directly next to a block, like the text of a claim
+    before its nested sub-claims, is a block of its own.
+  * Runs of ascii whitespace become a single space and each block (or line
+    inside a block, split by <br>) is stripped.
+  * Superscripts and subscripts use unicode characters when every character
+    has one, otherwise they are written as ^(...) or _(...).
+  * Tables of single line cells become simple tables, bulleted and numbered
+    lists of short items become tight lists.
+Pandoc wraps lines at 72 characters, but `parse_html` joins lines that are not
+separated by a blank line anyway, so we never wrap. The only places where this
+would change the output are continuation lines with an indent (lists, table
+cells), we don't convert documents where those would wrap.
+
+Anything else (images, math, preformatted text, malformed html, ...) raises
+`Unsupported` inside `html_to_text` and it returns None so the caller can fall
+back to pandoc.
+"""
+
+import re
+import unicodedata
+from html.entities import html5
+from typing import List, Optional
+
+# Formatting tags, plain text doesn't have formatting so only their contents
+# are kept.
+FORMATTING_TAGS = frozenset(
+    (
+        "a",
+        "abbr",
+        "b",
+        "big",
+        "cite",
+        "dfn",
+        "em",
+        "font",
+        "i",
+        "ins",
+        "kbd",
+        "mark",
+        "small",
+        "span",
+        "strong",
+        "u",
+    )
+)
+# Patent specific tags that pandoc doesn't know, so it drops them and parses
+# their contents as if they weren't there. This is true of any tag with a dash
+# in its name too, like <claim-text>.
+PATENT_TAGS = frozenset(
+    ("chemistry", "crossref", "figref", "heading", "nplcit", "o", "patcit", "tables")
+)
+INLINE_TAGS = FORMATTING_TAGS | PATENT_TAGS
+# Tags whose contents are blocks of their own.
+BLOCK_TAGS = frozenset(
+    (
+        "article",
+        "body",
+        "center",
+        "div",
+        "html",
+        "p",
+        "section",
+    )
+)
+SCRIPT_TAGS = frozenset(("sup", "sub"))
+# Tags that can't have children.
+VOID_TAGS = frozenset(("br", "wbr"))
+# Table cell attributes that pandoc uses for the layout.
+CELL_LAYOUT_ATTRIBUTES = frozenset(("align", "colspan", "rowspan", "style", "width"))
+
+SUPERSCRIPTS = {
+    **dict(zip("0123456789", "⁰¹²³⁴⁵⁶⁷⁸⁹")),
+    "+": "⁺",
+    "-": "⁻",
+    "−": "⁻",
+    "=": "⁼",
+    "(": "⁽",
+    ")": "⁾",
+}
+SUBSCRIPTS = {
+    **dict(zip("0123456789", "₀₁₂₃₄₅₆₇₈₉")),
+    "+": "₊",
+    "-": "₋",
+    # Pandoc uses the superscript minus here too.
+    "−": "⁻",
+    "=": "₌",
+    "(": "₍",
+    ")": "₎",
+}
+
+# Pandoc only treats ascii whitespace as spaces, thin spaces etc. are kept.
+_SPACES = re.compile(r"[ \t\n\r\f]+")
+ASCII_SPACES = " \t\n\r\f"
+_TOKENS = re.compile(
+    r"""<(?:
+        (?P<end>/)?(?P<tag>[a-zA-Z][a-zA-Z0-9-]*)
+        (?P<attributes>(?:\s+[^\s"'>/=]+(?:\s*=\s*(?:"[^"]*"|'[^']*'|[^\s"'>]+))?)*)
+        \s*(?P<self_closing>/)?>
+      |!--.*?-->
+    )""",
+    re.S | re.X,
+)
+_ATTRIBUTES = re.compile(
+    r"""([^\s"'>/=]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+)))?"""
+)
+_REFERENCES = re.compile(r"&(?:#[xX]([0-9a-fA-F]+)|#([0-9]+)|([a-zA-Z][a-zA-Z0-9]*));")
+_BARE_AMPERSANDS = re.compile(r"&(?=[ \t\n\r\f]|$)")
+# Pandoc wraps lines that are wider than this.
+MAX_LINE = 72
+
+# Marks a <br> in a list of inline text.
+BR = object()
+# Marks the start or end of a formatting tag.
+EDGE = object()
+
+
+class Unsupported(Exception):
+    """The html uses something we don't convert, use pandoc instead."""
+
+
+def _reference(m: re.Match) -> str:
+    hex_number, number, name = m.groups()
+    if name is not None:
+        if (character := html5.get(f"{name};")) is None:
+            raise Unsupported(f"Unknown entity &{name};")
+        return character
+    number = int(hex_number, 16) if hex_number is not None else int(number)
+    # Pandoc has its own ways of converting nulls, control characters,
+    # surrogates, and the windows-1252 range.
+    if (
+        not (0x20 <= number < 0x7F or 0xA0 <= number <= 0x10FFFF)
+        or 0xD800 <= number <= 0xDFFF
+    ):
+        raise Unsupported(f"Unusual character reference {m.group(0)}")
+    return chr(number)
+
+
+def unescape(text: str) -> str:
+    if "&" not in text:
+        return text
+    # A bare & is only text when nothing that could be a reference follows it.
+    if text.count("&") != len(_REFERENCES.findall(text)) + len(
+        _BARE_AMPERSANDS.findall(text)
+    ):
+        raise Unsupported("& without a reference")
+    return _REFERENCES.sub(_reference, text)
+
+
+def _attributes(attributes: str) -> dict:
+    return {
+        m.group(1).lower(): next((g for g in m.groups()[1:] if g is not None), "")
+        for m in _ATTRIBUTES.finditer(attributes)
+    }
+
+
+def text_width(text: str) -> int:
+    """How many columns pandoc thinks the text takes up."""
+    if text.isascii():
+        return len(text)
+    return sum(
+        (
+            0
+            if unicodedata.combining(c)
+            else 2
+            if unicodedata.east_asian_width(c) in ("W", "F")
+            else 1
+        )
+        for c in text
+    )
+
+
+def _script(tag: str, text: str) -> str:
+    characters = SUPERSCRIPTS if tag == "sup" else SUBSCRIPTS
+    # Spaces (including unicode ones like thin spaces) are kept as they are.
+    if all(c in characters or c.isspace() for c in text):
+        return "".join(characters.get(c, c) for c in text)
+    return f"{'^' if tag == 'sup' else '_'}({text})"
+
+
+def render_inline(inline: List) -> str:
+    """Join inline text, with a newline for each <br> and whitespace collapsed."""
+    pieces = []
+    # The whitespace at the end of the last text and if we've passed the edge
+    # of a formatting tag since.
+    trailing, edge = "", False
+    for item in inline:
+        if item is EDGE:
+            edge = True
+            continue
+        if isinstance(item, str) and edge and trailing:
+            leading = item[: len(item) - len(item.lstrip(ASCII_SPACES))]
+            # Pandoc merges spaces from both sides of the edge, but not newlines
+            # or tabs.
+            if leading and (trailing + leading).strip(" "):
+                raise Unsupported("Whitespace on both sides of a tag")
+        trailing, edge = "", False
+        if isinstance(item, str):
+            trailing = item[len(item.rstrip(ASCII_SPACES)) :]
+        if item is BR:
+            pieces.append("\0")
+        elif isinstance(item, tuple):
+            tag, contents = item
+            if BR in contents:
+                raise Unsupported("<br> inside a script")
+            text = render_inline(contents)
+            # Spaces at the start or end of the script are moved outside it.
+            if text.startswith(" "):
+                pieces.append(" ")
+            if core := text.strip(" "):
+                pieces.append(_script(tag, core))
+            if text.endswith(" "):
+                pieces.append(" ")
+        else:
+            pieces.append(item)
+    return _SPACES.sub(" ", "".join(pieces)).replace("\0", "\n")
+
+
+def _lines(text: str) -> str:
+    """Strip each line of a block, dropping the empty ones."""
+    lines = []
+    for line in text.split("\n"):
+        # Pandoc only strips spaces that are directly in the block. Others, like
+        # a space at the start of a <span>, are dropped unless pandoc wraps there
+        # because the first word doesn't fit on the line.
+        if line.startswith(" ") and text_width(line.split(" ", 2)[1]) >= MAX_LINE - 2:
+            raise Unsupported("Long word at the start of a line")
+        if line := line.strip(" "):
+            lines.append(line)
+    return "\n".join(lines)
+
+
+class _Converter:
+    """Build the blocks of plain text as we walk through the html tags."""
+
+    def __init__(self):
+        self.blocks: List[str] = []
+        self.inline: List = []
+        self.open: List[str] = []
+        # Where the inline text of each open tag starts.
+        self.starts: List[int] = []
+        # The inline text outside of each open <sup> or <sub>.
+        self.scripts: List[List] = []
+        # The rows of an open table, each a list of (cell text, is header) pairs.
+        self.rows: Optional[List[List]] = None
+        self.header = False
+        # If the current table cell or list item has inline tags.
+        self.tagged = False
+        # The items of an open list, and the number of the first one.
+        self.items: Optional[List[str]] = None
+        self.start: Optional[int] = None
+
+    def flush(self):
+        """End the current run of inline text, making it a block."""
+        if not self.inline:
+            return
+        if self.scripts:
+            raise Unsupported("Block inside a script")
+        if self.rows is not None or self.items is not None:
+            if _lines(render_inline(self.inline)):
+                raise Unsupported("Text directly inside a table or list")
+        elif text := _lines(render_inline(self.inline)):
+            self.blocks.append(text)
+        self.inline = []
+
+    def start_tag(self, tag: str, attributes: str):
+        if tag == "br":
+            self.inline.append(BR)
+            return
+        if tag in VOID_TAGS:
+            return
+        if self.scripts and tag not in SCRIPT_TAGS:
+            # Pandoc moves spaces out of some tags but not others, and converts
+            # their contents in different ways.
+            raise Unsupported(f"<{tag}> inside a script")
+        if tag in INLINE_TAGS or "-" in tag:
+            self.tagged = True
+            if tag in FORMATTING_TAGS:
+                self.inline.append(EDGE)
+        elif tag in SCRIPT_TAGS:
+            self.scripts.append(self.inline)
+            self.inline = []
+        elif tag in BLOCK_TAGS:
+            if self.rows is not None or self.items is not None:
+                raise Unsupported(f"<{tag}> inside a table or list")
+            self.flush()
+        elif tag == "table":
+            if self.rows is not None or self.items is not None:
+                raise Unsupported("Nested table")
+            self.flush()
+            self.rows = []
+            self.header = False
+        elif tag in ("thead", "tbody"):
+            if self.rows is None or self.open[-1] != "table":
+                raise Unsupported(f"<{tag}> outside of a table")
+            self.header = tag == "thead"
+        elif tag == "tr":
+            if self.rows is None or self.open[-1] not in ("table", "thead", "tbody"):
+                raise Unsupported("<tr> outside of a table")
+            self.flush()
+            self.rows.append([])
+        elif tag in ("td", "th"):
+            if self.rows is None or self.open[-1] != "tr":
+                raise Unsupported(f"<{tag}> outside of a row")
+            if CELL_LAYOUT_ATTRIBUTES.intersection(_attributes(attributes)):
+                raise Unsupported(f"<{tag}> with a layout")
+            self.flush()
+            self.tagged = False
+        elif tag in ("ul", "ol"):
+            if self.rows is not None or self.items is not None:
+                raise Unsupported("Nested list")
+            self.flush()
+            self.items = []
+            self.start = None
+            if tag == "ol":
+                attributes = _attributes(attributes)
+                if set(attributes) - {"start"}:
+                    raise Unsupported("<ol> with a style")
+                self.start = int(attributes.get("start", "1"))
+        elif tag == "li":
+            if self.items is None or self.open[-1] not in ("ul", "ol") or attributes:
+                raise Unsupported("<li> outside of a list")
+            self.flush()
+            self.tagged = False
+        else:
+            raise Unsupported(f"<{tag}>")
+        self.open.append(tag)
+        self.starts.append(len(self.inline))
+
+    def end_tag(self, tag: str):
+        if tag in VOID_TAGS or tag not in self.open:
+            raise Unsupported(f"</{tag}> without <{tag}>")
+        # Blocks close the tags that were left open inside of them.
+        while True:
+            open_tag = self.open.pop()
+            start = self.starts.pop()
+            # Pandoc keeps extra spaces around formatting without any text.
+            if open_tag in FORMATTING_TAGS:
+                if all(
+                    item is EDGE
+                    or isinstance(item, str)
+                    and not item.strip(ASCII_SPACES)
+                    for item in self.inline[start:]
+                ):
+                    raise Unsupported(f"<{open_tag}> without text")
+                self.inline.append(EDGE)
+            if open_tag == tag:
+                break
+            if not (
+                open_tag in INLINE_TAGS
+                or "-" in open_tag
+                or (open_tag in BLOCK_TAGS and tag in BLOCK_TAGS)
+            ):
+                raise Unsupported(f"<{open_tag}> closed by </{tag}>")
+        if tag in SCRIPT_TAGS:
+            contents = self.inline
+            self.inline = self.scripts.pop()
+            self.inline.append((tag, contents))
+        elif tag in BLOCK_TAGS:
+            self.flush()
+        elif tag in ("td", "th"):
+            self.rows[-1].append((self.item_text(), tag == "th" or self.header))
+        elif tag == "li":
+            if not (text := self.item_text()):
+                raise Unsupported("Empty list item")
+            self.items.append(text)
+        elif tag == "table":
+            self.flush()
+            self.blocks.append(self.render_table())
+            self.rows = None
+        elif tag in ("ul", "ol"):
+            self.flush()
+            self.blocks.append(self.render_list())
+            self.items = None
+        elif tag in ("thead", "tbody", "tr"):
+            self.flush()
+            self.header = False
+
+    def item_text(self) -> str:
+        """The text of a table cell or list item, which has to be a single line."""
+        text = render_inline(self.inline)
+        self.inline = []
+        if "\n" in text:
+            raise Unsupported("<br> in a table cell or list item")
+        # Pandoc keeps spaces at the edges of tags inside cells and items.
+        if self.tagged and text != text.strip(" "):
+            raise Unsupported("Table cell or list item with spaces at the edges")
+        return text.strip(" ")
+
+    def render_table(self) -> str:
+        rows = [row for row in self.rows if row]
+        if not rows or not all(any(text for text, _ in row) for row in rows):
+            raise Unsupported("Table with an empty row")
+        header = all(is_header for _, is_header in rows[0])
+        if any(is_header for row in rows[header:] for _, is_header in row):
+            raise Unsupported("Header cells in the table body")
+        columns = max(len(row) for row in rows)
+        rows = [[text for text, _ in row] + [""] * (columns - len(row)) for row in rows]
+        widths = [max(text_width(row[i]) for row in rows) + 2 for i in range(columns)]
+
+        def line(cells):
+            padded = [
+                cell + " " * (width - text_width(cell))
+                for cell, width in zip(cells[:-1], widths)
+            ]
+            return "  " + " ".join(padded + [cells[-1]])
+
+        rule = line(["-" * width for width in widths[:-1]] + ["-" * widths[-1]])
+        if header:
+            return "\n".join([line(rows[0]), rule, *(line(row) for row in rows[1:])])
+        return "\n".join([rule, *(line(row) for row in rows), rule])
+
+    def render_list(self) -> str:
+        if not self.items:
+            raise Unsupported("Empty list")
+        lines = []
+        for i, item in enumerate(self.items):
+            marker = "-" if self.start is None else f"{self.start + i}."
+            line = f"{marker:<3} {item}" if self.start is not None else f"- {item}"
+            if text_width(line) > MAX_LINE:
+                raise Unsupported("List item that pandoc would wrap")
+            lines.append(line)
+        return "\n".join(lines)
+
+    def convert(self, html: str) -> str:
+        # We use nulls to mark <br>s.
+        if "\0" in html:
+            raise Unsupported("Null character")
+        position = 0
+        for m in _TOKENS.finditer(html):
+            if m.start() > position:
+                self.text(html[position : m.start()])
+            position = m.end()
+            if (tag := m.group("tag")) is None:
+                # A comment.
+                continue
+            tag = tag.lower()
+            if m.group("end"):
+                self.end_tag(tag)
+            else:
+                self.start_tag(tag, m.group("attributes"))
+                if m.group("self_closing") and tag not in VOID_TAGS:
+                    raise Unsupported(f"Self closing <{tag}/>")
+        if position < len(html):
+            self.text(html[position:])
+        if self.scripts or self.rows is not None or self.items is not None:
+            raise Unsupported("Unclosed script, table, or list")
+        self.flush()
+        return "\n\n".join(self.blocks) + "\n"
+
+    def text(self, text: str):
+        if "<" in text:
+            raise Unsupported("< that doesn't start a tag")
+        self.inline.append(unescape(text))
+
+
+def html_to_text(html: str) -> Optional[str]:
+    """Convert html to what `pandoc --from html --to plain` gives, without wrapping lines.
+
+    Returns None when the html uses something we don't convert.
+    """
+    try:
+        return _Converter().convert(html)
+    except Unsupported:
+        return None
@@ -0,0 +1,129 @@
+"""Tests for converting patent html to text without pandoc.
+
+The expected outputs are what `pandoc --from html --to plain` gives (without
+wrapping lines). When pandoc is installed, html built from the examples and
+random documents are also checked against it.
+"""
+
+import random
+import re
+
+import pytest
+from patent_examples import example_html, read_examples
+from patent_html import html_to_text
+
+GOLDEN = [
+    ("<p>a <i>it</i> <b>bold</b> <u>u</u></p>", "a it bold u\n"),
+    (
+        "<p>  lead   multiple   spaces\n\n newline  </p>",
+        "lead multiple spaces newline\n",
+    ),
+    ("<p>10 nm a\xa0b</p>", "10 nm a\xa0b\n"),
+    ("<p>a<br/>b<br> <br>c<br></p>", "a\nb\nc\n"),
+    ("<p>a</p><p></p><p> </p><p>b</p>", "a\n\nb\n"),
+    ("text outside<p>p</p>tail", "text outside\n\np\n\ntail\n"),
+    ("<heading>HEAD</heading><p>x</p>", "HEAD\n\nx\n"),
+    (
+        "<p>see <figref idref='f1'>FIG. 1</figref> and <span>s</span></p>",
+        "see FIG. 1 and s\n",
+    ),
+    ("<div>x<p>y</p>z</div>", "x\n\ny\n\nz\n"),
+    (
+        "<claim-statement>What is claimed is:</claim-statement>"
+        "<div class='claim'><div class='claim-text'>1. A method comprising:"
+        "<div class='claim-text'>a step; and</div></div></div>",
+        "What is claimed is:\n\n1. A method comprising:\n\na step; and\n",
+    ),
+    ("<p>&amp; &lt; &#x2014;&mdash; &copy; a & b</p>", "& < —— © a & b\n"),
+    ("<p>H<sub>2</sub>O x<sup>2 </sup>y 10<sup>−3</sup></p>", "H₂O x² y 10⁻³\n"),
+    ("<p>CO<sub>2a</sub> x<sup>n+1</sup> y<sup> 2</sup></p>", "CO_(2a) x^(n+1) y ²\n"),
+    (
+        "<table><tr><th>A</th><th>Bee</th></tr><tr><td>1</td><td>2</td></tr></table>",
+        "  A   Bee\n  --- -----\n  1   2\n",
+    ),
+    (
+        "<tables><table><tr><td>a</td></tr><tr><td>µm 温度</td><td>c</td></tr></table></tables>",
+        "  --------- ---\n  a         \n  µm 温度   c\n  --------- ---\n",
+    ),
+    ("<ul><li>one</li><li>two</li></ul><p>b</p>", "- one\n- two\n\nb\n"),
+    ("<ol start='9'><li>i</li><li>j</li></ol>", "9.  i\n10. j\n"),
+    ("", "\n"),
+]
+
+UNSUPPORTED = [
+    "<p><img src='x.png' alt='alt'/></p>",
+    "<pre>pre  formatted</pre>",
+    "<p>a<math><mi>x</mi></math></p>",
+    "<p>a<sup><i>2</i></sup></p>",
+    "<p>a <b> </b>b</p>",
+    "<table><tr><td colspan='2'>a</td></tr></table>",
+    "<ul><li>a<ul><li>b</li></ul></li></ul>",
+    "<p>a &unknown; b</p>",
+    "<p>a < b</p>",
+    "<i><p>a</i>",
+]
+
+
+@pytest.mark.parametrize("html,text", GOLDEN)
+def test_html_to_text(html, text):
+    assert html_to_text(html) == text
+
+
+@pytest.mark.parametrize("html", UNSUPPORTED)
+def test_unsupported_html(html):
+    assert html_to_text(html) is None
+
+
+FRAGMENTS = [
+    *(html for html, _ in GOLDEN),
+    *UNSUPPORTED,
+    "<p>",
+    "</p>",
+    "<div>",
+    "</div>",
+    "<i>",
+    "</i>",
+    "<sup>",
+    "</sup>",
+    "<sub>",
+    "</sub>",
+    "<br>",
+    "<claim-text>",
+    "</claim-text>",
+    "text",
+    "2",
+    "−",
+    " ",
+    "\n",
+    "\t",
+    "&nbsp;",
+    "&amp;",
+    "1. ",
+    "x" * 40,
+]
+
+
+def test_matches_pandoc():
+    pypandoc = pytest.importorskip("pypandoc")
+    try:
+        pypandoc.get_pandoc_version()
+    except OSError:
+        pytest.skip("pandoc isn't installed")
+    single_newlines = re.compile(r"(?<!\n)\n(?!\n)")
+
+    def check(html):
+        text = pypandoc.convert_text(html, "plain", "html", extra_args=["--quiet"])
+        # Pandoc wraps lines, which `parse_html` undoes.
+        assert single_newlines.sub(" ", html_to_text(html)) == single_newlines.sub(
+            " ", text
+        ), html
+
+    rng = random.Random(1234)
+    for example in read_examples():
+        html = example_html(example["text"], rng)
+        assert html_to_text(html) is not None
+        check(html)
+    for _ in range(100):
+        html = "".join(rng.choices(FRAGMENTS, k=rng.randint(1, 10)))
+        if html_to_text(html) is not None:
+            check(html)
@@ -1,18 +1,24 @@
 import argparse
+import io
+import multiprocessing as mp
 import os
 import sys
-from functools import partial
+from contextlib import nullcontext
+from itertools import groupby
+from operator import itemgetter
 from pathlib import Path
-from typing import Iterator
+from typing import Iterable, Iterator, Optional, Tuple
 
 import polars as pl
+import pyarrow.parquet as pq
 from polars import col
 from tqdm import tqdm
-from utils import parallel_apply
+from utils import ConversionPool, clean_text_expr
 
 from licensed_pile.licenses import PermissiveLicenses
 from licensed_pile.logs import configure_logging
-from licensed_pile.write import to_dolma
+from licensed_pile.memory import parse_size
+from licensed_pile.write import to_dolma_chunks
 
 logger = configure_logging("uspto")
 
@@ -24,6 +30,8 @@ def process_datasets(
     data_dir: str = r"data/uspto/",
     limit: int = 0,
     max_concurrency: int = 4,
+    pool: Optional[ConversionPool] = None,
+    batch_size: int = 4096,
 ) -> Iterator[dict]:
     """
     This function `run_dataset` scans a dataset located in a directory, converts each file in the dataset to a desired
@@ -31,8 +39,12 @@ def process_datasets(
 
     Parameters:
     - `data_dir` (str): The directory where the dataset is located. Default value is "./data/uspto/".
-    - `limit` (int): The maximum number of rows to convert. Default value is 0, which means convert all rows from all files in the dataset.
+    - `limit` (int): The maximum number of rows to convert across all the files, files after the limit is reached
+      aren't read. Default value is 0, which means convert all rows from all files in the dataset.
     - `max_concurrency` (int): The maximum number of concurrent conversions to perform. Default value is 2.
+    - `pool` (ConversionPool): A pool to run the conversions in, one with `max_concurrency` workers is created
+      (and shared by all the files) when it isn't given.
+    - `batch_size` (int): How many rows of a file to read and convert at once, 0 converts each file at once.
 
     Returns:
     - `Iterable[dict]`: An iterable of dictionaries containing the converted data from each file in the dataset.
@@ -51,60 +63,166 @@ def process_datasets(
     """
     data_path = Path(data_dir)
     logger.info(f"Processing files in {data_path}")
-    file_names = list(data_path.glob("*.parquet"))
-    for i, file_name in enumerate(file_names):
-        for x in scan_dataset(file_name, limit, max_concurrency).iter_rows(named=True):
-            yield x
+    file_names = sorted(data_path.glob("*.parquet"))
+    with nullcontext(pool) if pool else ConversionPool(max_concurrency) as pool:
+        for _, batch in stream_datasets(file_names, limit, pool, batch_size):
+            yield from batch.iter_rows(named=True)
 
 
 def to_parquet(
-    output_dir: str, data_dir: str, limit: int, max_concurrency: int
+    output_dir: str,
+    data_dir: str,
+    limit: int,
+    max_concurrency: int,
+    pool: Optional[ConversionPool] = None,
+    batch_size: int = 4096,
 ) -> None:
     output_dir = Path(output_dir)
     datapath = Path(data_dir)
     logger.info(
         f'Processing {len(list(datapath.glob("*.parquet")))} files in {datapath}'
     )
-    for i, files in enumerate(tqdm(datapath.glob("*.parquet"))):
-        file_path = output_dir.joinpath(f"uspto{i}.parquet")
-        scan_dataset(files, limit, max_concurrency).write_parquet(file_path)
+    with nullcontext(pool) if pool else ConversionPool(max_concurrency) as pool:
+        file_names = tqdm(sorted(datapath.glob("*.parquet")))
+        for i, batches in groupby(
+            stream_datasets(file_names, limit, pool, batch_size), key=itemgetter(0)
+        ):
+            write_parquet(
+                (batch for _, batch in batches),
+                output_dir.joinpath(f"uspto{i}.parquet"),
+            )
+
+
+def write_parquet(batches: Iterator[pl.DataFrame], file_path) -> None:
+    """Append each converted batch to `file_path` as a row group."""
+    writer = None
+    for batch in batches:
+        table = batch.to_arrow()
+        if writer is None:
+            writer = pq.ParquetWriter(file_path, table.schema)
+        writer.write_table(table)
+    if writer is not None:
+        writer.close()
+
+
+def dolma_jsonl(batches: Iterable[pl.DataFrame]) -> Iterator[bytes]:
+    """Serialize each converted batch to dolma json lines with polars, without making a python dict per row."""
+    for batch in batches:
+        buffer = io.BytesIO()
+        batch.write_ndjson(buffer)
+        yield buffer.getvalue()
+
+
+def convert_file(
+    i: int, file_name, args: argparse.Namespace, pool: ConversionPool
+) -> None:
+    """Convert the `i`th parquet file to its own output, `uspto{i}.parquet` or `*_uspto-{i:05d}.jsonl.gz`."""
+    batches = stream_dataset(file_name, args.limit, pool, args.batch_size)
+    if args.to_parquet:
+        write_parquet(batches, Path(args.output_path).joinpath(f"uspto{i}.parquet"))
+    else:
+        to_dolma_chunks(
+            dolma_jsonl(batches),
+            args.output_path,
+            f"uspto-{i:05d}.jsonl.gz",
+            threads=args.write_threads,
+        )
 
 
-def scan_dataset(file_name, limit, max_concurrency) -> pl.DataFrame:
+def file_worker(files, args: argparse.Namespace, processes: int) -> None:
+    """Convert files from the `files` queue until it is empty, this runs in its own process.
+
+    The worker keeps one ConversionPool of `processes` workers for all of its files.
     """
-    Scans an individual parquet file and returns a processed DataFrame.
+    failed = False
+    with ConversionPool(
+        processes, args.converter, cache=args.cache, cache_size=args.cache_size
+    ) as pool:
+        while (task := files.get()) is not None:
+            i, file_name = task
+            try:
+                convert_file(i, file_name, args, pool)
+                logger.info(f"Finished {file_name}")
+            except Exception:
+                logger.exception(f"Failed to convert {file_name}")
+                failed = True
+                # Don't leave partial outputs that look like finished files.
+                for output in Path(args.output_path).glob(
+                    f"uspto{i}.parquet"
+                    if args.to_parquet
+                    else f"*_uspto-{i:05d}.jsonl.gz"
+                ):
+                    output.unlink()
+    if failed:
+        sys.exit(1)
 
-    Returns:
-        DataFrame: A processed DataFrame containing the selected columns from the dataset.
 
-    Example Usage:
-        file_name = "dataset.parquet"
-        limit = 100
-        max_concurrency = 4
+def process_files(args: argparse.Namespace) -> None:
+    """Convert `--file-workers` files at the same time, each one to its own output.
 
-        result = scan_dataset((file_name, limit, max_concurrency))
+    Converting one file at a time leaves the conversion pool idle while polars reads, filters and writes each
+    batch. Here each file worker has its own pool, with an even share of the `--max-concurrency` conversion
+    workers, and takes the next file as soon as it finishes one. Files are handed out largest first so a large
+    file isn't left running on its own at the end.
     """
-    parallel_apply_desc = partial(parallel_apply, False, max_concurrency)
-    parallel_apply_claims = partial(parallel_apply, True, max_concurrency)
-    columns = (
-        "title_text",
-        "title_language",
-        "abstract_text",
-        "description_html",
-        "claims_html",
-        "publication_date",
-        "application_number",
-        "filing_date",
+    file_names = sorted(Path(args.data_path).glob("*.parquet"))
+    os.makedirs(args.output_path, exist_ok=True)
+    workers = min(args.file_workers, len(file_names))
+    processes = max(1, (args.max_concurrency or os.cpu_count()) // max(workers, 1))
+    logger.info(
+        f"Processing {len(file_names)} files with {workers} file workers of {processes} conversion workers each."
     )
+    ctx = mp.get_context("spawn")
+    files = ctx.Queue()
+    for task in sorted(
+        enumerate(file_names), key=lambda f: os.path.getsize(f[1]), reverse=True
+    ):
+        files.put(task)
+    for _ in range(workers):
+        files.put(None)
+    running = [
+        ctx.Process(target=file_worker, args=(files, args, processes))
+        for _ in range(workers)
+    ]
+    for process in running:
+        process.start()
+    for process in running:
+        process.join()
+    if failed := [p for p in running if p.exitcode != 0]:
+        raise RuntimeError(
+            f"{len(failed)} file worker(s) failed, see the log for the files."
+        )
 
-    df: pl.LazyFrame = (
-        pl.scan_parquet(file_name)
-        .select(columns)
-        .filter(
-            ~pl.all_horizontal(
-                pl.col(["abstract_text", "description_html", "claims_html"]).is_null()
-            )
+
+COLUMNS = (
+    "title_text",
+    "title_language",
+    "abstract_text",
+    "description_html",
+    "claims_html",
+    "publication_date",
+    "application_number",
+    "filing_date",
+)
+
+
+def convert_patents(
+    df: pl.LazyFrame, pool: ConversionPool, limit: int = 0
+) -> pl.LazyFrame:
+    """Turn the raw patent columns into dolma style columns, converting the html with `pool`.
+
+    When `limit` is set, only the first `limit` rows that have some text are converted.
+    """
+    df = df.select(COLUMNS).filter(
+        ~pl.all_horizontal(
+            pl.col(["abstract_text", "description_html", "claims_html"]).is_null()
         )
+    )
+    if limit > 0:
+        # Cut the rows before the expensive html conversion.
+        df = df.head(limit)
+    return (
+        df
         # we use app no. for the id and filing date for the date created
         .rename({"application_number": "id", "filing_date": "created"})
         .with_columns(
@@ -121,13 +239,13 @@ def scan_dataset(file_name, limit, max_concurrency) -> pl.DataFrame:
         )
         .with_columns_seq(
             col("description_html").map_batches(
-                parallel_apply_desc,
-                return_dtype=pl.String,
-            ),
-            col("claims_html").map_batches(
-                parallel_apply_claims,
-                return_dtype=pl.String,
+                pool.parallel_apply, return_dtype=pl.String
             ),
+            col("claims_html").map_batches(pool.parallel_apply, return_dtype=pl.String),
+        )
+        .with_columns(
+            clean_text_expr(col("description_html"), claims=False),
+            clean_text_expr(col("claims_html"), claims=True),
         )
         .with_columns(
             pl.concat_str(
@@ -148,9 +266,76 @@ def scan_dataset(file_name, limit, max_concurrency) -> pl.DataFrame:
             pl.lit("Google Patents Public Data").alias("source"),
         )
     ).select(["id", "text", "added", "created", "source", "metadata"])
+
+
+def scan_dataset(file_name, limit, pool: ConversionPool) -> pl.DataFrame:
+    """
+    Scans an individual parquet file and returns a processed DataFrame.
+
+    The whole file is converted at once, use `stream_dataset` to convert large files with bounded memory.
+
+    Returns:
+        DataFrame: A processed DataFrame containing the selected columns from the dataset.
+
+    Example Usage:
+        file_name = "dataset.parquet"
+        limit = 100
+
+        with ConversionPool(max_concurrency=4) as pool:
+            result = scan_dataset(file_name, limit, pool)
+    """
+    return convert_patents(pl.scan_parquet(file_name), pool, limit).collect()
+
+
+def stream_dataset(
+    file_name, limit, pool: ConversionPool, batch_size: int = 4096
+) -> Iterator[pl.DataFrame]:
+    """
+    Converts an individual parquet file `batch_size` rows at a time.
+
+    Rows are read from the parquet row groups in batches (only the columns we use), so memory is bounded by the
+    batch size instead of the file size. Each batch is converted on its own and yielded as soon as it is done.
+    A `batch_size` of 0 converts the whole file at once, like `scan_dataset`. Once `limit` rows have been
+    converted the rest of the file isn't read.
+
+    Example Usage:
+        with ConversionPool(max_concurrency=4) as pool:
+            for batch in stream_dataset("dataset.parquet", 0, pool, batch_size=1024):
+                batch.write_parquet(...)
+    """
+    if batch_size <= 0:
+        yield scan_dataset(file_name, limit, pool)
+        return
     if limit > 0:
-        df = df.fetch(limit).lazy()
-    return df.collect()
+        batch_size = min(batch_size, limit)
+    remaining = limit
+    parquet = pq.ParquetFile(file_name)
+    for batch in parquet.iter_batches(batch_size=batch_size, columns=list(COLUMNS)):
+        df = convert_patents(pl.from_arrow(batch).lazy(), pool, remaining).collect()
+        yield df
+        if limit > 0:
+            remaining -= len(df)
+            if remaining <= 0:
+                break
+
+
+def stream_datasets(
+    file_names: Iterable[Path], limit, pool: ConversionPool, batch_size: int = 4096
+) -> Iterator[Tuple[int, pl.DataFrame]]:
+    """
+    Converts each file with `stream_dataset`, yielding the index of the file with each batch.
+
+    `limit` is the number of rows for all the files together, no more files are read once it is reached.
+    """
+    remaining = limit
+    for i, file_name in enumerate(file_names):
+        for batch in stream_dataset(file_name, remaining, pool, batch_size):
+            yield i, batch
+            if limit > 0:
+                remaining -= len(batch)
+        if limit > 0 and remaining <= 0:
+            logger.info(f"Converted {limit} rows, skipping the rest of the files.")
+            return
 
 
 def create_args_parser() -> argparse.ArgumentParser:
@@ -169,7 +354,7 @@ def create_args_parser() -> argparse.ArgumentParser:
         "--limit",
         type=int,
         default=0,
-        help="Limit the number of rows to read for testing",
+        help="Limit the number of rows to convert (across all files) for testing",
     )
     parser.add_argument(
         "--max-concurrency",
@@ -177,6 +362,40 @@ def create_args_parser() -> argparse.ArgumentParser:
         default=int(os.cpu_count()) - 1,
         help="Maximum number of multiprocessing for pandoc conversions",
     )
+    parser.add_argument(
+        "--converter",
+        choices=["python", "pandoc"],
+        default="python",
+        help="Convert the html in python, falling back to pandoc for documents it doesn't support, or always use pandoc.",
+    )
+    parser.add_argument(
+        "--cache",
+        help="Path to an sqlite cache of conversions, reruns only convert html that isn't in it.",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=parse_size,
+        default="20G",
+        help="The most (compressed) text to keep in the --cache, the least recently used conversions are removed.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=4096,
+        help="Number of rows to read and convert at once, memory use is bounded by this instead of the file size. 0 converts whole files at once.",
+    )
+    parser.add_argument(
+        "--file-workers",
+        type=int,
+        default=1,
+        help="Number of files to process at the same time, each one is written to its own output. The --max-concurrency conversion workers are split between them.",
+    )
+    parser.add_argument(
+        "--write-threads",
+        type=int,
+        default=4,
+        help="Number of threads used to compress the dolma shards.",
+    )
     parser.add_argument(
         "--to-parquet",
         action="store_true",
@@ -192,15 +411,40 @@ if __name__ == "__main__":
         f"""Processing USPTO with the following parameters: Output Dir: {args.output_path}, Data Dir: {args.data_path},
          Limit: {args.limit}, Max Concurrency: {args.max_concurrency}"""
     )
-    if args.to_parquet:
-        to_parquet(args.output_path, args.data_path, args.limit, args.max_concurrency)
-    else:
-        to_dolma(
-            process_datasets(
-                data_dir=args.data_path,
-                limit=args.limit,
-                max_concurrency=args.max_concurrency,
-            ),
-            args.output_path,
-            "uspto.jsonl.gz",
+    if args.file_workers > 1 and args.limit > 0:
+        logger.warning(
+            "--limit counts rows across all files, so files are processed one at a time."
         )
+        args.file_workers = 1
+    if args.file_workers > 1:
+        process_files(args)
+    else:
+        # One pool of pandoc workers is used for every file.
+        with ConversionPool(
+            args.max_concurrency,
+            args.converter,
+            cache=args.cache,
+            cache_size=args.cache_size,
+        ) as pool:
+            if args.to_parquet:
+                to_parquet(
+                    args.output_path,
+                    args.data_path,
+                    args.limit,
+                    args.max_concurrency,
+                    pool,
+                    args.batch_size,
+                )
+            else:
+                batches = stream_datasets(
+                    sorted(Path(args.data_path).glob("*.parquet")),
+                    args.limit,
+                    pool,
+                    args.batch_size,
+                )
+                to_dolma_chunks(
+                    dolma_jsonl(batch for _, batch in batches),
+                    args.output_path,
+                    "uspto.jsonl.gz",
+                    threads=args.write_threads,
+                )
@@ -1,12 +1,21 @@
+import hashlib
 import multiprocessing
+import multiprocessing.util
+import os
 import re
-from functools import partial
+import sys
+from functools import lru_cache, partial
 from itertools import islice
+from typing import Optional
 
+import patent_html
 import polars as pl
-import pypandoc
+from patent_html import html_to_text
 from rich.progress import track
 
+from licensed_pile.cache import ConversionCache
+from licensed_pile.pandoc import Pandoc
+
 
 def batched(iterable, n):
     it = iter(iterable)
@@ -14,29 +23,183 @@ def batched(iterable, n):
         yield batch
 
 
-def parse_html(claims: bool, html_string: str) -> str:
+# Each worker starts its own pandoc process the first time it needs one and keeps
+# it running for the rest of the documents.
+_PANDOC = None
+
+
+def get_pandoc() -> Pandoc:
+    global _PANDOC
+    if _PANDOC is None:
+        _PANDOC = Pandoc("html", "plain")
+    return _PANDOC
+
+
+# remove single newlines that are not surrounded by other newlines as those are likely line length formatting.
+NEW_LINE_PATTERN = r"(?<!\n)\n(?!\n)"
+# also add line-breaks after <number><periods> for claims (as they are all numbered).
+LIST_PATTERN = r"(\s\d+\.\s)"
+
+
+# Each worker opens the conversion cache the first time it needs it.
+_CACHES = {}
+
+
+def conversion_version(converter: str) -> str:
+    """Cached conversions are only reused while this (and so the conversion) is the same."""
+    with open(patent_html.__file__, "rb") as f:
+        source = hashlib.sha1(f.read()).hexdigest()
+    try:
+        pandoc = get_pandoc().version
+    except FileNotFoundError:
+        pandoc = "no pandoc"
+    return f"uspto {converter} patent_html={source} {pandoc}"
+
+
+def get_cache(path: str, converter: str, max_size: Optional[int]) -> ConversionCache:
+    if path not in _CACHES:
+        cache = ConversionCache(path, conversion_version(converter), max_size)
+        # Save the buffered results when the pool closes and the worker exits.
+        multiprocessing.util.Finalize(cache, cache.close, exitpriority=10)
+        _CACHES[path] = cache
+    return _CACHES[path]
+
+
+def convert_html(
+    html_string: str,
+    converter: str = "python",
+    cache: Optional[str] = None,
+    cache_size: Optional[int] = None,
+) -> str:
     if not html_string:
         return ""
-    text = pypandoc.convert_text(html_string, "plain", "html", extra_args=["--quiet"])
-    # remove single newlines that are not surrounded by other newlines as those are likely line length formatting.
-    new_line_pattern = r"(?<!\n)\n(?!\n)"
-    # also add line-breaks after <number><periods> for claims (as they are all numbered).
-    list_pattern = r"(\s\d+\.\s)"
-    text = re.sub(new_line_pattern, " ", text)
+    if cache is not None:
+        return get_cache(cache, converter, cache_size).convert(
+            html_string, partial(convert_html, converter=converter)
+        )
+    # The python converter gives the same text as pandoc without starting a
+    # process, documents it can't convert are still sent to pandoc.
+    text = html_to_text(html_string) if converter == "python" else None
+    if text is None:
+        text = get_pandoc().convert(html_string)
+    return text
+
+
+def clean_text(claims: bool, text: str) -> str:
+    text = re.sub(NEW_LINE_PATTERN, " ", text)
     if claims:
-        text = re.sub(list_pattern, r"\n\1", text)
+        text = re.sub(LIST_PATTERN, r"\n\1", text)
     return text
 
 
-# from: https://stackoverflow.com/a/74749075/19355181
-def parallel_apply(claims: bool, max_concurrency: int, column: pl.Series) -> pl.Series:
+def parse_html(claims: bool, html_string: str, converter: str = "python") -> str:
+    return clean_text(claims, convert_html(html_string, converter))
+
+
+@lru_cache
+def python_class(predicate) -> str:
+    r"""A regex character class of the characters where `predicate` is true.
+
+    Python's `\s` and `\d` are `str.isspace` and `str.isdecimal`, rust's are
+    close but not the same (python's `\s` includes \x1c-\x1f and the unicode
+    versions differ) so we spell out python's.
+    """
+    ranges = []
+    for i in range(sys.maxunicode + 1):
+        if predicate(chr(i)):
+            if ranges and ranges[-1][1] == i - 1:
+                ranges[-1][1] = i
+            else:
+                ranges.append([i, i])
+    return "[" + "".join(f"\\x{{{a:x}}}-\\x{{{b:x}}}" for a, b in ranges) + "]"
+
+
+def clean_text_expr(text: pl.Expr, claims: bool) -> pl.Expr:
+    r"""`clean_text` as a polars expression, so it runs in rust over the whole column.
+
+    Rust's regex engine doesn't support look-arounds, so a single newline is
+    matched along with the (non newline) characters on either side of it. Those
+    characters are consumed, so a newline right after a match (`a\nb\nc`) is
+    missed, but it is never next to another missed one and a second pass finds
+    it.
+    """
+    for _ in range(2):
+        text = text.str.replace_all(r"(^|[^\n])\n([^\n]|$)", "${1} ${2}")
     if claims:
-        fn = partial(parse_html, True)
-    else:
-        fn = partial(parse_html, False)
-    if max_concurrency == 0:
-        max_concurrency = None
-    # polars mainly handles the concurrency but the pandoc calls add as a blocker. This is a workaround to
-    # increase the concurrency of the pandoc calls.
-    with multiprocessing.get_context("spawn").Pool(max_concurrency) as pool:
-        return pl.Series(pool.imap(fn, track(column, description="Processing column")))
+        space, digit = python_class(str.isspace), python_class(str.isdecimal)
+        text = text.str.replace_all(f"({space}{digit}+\\.{space})", "\n${1}")
+    return text
+
+
+class ConversionPool:
+    """A long lived pool of workers for the pandoc conversions.
+
+    Starting a spawn pool means each worker re-imports polars (and starts a pandoc process), so
+    the pool is created once and shared by every column of every file instead
+    of once per `map_batches` call.
+
+    Parameters:
+    - `max_concurrency` (int): The number of workers, 0 uses all cpus.
+    - `converter` (str): "python" to convert html in process and only use pandoc for the documents it can't
+      convert, or "pandoc" to use pandoc for everything.
+    - `chunks_per_worker` (int): How many chunks each worker should get for a column. More chunks balance the
+      load better, fewer chunks have less ipc overhead.
+    - `max_chunksize` (int): The most documents to send to a worker at once.
+    - `cache` (str): The path to a `ConversionCache` shared by the workers, conversions of html that was
+      converted before (by the same version of the converters) are read from it instead.
+    - `cache_size` (int): The most bytes to keep in the cache, the least recently used conversions are removed.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        converter: str = "python",
+        chunks_per_worker: int = 4,
+        max_chunksize: int = 64,
+        cache: Optional[str] = None,
+        cache_size: Optional[int] = None,
+    ):
+        self.processes = max_concurrency or os.cpu_count()
+        self.converter = converter
+        self.cache = cache
+        self.cache_size = cache_size
+        self.chunks_per_worker = chunks_per_worker
+        self.max_chunksize = max_chunksize
+        self.pool = multiprocessing.get_context("spawn").Pool(self.processes)
+
+    def chunksize(self, n: int) -> int:
+        return max(
+            1, min(self.max_chunksize, n // (self.processes * self.chunks_per_worker))
+        )
+
+    # from: https://stackoverflow.com/a/74749075/19355181
+    def parallel_apply(self, column: pl.Series) -> pl.Series:
+        # polars mainly handles the concurrency but the pandoc calls add as a blocker. This is a workaround to
+        # increase the concurrency of the pandoc calls.
+        # The text is cleaned up afterwards for the whole column with `clean_text_expr`.
+        return pl.Series(
+            self.pool.imap(
+                partial(
+                    convert_html,
+                    converter=self.converter,
+                    cache=self.cache,
+                    cache_size=self.cache_size,
+                ),
+                track(column, description="Processing column"),
+                chunksize=self.chunksize(len(column)),
+            ),
+            dtype=pl.String,
+        )
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+        else:
+            self.pool.terminate()
@@ -0,0 +1,44 @@
+"""Tests for the vectorized text cleanup matching the regexes in `clean_text`."""
+
+import random
+
+import polars as pl
+import pytest
+from utils import clean_text, clean_text_expr
+
+EXAMPLES = [
+    "",
+    "\n",
+    "\n\n",
+    "a\nb\nc\nd",
+    "\na\n",
+    "a\n\nb\n\n\nc\nd",
+    "What is claimed is:\n1. A method comprising: 2. The method of claim 1.\n3. x",
+    "a 12. b\t3.\nc 4.5. d",
+    "claim ٣. b\x1c7.\x1dc 8. d",
+]
+
+ALPHABET = ["\n", "\n", " ", "\t", "\r", "a", "1", "23", ".", "\x1c", " ", "٣"]
+
+
+def clean(texts, claims):
+    return (
+        pl.Series("text", texts, dtype=pl.String)
+        .to_frame()
+        .select(clean_text_expr(pl.col("text"), claims))
+        .to_series()
+        .to_list()
+    )
+
+
+@pytest.mark.parametrize("claims", [False, True])
+def test_clean_text_expr_matches_regexes(claims):
+    rng = random.Random(1234)
+    texts = EXAMPLES + [
+        "".join(rng.choices(ALPHABET, k=rng.randint(1, 30))) for _ in range(5000)
+    ]
+    assert clean(texts, claims) == [clean_text(claims, text) for text in texts]
+
+
+def test_clean_text_expr_keeps_nulls():
+    assert clean([None, "a\nb"], claims=True) == [None, "a b"]